@@ -0,0 +1,60 @@
+"""
+Connects the benchmark scripts that need a real database to a database of their own, so the synthetic rows they write
+never go to the real one. The database is given by the YTM_BENCHMARK_DSN environment variable
+(ie: "host=nuc dbname=ytm_bench user=postgres password=..."). If it doesn't have any tables yet, they are created with
+sql/create_tables.sql.
+"""
+import os
+
+from psycopg2.extensions import parse_dsn
+from psycopg2.pool import ThreadedConnectionPool
+
+from db import db_service
+from db.db_service import executeSQL, executeSQLFetchOne, transaction
+
+BENCHMARK_DSN_VARIABLE = "YTM_BENCHMARK_DSN"
+# the name of the real database (see db_service.initializeDbConnectionPool)
+REAL_DB_NAME = "ytm"
+CREATE_TABLES_FILE = os.path.join(os.path.dirname(__file__), "..", "..", "sql", "create_tables.sql")
+
+# the ids of the rows created by synthetic.createSongs that aren't deleted with the songs
+SYNTHETIC_ALBUM_IDS = r"^MPREb_album\d+$"
+SYNTHETIC_ARTIST_IDS = r"^UC_artist\d+$"
+SYNTHETIC_THUMBNAIL_IDS = r"^https://lh3\.googleusercontent\.com/album\d+=$"
+
+
+def initializeBenchmarkDb():
+    """
+    Point the db connection pool at the benchmark database. Exits if YTM_BENCHMARK_DSN isn't set, or if it is the
+    real database.
+    :return:
+    """
+    dsn = os.environ.get(BENCHMARK_DSN_VARIABLE)
+    if not dsn:
+        raise SystemExit(f"Set {BENCHMARK_DSN_VARIABLE} to the dsn of a database the benchmark can write to")
+    if parse_dsn(dsn).get("dbname", REAL_DB_NAME) == REAL_DB_NAME:
+        raise SystemExit(f"{BENCHMARK_DSN_VARIABLE} can't be the real database ({REAL_DB_NAME})")
+    db_service.db_conn_pool = ThreadedConnectionPool(1, 20, dsn=dsn)
+    if not executeSQLFetchOne("SELECT to_regclass('song')", None)[0]:
+        with open(CREATE_TABLES_FILE) as f:
+            executeSQL(f.read())
+
+
+def deleteSyntheticRows():
+    """
+    Delete the albums, artists and thumbnails created by synthetic.createSongs that no song uses anymore.
+    Call this after the benchmark's songs have been deleted.
+    :return:
+    """
+    with transaction():
+        executeSQL("DELETE FROM album AS a WHERE a.id ~ %s "
+                   "AND NOT EXISTS (SELECT 1 FROM song AS s WHERE s.album_id = a.id)", (SYNTHETIC_ALBUM_IDS,))
+        executeSQL("DELETE FROM artist AS a WHERE a.id ~ %s "
+                   "AND NOT EXISTS (SELECT 1 FROM artist_songs AS ass WHERE ass.artist_id = a.id)",
+                   (SYNTHETIC_ARTIST_IDS,))
+        # thumbnail_download rows are deleted with them (on delete cascade)
+        executeSQL("DELETE FROM data_cache WHERE data_id ~ %s AND data_type = 'thumbnail'",
+                   (SYNTHETIC_THUMBNAIL_IDS,))
+        executeSQL("DELETE FROM thumbnail AS t WHERE t.id ~ %s "
+                   "AND NOT EXISTS (SELECT 1 FROM album AS a WHERE a.thumbnail_id = t.id)",
+                   (SYNTHETIC_THUMBNAIL_IDS,))
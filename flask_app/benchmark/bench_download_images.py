@@ -0,0 +1,97 @@
+"""
+Measures thumbnail download throughput against a local http server that stands in for the YTM image CDN.
+Compares the original downloader (a new connection per image, 1 KB writes, one UPDATE per image) with
+image_downloader.downloadImages. The 5 second sleep the original did after every image is left out.
+
+Run from the flask_app directory: python -m benchmark.bench_download_images
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import benchmark.synthetic  # noqa: F401 (imports cache_service first)
+import requests
+
+from benchmark.fake_db import installFakePool
+from cache import image_downloader
+from db.db_service import executeSQL
+
+IMAGE_SIZE_BYTES = 40 * 1024
+# how long the stand-in server takes to start responding (ie: network latency)
+RESPONSE_DELAY_SECONDS = 0.02
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    image = os.urandom(IMAGE_SIZE_BYTES)
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(RESPONSE_DELAY_SECONDS)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(self.image)))
+        self.end_headers()
+        self.wfile.write(self.image)
+
+    def log_message(self, log_format, *args):
+        pass
+
+
+def startServer():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def downloadImagesOriginal(image_dir):
+    """
+    The implementation of downloadImages before the download pipeline was added (without the sleep)
+    :param image_dir:
+    :return:
+    """
+    for thumbnail in image_downloader.getThumbnailsToDownload():
+        filename = image_downloader.getImageFilename(thumbnail.url)
+        with open(os.path.join(image_dir, filename), 'wb') as img_file:
+            response = requests.get(thumbnail.url, stream=True)
+            if not response:
+                continue
+            for block in response.iter_content(1024):
+                if not block:
+                    break
+                img_file.write(block)
+        update = "UPDATE thumbnail_download " \
+                 "SET filepath = %s, downloaded=true " \
+                 "WHERE thumbnail_id = %s"
+        executeSQL(update, (filename, thumbnail.thumbnail_id))
+
+
+def runBenchmark(download_function, num_images, port):
+    rows = [(f"http://127.0.0.1:{port}/image/{i}", False, 120, None) for i in range(num_images)]
+    pool = installFakePool(lambda query, data: rows if str(query).startswith("SELECT") else [])
+    image_dir = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        download_function(image_dir)
+        elapsed = time.perf_counter() - start
+        assert len(os.listdir(image_dir)) == num_images
+    finally:
+        shutil.rmtree(image_dir)
+    return len(pool.queries), elapsed
+
+
+def main():
+    server = startServer()
+    port = server.server_address[1]
+    print(f"{'images':>8} {'implementation':>16} {'db statements':>14} {'seconds':>8} {'images/s':>9}")
+    for num_images in [100, 500]:
+        for name, func in [("original", downloadImagesOriginal), ("pipeline", image_downloader.downloadImages)]:
+            statements, elapsed = runBenchmark(func, num_images, port)
+            print(f"{num_images:>8} {name:>16} {statements:>14} {elapsed:>8.2f} {num_images / elapsed:>9.1f}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Measures getListeningStats (which reads the listening_stats rollup) as years of history build up, compared to
+computing the same top songs and total from the raw listening_history table.
+Needs a database of its own (see bench_db): synthetic songs and plays are written to it (in the year 2000, so they
+don't mix with real stats), then deleted.
+
+Run from the flask_app directory: python -m benchmark.bench_listening_stats
+"""
+import time
+from datetime import datetime, date
+
+from benchmark.bench_db import initializeBenchmarkDb, deleteSyntheticRows
+from benchmark.synthetic import createSongs
+from db import listening_stats
+from db import ytm_db_service as dbs
+from db.db_service import executeSQL, executeSQLFetchAll, executeSQLValues, transaction
+
+NUM_SONGS = 2000
+PLAYS_PER_DAY = 100
+YEARS = [1, 3]
+SONG_PREFIX = "STATS_"
+FIRST_DAY = datetime(2000, 1, 1)
+RUNS = 5
+
+# the top songs of a month, and its total, from the raw history
+# noinspection SqlResolve
+SELECT_RAW_STATS = "SELECT h.song_id, s.name, count(*) AS plays FROM listening_history AS h " \
+                   "JOIN song AS s ON s.id = h.song_id " \
+                   "WHERE h.listen_timestamp >= %(start)s AND h.listen_timestamp < %(end)s " \
+                   "GROUP BY h.song_id, s.name ORDER BY plays DESC LIMIT 10"
+SELECT_RAW_TOTAL = "SELECT count(*) FROM listening_history WHERE listen_timestamp >= %(start)s " \
+                   "AND listen_timestamp < %(end)s"
+
+
+def createHistory(songs, first_day, num_days):
+    """
+    Add PLAYS_PER_DAY plays to listening_history and listening_stats for each day
+    :return:
+    """
+    start = first_day.timestamp()
+    plays = [(songs[(n * 7) % len(songs)], int(start + n * 86400 / PLAYS_PER_DAY))
+             for n in range(num_days * PLAYS_PER_DAY)]
+    with transaction():
+        executeSQLValues("INSERT INTO listening_history (song_id, listen_timestamp) VALUES %s",
+                         [(song.video_id, timestamp) for song, timestamp in plays])
+        listening_stats.persistPlays(plays)
+
+
+def deleteHistory():
+    with transaction():
+        executeSQL("DELETE FROM listening_history WHERE song_id LIKE %s", (f"{SONG_PREFIX}%",))
+        executeSQL("DELETE FROM listening_stats WHERE period_start < %s", (date(2010, 1, 1),))
+        executeSQL("DELETE FROM artist_songs WHERE song_id LIKE %s", (f"{SONG_PREFIX}%",))
+        executeSQL("DELETE FROM song WHERE id LIKE %s", (f"{SONG_PREFIX}%",))
+    deleteSyntheticRows()
+
+
+def measure(func):
+    """
+    :return: fastest run in milliseconds
+    """
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def main():
+    initializeBenchmarkDb()
+    songs = createSongs(NUM_SONGS)
+    for song in songs:
+        song.video_id = f"{SONG_PREFIX}{song.video_id}"
+    with transaction():
+        dbs.persistAllSongData(songs, None)
+    print(f"{'years':>6} {'plays':>8} {'day ms':>9} {'week ms':>9} {'month ms':>9} {'raw month ms':>13}")
+    try:
+        days_created = 0
+        for years in YEARS:
+            num_days = years * 365
+            createHistory(songs, datetime.fromtimestamp(FIRST_DAY.timestamp() + days_created * 86400),
+                          num_days - days_created)
+            days_created = num_days
+            # a month in the middle of the history
+            month = date(2000 + years // 2, 6, 1)
+            raw_data = {"start": datetime(month.year, 6, 1).timestamp(), "end": datetime(month.year, 7, 1).timestamp()}
+            raw_ms = measure(lambda: (executeSQLFetchAll(SELECT_RAW_STATS, raw_data),
+                                      executeSQLFetchAll(SELECT_RAW_TOTAL, raw_data)))
+            rollup_ms = [measure(lambda: listening_stats.getListeningStats(period, month))
+                         for period in listening_stats.PERIODS]
+            print(f"{years:>6} {num_days * PLAYS_PER_DAY:>8} " + " ".join(f"{ms:>9.1f}" for ms in rollup_ms) +
+                  f" {raw_ms:>13.1f}")
+    finally:
+        deleteHistory()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Counts the db round trips made when persisting the songs of a playlist.
+Compares the original one-INSERT-per-row implementation with the bulk persistAllSongData.
+
+Run from the flask_app directory: python -m benchmark.bench_persist_songs
+"""
+import time
+from datetime import datetime
+
+from benchmark.fake_db import installFakePool
+from benchmark.synthetic import createSongs
+from db import ytm_db_service as dbs
+from db.db_service import executeSQL
+
+
+def persistAllSongDataPerRow(songs_to_add, playlist_id):
+    """
+    The implementation of persistAllSongData before bulk inserts were added: every row is its own statement
+    :param songs_to_add:
+    :param playlist_id:
+    :return:
+    """
+    datetime_added = datetime.now().timestamp()
+    for song in songs_to_add:
+        if song.album:
+            dbs.persistThumbnail(song.album.thumbnail)
+            if song.album.album_id:
+                dbs.persistAlbum(song.album)
+        dbs.persistSong(song)
+        if song.set_video_id and playlist_id:
+            sip_data = playlist_id, song.video_id, song.set_video_id, datetime_added, song.index
+            executeSQL(dbs.INSERT_SONG_IN_PLAYLIST.replace("VALUES %s", "VALUES (%s, %s, %s, %s, %s)"), sip_data)
+        for artist in song.artists:
+            executeSQL(dbs.INSERT_ARTIST.replace("VALUES %s", "VALUES (%s, %s, %s, %s, %s, %s, %s)"), artist.to_db())
+            executeSQL(dbs.INSERT_ARTIST_SONG.replace("VALUES %s", "VALUES (%s, %s)"),
+                       (song.video_id, artist.artist_id))
+
+
+def runBenchmark(persist_function, num_songs):
+    songs = createSongs(num_songs)
+    pool = installFakePool()
+    start = time.perf_counter()
+    persist_function(songs, "PL_benchmark")
+    elapsed = time.perf_counter() - start
+    return len(pool.queries), elapsed
+
+
+def main():
+    print(f"{'songs':>8} {'implementation':>16} {'round trips':>12} {'per song':>9} {'python time':>12}")
+    for num_songs in [100, 1000, 5000]:
+        for name, func in [("per row", persistAllSongDataPerRow), ("bulk", dbs.persistAllSongData)]:
+            round_trips, elapsed = runBenchmark(func, num_songs)
+            print(f"{num_songs:>8} {name:>16} {round_trips:>12} {round_trips / num_songs:>9.3f} {elapsed:>11.3f}s")
+
+
+if __name__ == '__main__':
+    main()
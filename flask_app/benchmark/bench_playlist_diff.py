@@ -0,0 +1,90 @@
+"""
+Compares the original playlist diff in persistPlaylistSongs (a linear next(...) scan for every song, and one UPDATE
+per moved song) with diffPlaylistSongs + updateSongIndicesInPlaylist, over synthetic reorder patterns.
+
+Run from the flask_app directory: python -m benchmark.bench_playlist_diff
+"""
+import copy
+import random
+import time
+
+from benchmark.fake_db import installFakePool
+from benchmark.synthetic import createSongs
+from db import ytm_db_service as dbs
+from db.db_service import executeSQL
+
+
+def diffPerRow(existing_songs, new_songs, playlist_id):
+    """
+    The original implementation: finds moved songs with next(...) scans and updates them one at a time
+    :param existing_songs:
+    :param new_songs:
+    :param playlist_id:
+    :return:
+    """
+    existing_song_ids = {(s.video_id, s.set_video_id) for s in existing_songs}
+    new_song_ids = {(s.video_id, s.set_video_id) for s in new_songs}
+    song_ids_to_update = existing_song_ids.intersection(new_song_ids)
+    for set_video_id in [s[1] for s in song_ids_to_update]:
+        existing_song_to_update = next((s for s in existing_songs if s.set_video_id == set_video_id))
+        new_song_to_update = next((s for s in new_songs if s.set_video_id == set_video_id))
+        if existing_song_to_update.index != new_song_to_update.index:
+            update = "UPDATE songs_in_playlist set index = %s where set_video_id = %s and playlist_id = %s"
+            executeSQL(update, (new_song_to_update.index, new_song_to_update.set_video_id, playlist_id))
+
+
+def diffKeyed(existing_songs, new_songs, playlist_id):
+    songs_to_delete, songs_to_add, index_updates = dbs.diffPlaylistSongs(existing_songs, new_songs)
+    if index_updates:
+        dbs.updateSongIndicesInPlaylist(playlist_id, index_updates)
+
+
+def reindex(songs):
+    for index, song in enumerate(songs):
+        song.index = index
+    return songs
+
+
+def unchanged(songs):
+    return songs
+
+
+def swapTwo(songs):
+    songs[0], songs[len(songs) // 2] = songs[len(songs) // 2], songs[0]
+    return reindex(songs)
+
+
+def moveTopToBottom(songs):
+    return reindex(songs[1:] + songs[:1])
+
+
+def moveBottomToTop(songs):
+    return reindex(songs[-1:] + songs[:-1])
+
+
+def reverseTop100(songs):
+    return reindex(list(reversed(songs[:100])) + songs[100:])
+
+
+def shuffleAll(songs):
+    random.Random(1).shuffle(songs)
+    return reindex(songs)
+
+
+def main():
+    patterns = [unchanged, swapTwo, moveTopToBottom, moveBottomToTop, reverseTop100, shuffleAll]
+    print(f"{'songs':>6} {'pattern':>16} {'implementation':>15} {'statements':>11} {'time':>9}")
+    for num_songs in [1000, 3000]:
+        existing_songs = createSongs(num_songs)
+        for pattern in patterns:
+            new_songs = pattern([copy.copy(s) for s in existing_songs])
+            for name, func in [("next() scan", diffPerRow), ("keyed diff", diffKeyed)]:
+                pool = installFakePool()
+                start = time.perf_counter()
+                func(existing_songs, new_songs, "PL_benchmark")
+                elapsed = time.perf_counter() - start
+                print(f"{num_songs:>6} {pattern.__name__:>16} {name:>15} {len(pool.queries):>11} {elapsed:>8.3f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Compares the two ways of turning a cached playlist into json: building Song objects from the db rows and calling
+to_json on each (the original streamPlaylistFromCache), and having postgres build the json for each track
+(iterPlaylistSongsJsonFromDb). Needs a database of its own (see bench_db): synthetic playlists are written to it,
+then deleted.
+
+Run from the flask_app directory: python -m benchmark.bench_playlist_json
+"""
+import json
+import time
+import tracemalloc
+
+from benchmark.bench_db import initializeBenchmarkDb, deleteSyntheticRows
+from benchmark.synthetic import createSongs
+from cache import cache_service as cs
+from db import ytm_db_service as dbs
+from db.db_service import executeSQL, transaction
+
+PLAYLIST_SIZES = [1000, 5000, 10000]
+RUNS = 3
+
+
+def iterPlaylistJsonOriginal(playlist_id):
+    """
+    The implementation of streamPlaylistFromCache before the json was built by postgres
+    :param playlist_id:
+    :return:
+    """
+    playlist = dbs.getPlaylistsFromDb(convert_to_json=False, playlist_id=playlist_id)
+    playlist_json = playlist.to_json()
+    del playlist_json["tracks"]
+    yield json.dumps(playlist_json)[:-1] + ', "tracks": ['
+    id_set = set()
+    for index, song in enumerate(dbs.iterPlaylistSongsFromDb(playlist_id, convert_to_json=False)):
+        if song.video_id in id_set:
+            song.is_dupe = True
+        id_set.add(song.video_id)
+        yield ("," if index else "") + json.dumps(song.to_json())
+    yield "]}"
+
+
+def createPlaylist(playlist_id, num_songs):
+    songs = createSongs(num_songs)
+    for song in songs:
+        song.video_id = f"{playlist_id}_{song.video_id}"
+        song.set_video_id = f"{playlist_id}_{song.set_video_id}"
+    with transaction():
+        executeSQL("INSERT INTO playlist (id, name) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                   (playlist_id, playlist_id))
+        dbs.persistAllSongData(songs, playlist_id)
+
+
+def deletePlaylist(playlist_id):
+    with transaction():
+        executeSQL("DELETE FROM artist_songs WHERE song_id LIKE %s", (f"{playlist_id}_%",))
+        executeSQL("DELETE FROM songs_in_playlist WHERE playlist_id = %s", (playlist_id,))
+        executeSQL("DELETE FROM song WHERE id LIKE %s", (f"{playlist_id}_%",))
+        executeSQL("DELETE FROM playlist WHERE id = %s", (playlist_id,))
+    deleteSyntheticRows()
+
+
+def measure(json_iter_function, playlist_id):
+    """
+    :return: (fastest run in seconds, peak python memory in MB, the json)
+    """
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        text = "".join(json_iter_function(playlist_id))
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    for _ in json_iter_function(playlist_id):
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak / 1024 / 1024, text
+
+
+def main():
+    initializeBenchmarkDb()
+    print(f"{'tracks':>8} {'implementation':>16} {'seconds':>8} {'peak MB':>8}")
+    for num_songs in PLAYLIST_SIZES:
+        playlist_id = f"PLbench{num_songs}"
+        createPlaylist(playlist_id, num_songs)
+        try:
+            outputs = []
+            for name, func in [("objects", iterPlaylistJsonOriginal), ("postgres", cs.streamPlaylistFromCache)]:
+                seconds, peak_mb, text = measure(func, playlist_id)
+                outputs.append(json.loads(text))
+                print(f"{num_songs:>8} {name:>16} {seconds:>8.3f} {peak_mb:>8.2f}")
+            assert outputs[0] == outputs[1]
+        finally:
+            deletePlaylist(playlist_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Measures the time to get one page of a playlist's songs as json (streamPlaylistFromCache with a limit), compared to
+building the json for the whole playlist. Pages are read with offset, and with afterIndex (the nextAfterIndex of the
+previous page). Needs a database of its own (see bench_db): synthetic playlists are written to it, then
+deleted.
+
+Run from the flask_app directory: python -m benchmark.bench_playlist_pages
+"""
+import time
+
+from benchmark.bench_db import initializeBenchmarkDb
+from benchmark.bench_playlist_json import createPlaylist, deletePlaylist
+from cache import cache_service as cs
+
+PLAYLIST_SIZES = [1000, 10000]
+PAGE_SIZE = 100
+RUNS = 5
+
+
+def measure(json_iter_function):
+    """
+    :return: fastest run in seconds
+    """
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        "".join(json_iter_function())
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    initializeBenchmarkDb()
+    print(f"{'tracks':>8} {'request':>24} {'seconds':>8}")
+    for num_songs in PLAYLIST_SIZES:
+        playlist_id = f"PLpages{num_songs}"
+        createPlaylist(playlist_id, num_songs)
+        try:
+            middle = num_songs // 2
+            requests = [
+                ("whole playlist", lambda: cs.iterPlaylistTracksJsonFromDb(playlist_id)),
+                ("first page", lambda: cs.streamPlaylistFromCache(playlist_id, limit=PAGE_SIZE)),
+                ("middle page (offset)", lambda: cs.streamPlaylistFromCache(playlist_id, middle, PAGE_SIZE)),
+                ("middle page (afterIndex)",
+                 lambda: cs.streamPlaylistFromCache(playlist_id, limit=PAGE_SIZE, after_index=middle)),
+            ]
+            for name, func in requests:
+                print(f"{num_songs:>8} {name:>24} {measure(func):>8.3f}")
+        finally:
+            deletePlaylist(playlist_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""
+Measures the memory used by the model objects for a cached playlist: the Song/Album/Artist/Thumbnail/SongInPlaylist
+objects created by getPlaylistSongsFromDb, and the dicts created by Playlist.to_json. They are compared to the objects
+and json that were created before the models had __slots__ and shared their albums and artists
+(see createOriginalObjects).
+Needs a database of its own (see bench_db): synthetic playlists are written to it, then deleted. Every song is
+also in a second playlist, so each has two memberships.
+
+Run from the flask_app directory: python -m benchmark.bench_song_memory
+"""
+import gc
+import json
+import time
+import tracemalloc
+
+from benchmark.bench_db import initializeBenchmarkDb, deleteSyntheticRows
+from benchmark.synthetic import createSongs
+from db import data_models as dm
+from db import ytm_db_service as dbs
+from db.db_service import executeSQL, transaction
+
+PLAYLIST_SIZES = [1000, 10000]
+MODEL_CLASSES = (dm.Song, dm.Album, dm.Artist, dm.Thumbnail, dm.SongInPlaylist)
+
+
+def createPlaylists(playlist_id, num_songs):
+    songs = createSongs(num_songs)
+    for song in songs:
+        song.video_id = f"{playlist_id}_{song.video_id}"
+        song.set_video_id = f"{playlist_id}_{song.set_video_id}"
+    with transaction():
+        for pid in [playlist_id, f"{playlist_id}_copy"]:
+            executeSQL("INSERT INTO playlist (id, name) VALUES (%s, %s) ON CONFLICT DO NOTHING", (pid, pid))
+        dbs.persistAllSongData(songs, playlist_id)
+        for song in songs:
+            song.set_video_id = f"{song.set_video_id}_copy"
+        dbs.persistAllSongData(songs, f"{playlist_id}_copy")
+
+
+def deletePlaylists(playlist_id):
+    with transaction():
+        executeSQL("DELETE FROM artist_songs WHERE song_id LIKE %s", (f"{playlist_id}_%",))
+        executeSQL("DELETE FROM songs_in_playlist WHERE playlist_id LIKE %s", (f"{playlist_id}%",))
+        executeSQL("DELETE FROM song WHERE id LIKE %s", (f"{playlist_id}_%",))
+        executeSQL("DELETE FROM playlist WHERE id LIKE %s", (f"{playlist_id}%",))
+    deleteSyntheticRows()
+
+
+def withoutSlots(cls):
+    """
+    :return: a copy of a model class that keeps its attributes in a __dict__ instead of __slots__
+    """
+    skip = set(cls.__slots__) | {"__slots__", "__dict__", "__weakref__"}
+    return type(cls.__name__, (), {name: value for name, value in vars(cls).items() if name not in skip})
+
+
+UNSLOTTED_CLASSES = {cls: withoutSlots(cls) for cls in MODEL_CLASSES}
+
+
+def copyObject(obj):
+    """
+    Copy a model object into its unslotted class. Every string is copied, like it is when it's read from a new row
+    :param obj:
+    :return:
+    """
+    copy = object.__new__(UNSLOTTED_CLASSES[type(obj)])
+    for name in type(obj).__slots__:
+        if hasattr(obj, name):
+            value = getattr(obj, name)
+            setattr(copy, name, (value + ".")[:-1] if isinstance(value, str) else value)
+    return copy
+
+
+def createOriginalObjects(songs):
+    """
+    Copy songs into the objects that getPlaylistSongsFromDb created before the models had __slots__.
+    Every row got its own strings, and every song got its own Artist objects. Albums and thumbnails were already
+    shared by the songs that have them.
+    :param songs:
+    :return:
+    """
+    shared = {}
+
+    def copyShared(obj):
+        if obj is None:
+            return None
+        if id(obj) not in shared:
+            copy = shared[id(obj)] = copyObject(obj)
+            if not isinstance(obj, dm.Thumbnail):
+                copy.thumbnail = copyShared(obj.thumbnail)
+        return shared[id(obj)]
+
+    original_songs = []
+    for song in songs:
+        original_song = copyObject(song)
+        original_song.album = copyShared(song.album)
+        original_song.playlists = [copyObject(sip) for sip in song.playlists]
+        original_song.artists = []
+        for artist in song.artists:
+            original_artist = copyObject(artist)
+            original_artist.thumbnail = copyShared(artist.thumbnail)
+            original_song.artists.append(original_artist)
+        original_songs.append(original_song)
+    return original_songs
+
+
+def countModelObjects(songs):
+    """
+    :return: the number of distinct model objects reachable from the songs
+    """
+    seen = set()
+    stack = list(songs)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if hasattr(obj, "playlists"):
+            stack.extend(obj.artists + obj.playlists + ([obj.album] if obj.album else []))
+        elif getattr(obj, "thumbnail", None):
+            stack.append(obj.thumbnail)
+    return len(seen)
+
+
+def countDicts(json_obj, seen=None):
+    """
+    :return: the number of distinct dicts in the json
+    """
+    seen = set() if seen is None else seen
+    if isinstance(json_obj, dict):
+        if id(json_obj) in seen:
+            return 0
+        seen.add(id(json_obj))
+        return 1 + sum(countDicts(v, seen) for v in json_obj.values())
+    if isinstance(json_obj, list):
+        return sum(countDicts(v, seen) for v in json_obj)
+    return 0
+
+
+def measureRetained(func):
+    """
+    :return: (the result of func, seconds, bytes that are still allocated after func returns)
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, seconds, retained
+
+
+def main():
+    initializeBenchmarkDb()
+    print(f"{'tracks':>8} {'models':>9} {'objects':>8} {'bytes/song':>11} {'build s':>8} "
+          f"{'json dicts':>11} {'json bytes/song':>16} {'to_json s':>10}")
+    for num_songs in PLAYLIST_SIZES:
+        playlist_id = f"PLmem{num_songs}"
+        createPlaylists(playlist_id, num_songs)
+        try:
+            # warm up the thumbnail index, so it isn't counted
+            dbs.getPlaylistSongsFromDb(playlist_id)
+            songs, build_seconds, build_bytes = measureRetained(lambda: dbs.getPlaylistSongsFromDb(playlist_id))
+            playlist = dm.Playlist(playlist_id, playlist_id, None, songs, None)
+            # the original songs are copied from the current ones, so their build time isn't measured
+            original_songs, _, original_bytes = measureRetained(lambda: createOriginalObjects(songs))
+            playlist_shell = dm.Playlist(playlist_id, playlist_id, None, [], None, num_songs=num_songs)
+            outputs = []
+            for name, model_songs, model_bytes, seconds, to_json in [
+                # Playlist.to_json before the json of shared albums and artists was reused
+                ("original", original_songs, original_bytes, None,
+                 lambda: {**playlist_shell.to_json(), "tracks": [s.to_json() for s in original_songs]}),
+                ("slots", songs, build_bytes, build_seconds, playlist.to_json),
+            ]:
+                playlist_json, json_seconds, json_bytes = measureRetained(to_json)
+                outputs.append(json.dumps(playlist_json))
+                build = "-" if seconds is None else f"{seconds:.3f}"
+                print(f"{num_songs:>8} {name:>9} {countModelObjects(model_songs):>8} {model_bytes // num_songs:>11} "
+                      f"{build:>8} {countDicts(playlist_json):>11} {json_bytes // num_songs:>16} "
+                      f"{json_seconds:>10.3f}")
+            assert outputs[0] == outputs[1]
+        finally:
+            deletePlaylists(playlist_id)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+A stand-in for the postgres connection pool that counts round trips instead of talking to a database.
+Used by the benchmark scripts to measure how many statements a code path sends to the db.
+"""
+from db import db_service
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.connection = conn
+        self.itersize = 2000
+        self.rows = []
+
+    def execute(self, query, data=None):
+        self.connection.pool.queries.append(query)
+        self.rows = self.connection.pool.responder(query, data)
+
+    def mogrify(self, template, args):
+        return repr(args).encode()
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchmany(self, size=None):
+        rows, self.rows = self.rows[:size or self.itersize], self.rows[size or self.itersize:]
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+
+class FakeConnection:
+    encoding = "UTF8"
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.autocommit = True
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.pool.commits += 1
+
+    def rollback(self):
+        self.pool.rollbacks += 1
+
+
+class FakeConnectionPool:
+    def __init__(self, responder=None):
+        """
+        :param responder: function(query, data) that returns the rows for a query. By default no rows are returned
+        """
+        self.responder = responder if responder else (lambda query, data: [])
+        self.queries = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.checkouts = 0
+
+    def getconn(self):
+        self.checkouts += 1
+        return FakeConnection(self)
+
+    def putconn(self, conn):
+        pass
+
+    def closeall(self):
+        pass
+
+    def reset(self):
+        self.queries = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.checkouts = 0
+
+
+def installFakePool(responder=None) -> FakeConnectionPool:
+    """
+    Replace the db connection pool with a FakeConnectionPool
+    :param responder:
+    :return:
+    """
+    pool = FakeConnectionPool(responder)
+    db_service.db_conn_pool = pool
+    return pool
@@ -0,0 +1,33 @@
+"""Builds synthetic Song objects for the benchmark scripts"""
+# cache_service has to be imported before data_models to avoid a circular import
+from cache import cache_service  # noqa
+from db import data_models as dm
+from util import SONG_THUMBNAIL_SIZE
+
+
+def createSongs(num_songs, num_albums=None, num_artists=None, artists_per_song=2):
+    """
+    Create a list of songs, like the ones returned by the YTM api for a playlist.
+    Albums and artists are shared between songs the same way they are in a real library.
+    :param num_songs:
+    :param num_albums:
+    :param num_artists:
+    :param artists_per_song:
+    :return:
+    """
+    num_albums = num_albums or max(1, num_songs // 10)
+    num_artists = num_artists or max(1, num_songs // 20)
+    songs = []
+    for index in range(num_songs):
+        album_num = index % num_albums
+        thumbnail = dm.Thumbnail(f"https://lh3.googleusercontent.com/album{album_num}=", None, SONG_THUMBNAIL_SIZE,
+                                 False)
+        album = dm.Album(f"MPREb_album{album_num}", f"Album {album_num}", thumbnail)
+        artists = [dm.Artist(f"UC_artist{(index + n) % num_artists}", f"Artist {(index + n) % num_artists}", None)
+                   for n in range(artists_per_song)]
+        song = dm.Song(vid_id=f"video{index}", title=f"Song {index}", artists=artists, length="3:30", explicit=False,
+                       local=False, set_vid_id=f"set{index}", album_id=album.album_id, album_name=album.name,
+                       thumbnail_id=thumbnail.thumbnail_id, is_available=True, index=index)
+        song.album = album
+        songs.append(song)
+    return songs
@@ -1,19 +1,27 @@
 """
 This service determines whether data should be retrieved from the database or the YTM api
 """
+import codecs
+import json
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from enum import Enum
 from typing import List
 
+from cache.memory_cache import MemoryCache
+from cache.single_flight import SingleFlight
 from db import data_models as dm
 from db.data_models import getThumbnailId
-from db.db_service import executeSQLFetchOne, executeSQL, executeSQLFetchAll
+from db.db_service import executeSQLFetchOne, executeSQL, executeSQLFetchAll, transaction, advisoryLock, afterCommit
 from db.listening_history import getHistoryAsPlaylist, persistHistory, \
     getHistoryAsPlaylistShell
 from db import ytm_db_service as ytmdbs
-from db.ytm_db_service import persistAlbum, persistSong
-from log import logMessage
-from util import iterableToDbTuple, SONG_THUMBNAIL_SIZE
+from db.ytm_db_service import persistAlbum, persistArtist, persistSong
+from log import logMessage, logException
+from util import iterableToDbTuple, SONG_THUMBNAIL_SIZE, PLAYLIST_THUMBNAIL_SIZE, LIBRARY_ID
 from ytm_api.ytm_client import getYTMClient, setupYTMClient
 from ytm_api.ytm_service import findDuplicatesAndAddFlag
 
@@ -21,24 +29,96 @@ from ytm_api.ytm_service import findDuplicatesAndAddFlag
 class DataType(Enum):
     """
     Enum for the different types of data I store in the db
-    Contains two values: value and cache_time
+    Contains three values: value, cache_time and stale_while_revalidate
     cache_time is the number of days an item will be cached before it is invalidated
+    stale_while_revalidate: if True, an invalidated item is still returned from the db right away (marked as stale),
+        and it is refreshed from YTM in the background
+    NOT_FOUND entries are items that YTM returned 404 for. They aren't requested from YTM again until their
+        cache_time is over (see CachedData.isNotFound)
     """
-    HISTORY = ("history", .5)
-    PLAYLIST = ("playlist", 1)
-    LIBRARY = ("library", 1)
-    ARTIST = ("artist", 7)
-    SONG = ("song", 30)
-    ALBUM = ("album", 1000)
-    THUMBNAIL = ("thumbnail", 1000)
-
-    def __new__(cls, data_type, cache_time):
+    HISTORY = ("history", .5, False)
+    PLAYLIST = ("playlist", 1, True)
+    LIBRARY = ("library", 1, True)
+    ARTIST = ("artist", 7, False)
+    SONG = ("song", 30, False)
+    ALBUM = ("album", 1000, False)
+    THUMBNAIL = ("thumbnail", 1000, False)
+    NOT_FOUND = ("not_found", 7, False)
+
+    def __new__(cls, data_type, cache_time, stale_while_revalidate):
         entry = object.__new__(cls)
         entry.type = entry._value_ = data_type
         entry.cache_time = cache_time
+        entry.stale_while_revalidate = stale_while_revalidate
         return entry
 
 
+# stale items are refreshed from YTM by these threads (see CachedData.refreshInBackground)
+refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cache_refresh")
+# (data type, data id) of every background refresh that is queued or running
+refreshes_in_progress = set()
+refresh_lock = threading.Lock()
+# concurrent YTM fetches of the same item share one call (see CachedData.getDataFromYTMWrapper)
+ytm_fetches = SingleFlight()
+# number of YTM fetches that weren't made because the item was already known to be 404 (see CachedData.isNotFound)
+not_found_stats = {"avoidedYtmFetches": 0}
+not_found_lock = threading.Lock()
+
+
+# how many seconds an object in the memory cache is used before its data_cache timestamp is checked again.
+# This is how long it can take to notice that another process (ie: update_cache.py) got new data from YTM
+MEMORY_REVALIDATE_SECONDS = 60
+# max total weight of the objects in the memory cache. (see getMemoryWeight)
+MEMORY_CACHE_MAX_WEIGHT = 50000
+
+
+class MemoryEntry:
+    """
+    An object in the memory cache, and the validator it was loaded with (see CachedData.getValidator)
+    """
+
+    def __init__(self, data, validator):
+        self.data = data
+        self.validator = validator
+        self.validated_at = time.monotonic()
+
+
+def getMemoryWeight(entry: MemoryEntry):
+    """
+    The weight of an object in the memory cache: 1, plus the number of songs/albums it contains
+    :param entry:
+    :return:
+    """
+    data = entry.data
+    weight = 1 + len(data) if isinstance(data, list) else 1
+    weight += len(getattr(data, "songs", None) or [])
+    weight += len(getattr(data, "albums", None) or []) + len(getattr(data, "singles", None) or [])
+    return weight
+
+
+memory_cache = MemoryCache(MEMORY_CACHE_MAX_WEIGHT, weigher=getMemoryWeight)
+
+# (thumbnail id, size) -> Thumbnail, so building objects doesn't query the db for every thumbnail.
+# Thumbnails are downloaded by update_cache.py, this is how long it can take to notice that
+THUMBNAIL_INDEX_TTL_SECONDS = 5 * 60
+THUMBNAIL_INDEX_MAX_ENTRIES = 50000
+thumbnail_index = MemoryCache(THUMBNAIL_INDEX_MAX_ENTRIES)
+
+# number of compressed bytes of a playlist snapshot that are decompressed at a time
+SNAPSHOT_CHUNK_SIZE = 64 * 1024
+
+
+def markStale(data):
+    """
+    Flag data that was returned from the db after its cache expired. The flag is included in its json.
+    :param data: a Playlist, or list of Playlists
+    :return:
+    """
+    for item in (data if isinstance(data, list) else [data]):
+        item.is_stale = True
+    return data
+
+
 # noinspection PyTypeChecker
 class CachedData:
     """
@@ -49,14 +129,16 @@ class CachedData:
         # noinspection PyTypeChecker
         self.data_type: DataType = None
         self.additional_params = None
+        # keep objects in the in-process memory cache (in front of the db)
+        self.use_memory_cache = True
+        # only let one thread/process get an item from YTM at a time (see getDataFromYTMWrapper)
+        self.coordinate_fetches = True
 
-    def shouldUseCache(self, item_id):
+    def getCacheTimestamp(self, item_id):
         """
-        Determines if the db should be used to access a given item id, or if we should use the YTM api.
-
+        Get the time when the given item was last retrieved from YTM
         :param item_id:
-        :return: True if we retrieved this data from YTM within the last x days. False otherwise.
-            (where x is determined by the type of data I am retrieving).
+        :return: the timestamp from the data_cache table, or None if the item has never been cached
         """
         select = f"SELECT timestamp " \
                  f"FROM data_cache " \
@@ -64,28 +146,153 @@ class CachedData:
                  f"AND data_type = %s"
         data = item_id, self.data_type.value,
         resp = executeSQLFetchOne(select, data)
-        if not resp:
+        return resp[0] if resp else None
+
+    def getValidator(self, item_id):
+        """
+        Get the values that change whenever the data of an item changes. This is its data_cache timestamp, plus
+        anything that can change the data without it being retrieved from YTM again (see CachedPlaylist).
+        It is used to check objects in the memory cache, and as the ETag of the item's endpoint.
+        :param item_id:
+        :return: a tuple, starting with the data_cache timestamp (None if the item has never been cached)
+        """
+        return self.getCacheTimestamp(item_id),
+
+    def getCacheTimeRemaining(self, cache_timestamp):
+        """
+        :param cache_timestamp: the time the item was last retrieved from YTM
+        :return: the time left until the cached item is invalidated
+        """
+        if cache_timestamp is None:
             # I've never cached this item in the db before, I need to go to use the api
-            return False
+            return timedelta(0)
+        delta = datetime.now() - datetime.fromtimestamp(cache_timestamp)
+        return timedelta(days=self.data_type.cache_time) - delta
 
+    def shouldUseCache(self, item_id):
+        """
+        Determines if the db should be used to access a given item id, or if we should use the YTM api.
+
+        :param item_id:
+        :return: True if we retrieved this data from YTM within the last x days. False otherwise.
+            (where x is determined by the type of data I am retrieving).
+        """
         # check if this data has been in the db for too long and needs to be invalidated
-        delta = datetime.now() - datetime.fromtimestamp(resp[0])
-        return delta < timedelta(days=self.data_type.cache_time)
+        return self.getCacheTimeRemaining(self.getCacheTimestamp(item_id)) > timedelta(0)
+
+    def getMemoryKey(self, data_id, extra_data):
+        extra_data_key = tuple(sorted(extra_data.items())) if extra_data else ()
+        return self.data_type, data_id, extra_data_key
 
-    def updateCache(self, item_id):
+    def getFromMemory(self, memory_key, data_id, validator=None):
+        """
+        Get an object from the memory cache.
+        Every MEMORY_REVALIDATE_SECONDS its validator is checked, in case another process (ie: update_cache.py)
+        changed it.
+        :param memory_key:
+        :param data_id:
+        :param validator: the item's current validator, if the caller already has it. Then it is checked right away
+        :return: the object, or None if it isn't in the memory cache
+        """
+        entry: MemoryEntry = memory_cache.get(memory_key)
+        if not entry:
+            return None
+        if validator is None and time.monotonic() - entry.validated_at > MEMORY_REVALIDATE_SECONDS:
+            validator = self.getValidator(data_id)
+        if validator is not None:
+            if entry.validator is not None and entry.validator != validator:
+                memory_cache.invalidate(memory_key)
+                return None
+            entry.validator = validator
+            entry.validated_at = time.monotonic()
+        return entry.data
+
+    def putInMemory(self, memory_key, data, validator):
+        """
+        Add an object to the memory cache. It expires at the same time as its data_cache entry
+        :param memory_key:
+        :param data:
+        :param validator: the validator the object was loaded with, or None if it was just retrieved from YTM
+        :return:
+        """
+        if not self.use_memory_cache or data is None:
+            return
+        if validator is None:
+            ttl = timedelta(days=self.data_type.cache_time)
+        else:
+            ttl = self.getCacheTimeRemaining(validator[0])
+        memory_cache.put(memory_key, MemoryEntry(data, validator), ttl.total_seconds())
+
+    def updateCache(self, item_id, data_type: DataType = None):
         """
         Set the cache timestamp value for the given data item to datetime.now()
         :param item_id:
+        :param data_type: defaults to the data type of this cache
         :return:
         """
         insert = "INSERT INTO data_cache (data_id, data_type, timestamp) " \
                  "VALUES (%s, %s, %s) " \
                  "ON CONFLICT ON CONSTRAINT unique_id_and_type DO UPDATE " \
                  "SET timestamp = excluded.timestamp "
-        data = item_id, self.data_type.value, datetime.now().timestamp()
+        data = item_id, (data_type or self.data_type).value, datetime.now().timestamp()
         executeSQL(insert, data)
 
-    def getData(self, data_id, ignore_cache, extra_data=None, do_additional_processing=False, get_json=False):
+    def getNotFoundId(self, item_id):
+        """
+        :param item_id:
+        :return: the data_id of the item's NOT_FOUND entry in data_cache (ie: album:MPREb_123)
+        """
+        return f"{self.data_type.value}:{item_id}"
+
+    def getNotFoundIds(self, item_ids):
+        """
+        :param item_ids:
+        :return: the set of item ids that YTM returned 404 for within the last DataType.NOT_FOUND.cache_time days
+        """
+        if not item_ids:
+            return set()
+        not_found_ids = {self.getNotFoundId(item_id): item_id for item_id in item_ids}
+        select = "SELECT data_id " \
+                 "FROM data_cache " \
+                 "WHERE data_id in %s " \
+                 "AND data_type = %s " \
+                 "AND timestamp > %s"
+        not_found_after = datetime.now() - timedelta(days=DataType.NOT_FOUND.cache_time)
+        data = iterableToDbTuple(not_found_ids), DataType.NOT_FOUND.value, not_found_after.timestamp()
+        return {not_found_ids[r[0]] for r in executeSQLFetchAll(select, data)}
+
+    def isNotFound(self, item_id):
+        """
+        :param item_id:
+        :return: True if YTM returned 404 for this item within the last DataType.NOT_FOUND.cache_time days
+        """
+        return item_id in self.getNotFoundIds([item_id])
+
+    def persistNotFound(self, item_id):
+        """
+        Record that YTM returned 404 for an item. Its own data_cache entry is removed, so it isn't read from the db
+        :param item_id:
+        :return:
+        """
+        logMessage(f"404 received for [{self.data_type.value}: {item_id}]. "
+                   f"It won't be requested again for [{DataType.NOT_FOUND.cache_time}] days")
+        with transaction():
+            delete = "DELETE FROM data_cache WHERE data_id = %s AND data_type = %s"
+            executeSQL(delete, (item_id, self.data_type.value))
+            self.updateCache(self.getNotFoundId(item_id), DataType.NOT_FOUND)
+            self.onNotFound(item_id)
+            afterCommit(lambda: invalidateMemoryCache(self.data_type, item_id))
+
+    def onNotFound(self, item_id):
+        """
+        Called (in the same transaction) when YTM returns 404 for an item, to remove it from the db
+        :param item_id:
+        :return:
+        """
+        pass
+
+    def getData(self, data_id, ignore_cache, extra_data=None, do_additional_processing=False, get_json=False,
+                validator=None):
         """
         Get data. Either from the database or YTM.
         We use the api if ignore_cache is true OR the cache for this item has been invalidated.
@@ -95,15 +302,36 @@ class CachedData:
         :param extra_data:
         :param data_id:
         :param ignore_cache:
+        :param validator: the item's current validator, if the caller already has it (see getValidator)
         :return:
         """
-        use_api = ignore_cache or not self.shouldUseCache(data_id)
-        if not self.data_type == DataType.THUMBNAIL:
-            logMessage(f"Getting data for [{self.data_type.value}: {data_id}] from [{'YTM' if use_api else 'DB'}]")
-        if use_api:
-            data = self.getDataFromYTMWrapper(data_id, extra_data)
-        else:
-            data = self.getDataFromDb(data_id, extra_data)
+        memory_key = self.getMemoryKey(data_id, extra_data)
+        data = self.getFromMemory(memory_key, data_id, validator) \
+            if self.use_memory_cache and not ignore_cache else None
+        if data is None:
+            validator = None if ignore_cache else validator or self.getValidator(data_id)
+            cache_timestamp = validator[0] if validator else None
+            use_api = ignore_cache or self.getCacheTimeRemaining(cache_timestamp) <= timedelta(0)
+            if not self.data_type == DataType.THUMBNAIL:
+                logMessage(f"Getting data for [{self.data_type.value}: {data_id}] from [{'YTM' if use_api else 'DB'}]")
+            if not use_api:
+                data = self.getDataFromDb(data_id, extra_data)
+            elif not ignore_cache and cache_timestamp is not None and self.data_type.stale_while_revalidate:
+                # return the stale data from the db now, and get new data from YTM in the background
+                data = self.getDataFromDb(data_id, extra_data)
+                if data is not None:
+                    logMessage(f"Returning stale data for [{self.data_type.value}: {data_id}] while it is refreshed")
+                    markStale(data)
+                    self.refreshInBackground(data_id, extra_data)
+            if use_api and data is None:
+                # or the stale data isn't in the db anymore
+                data = self.getDataFromYTMWrapper(data_id, extra_data)
+                validator = None
+            self.putInMemory(memory_key, data, validator)
+
+        if data is None:
+            # YTM returned 404 for it (see isNotFound)
+            return None
 
         if do_additional_processing:
             data = self.additionalDataProcessing(data)
@@ -118,6 +346,41 @@ class CachedData:
         return self.additionalDataProcessing(data) if do_additional_processing else data
 
     def getDataFromYTMWrapper(self, data_id, extra_data=None):
+        """
+        Get data from YTM, making sure only one fetch for this item runs at a time.
+        Threads in this process that ask for the same item wait for the running fetch and share its result.
+        Other processes (ie: update_cache.py) wait on a postgres advisory lock, and then use the data it persisted.
+        :param extra_data:
+        :param data_id:
+        :return: the data, or None if YTM returned 404 for it (now, or within the NOT_FOUND cache time)
+        """
+        if self.isNotFound(data_id):
+            with not_found_lock:
+                not_found_stats["avoidedYtmFetches"] += 1
+            logMessage(f"[{self.data_type.value}: {data_id}] was not found on YTM recently. Not requesting it again")
+            return None
+        if not self.coordinate_fetches:
+            return self.getDataFromYTMAndUpdateCache(data_id, extra_data)
+        flight_key = self.getMemoryKey(data_id, extra_data)
+        return ytm_fetches.do(flight_key, lambda: self.getDataFromYTMWithLock(data_id, extra_data))
+
+    def getDataFromYTMWithLock(self, data_id, extra_data):
+        """
+        Get data from YTM while holding an advisory lock for this item.
+        If another process got the data from YTM while I was waiting for the lock, it is read from the db instead.
+        The YTM call isn't made inside a transaction, the data is persisted in transactions of its own.
+        :param data_id:
+        :param extra_data:
+        :return:
+        """
+        timestamp_before_lock = self.getCacheTimestamp(data_id)
+        with advisoryLock(f"{self.data_type.value}:{data_id}"):
+            if self.getCacheTimestamp(data_id) != timestamp_before_lock:
+                logMessage(f"[{self.data_type.value}: {data_id}] was just retrieved by another process. Using the db")
+                return self.getDataFromDb(data_id, extra_data if extra_data else {})
+            return self.getDataFromYTMAndUpdateCache(data_id, extra_data)
+
+    def getDataFromYTMAndUpdateCache(self, data_id, extra_data=None):
         """
         Get data from YTM. If there's an authentication error this attempts to re-setup the ytm client.
         Updates the db cache after getting data.
@@ -133,12 +396,41 @@ class CachedData:
             return resp
         except Exception as e:
             # catch generic Exception here because that's what is thrown ...
-            if "403" in str(e) or "has no attribute" in str(e):
+            if "HTTP 404" in str(e):
+                self.persistNotFound(data_id)
+                return None
+            elif "403" in str(e) or "has no attribute" in str(e):
                 setupYTMClient()
                 return self.getDataFromYTM(data_id, extra_data)
             else:
                 raise e
 
+    def refreshInBackground(self, data_id, extra_data):
+        """
+        Get data from YTM on a background thread.
+        If a refresh of this item is already queued or running, this does nothing.
+        :param data_id:
+        :param extra_data:
+        :return:
+        """
+        refresh_key = self.data_type, data_id
+        with refresh_lock:
+            if refresh_key in refreshes_in_progress:
+                return
+            refreshes_in_progress.add(refresh_key)
+        refresh_executor.submit(self.refresh, refresh_key, data_id, extra_data)
+
+    def refresh(self, refresh_key, data_id, extra_data):
+        try:
+            data = self.getDataFromYTMWrapper(data_id, extra_data)
+            self.putInMemory(self.getMemoryKey(data_id, extra_data), data, None)
+            logMessage(f"Done refreshing [{self.data_type.value}: {data_id}] in the background")
+        except Exception as e:
+            logException(e)
+        finally:
+            with refresh_lock:
+                refreshes_in_progress.discard(refresh_key)
+
     @staticmethod
     def additionalDataProcessing(data):
         """
@@ -170,16 +462,30 @@ class CachedLibrary(CachedData):
         super().__init__()
         self.data_type = DataType.LIBRARY
 
+    def getValidator(self, item_id):
+        """
+        The number of songs in a playlist, and its name, can change without the library being retrieved from YTM
+        again. The library's version changes when that happens (see bumpLibraryVersion)
+        :param item_id:
+        :return:
+        """
+        select = "SELECT (SELECT timestamp FROM data_cache WHERE data_id = %s AND data_type = %s), " \
+                 "(SELECT version FROM library_version WHERE id = %s)"
+        data = item_id, self.data_type.value, item_id
+        return executeSQLFetchOne(select, data)
+
     def getDataFromDb(self, data_id, extra_data):
         resp = ytmdbs.getPlaylistsFromDb(convert_to_json=False)
         return resp
 
     def getDataFromYTM(self, data_id, extra_data):
         playlist_list = getYTMClient().get_library_playlists(limit=100)
+        prefetchThumbnails(playlist_list, PLAYLIST_THUMBNAIL_SIZE)
         playlist_objs = [dm.Playlist.from_json(pl) for pl in playlist_list]
         ytmdbs.persistAllPlaylists(playlist_objs)
+        num_songs = ytmdbs.getNumSongsInPlaylists([pl_obj.playlist_id for pl_obj in playlist_objs])
         for pl_obj in playlist_objs:
-            pl_obj.num_songs = ytmdbs.getNumSongsInPlaylist(pl_obj.playlist_id)
+            pl_obj.num_songs = num_songs.get(pl_obj.playlist_id, 0)
         return playlist_objs
 
 
@@ -200,14 +506,28 @@ class CachedPlaylist(CachedData):
         findDuplicatesAndAddFlag(data.songs)
         return data
 
+    def getValidator(self, item_id):
+        """
+        The songs of a playlist can change without it being retrieved from YTM again (ie: when songs are removed here,
+        or when a playlist that shares songs with it is synced). Its version changes when that happens
+        (see bumpPlaylistVersions)
+        :param item_id:
+        :return:
+        """
+        select = "SELECT (SELECT timestamp FROM data_cache WHERE data_id = %s AND data_type = %s), " \
+                 "(SELECT version FROM playlist WHERE id = %s)"
+        data = item_id, self.data_type.value, item_id
+        return executeSQLFetchOne(select, data)
+
     def getDataFromDb(self, data_id, extra_data):
         # get songs from db
         if data_id == "history":
             playlist_obj = getHistoryAsPlaylist(limit=200, use_cache=True, get_json=False)
         else:
-            tracks = ytmdbs.getPlaylistSongsFromDb(data_id, convert_to_json=False)
             playlist_obj: dm.Playlist = ytmdbs.getPlaylistsFromDb(convert_to_json=False, playlist_id=data_id)
-            playlist_obj.songs = tracks
+            if not playlist_obj:
+                return None
+            playlist_obj.songs = ytmdbs.getPlaylistSongsFromDb(data_id, convert_to_json=False)
         return playlist_obj
 
     def getDataFromYTM(self, data_id, extra_data):
@@ -218,52 +538,65 @@ class CachedPlaylist(CachedData):
             resp = getYTMClient().get_playlist(data_id, limit=10000)
             playlist_obj = dm.Playlist.from_json(resp)
         # persist them
-        ytmdbs.persistPlaylistSongs(playlist_obj)
+        playlist_obj.changed = ytmdbs.persistPlaylistSongs(playlist_obj)
         return playlist_obj
 
+    def onNotFound(self, item_id):
+        ytmdbs.deletePlaylistFromDb(item_id, through_ytm=False)
+
 
 class CachedThumbnail(CachedData):
     def __init__(self):
         super().__init__()
         self.data_type = DataType.THUMBNAIL
+        # thumbnail rows are updated by update_cache.py when they are downloaded
+        self.use_memory_cache = False
+        # getDataFromYTM reads from the db, there's no YTM call to coordinate
+        self.coordinate_fetches = False
         self.select_sql = 'SELECT thumbnail_id, downloaded, size, filepath from thumbnail_download ' \
                           'where thumbnail_id = %s'
         self.select_many = self.select_sql.replace("where thumbnail_id =", "where thumbnail_id in")
 
     def getDataFromDb(self, data_id, extra_data):
-        select = self.select_sql
-        size = extra_data.get("size")
-        data = data_id,
-        if size:
-            select += " and size = %s"
-            data += size,
-        result = executeSQLFetchOne(select, data)
-        result_obj = dm.Thumbnail.from_db(result) if result else None
-        # if it isn't in the db: create it
-        if not result_obj:
-            return dm.Thumbnail(data_id, None, size, False)
-        return result_obj
+        return self.getListFromDb([data_id], extra_data)[0]
 
     def getListFromDb(self, data_ids: list, extra_data):
+        """
+        Get thumbnails from the thumbnail index, and get the ones that aren't in it from the db in one query
+        :param data_ids: thumbnail ids
+        :param extra_data: {"size": size} to get a specific size
+        :return: a Thumbnail for each id. Thumbnails that aren't in the db are created (but not persisted)
+        """
         if not data_ids:
             return []
-        select = self.select_many
         size = extra_data.get("size", None)
-        data = iterableToDbTuple(data_ids),
+        thumbnails = {}
+        missing_ids = []
+        for thumbnail_id in dict.fromkeys(data_ids):
+            thumbnail = thumbnail_index.get((thumbnail_id, size))
+            if thumbnail:
+                thumbnails[thumbnail_id] = thumbnail
+            else:
+                missing_ids.append(thumbnail_id)
+        if not missing_ids:
+            return list(thumbnails.values())
+
+        select = self.select_many
+        data = iterableToDbTuple(missing_ids),
         if size:
             select += " and size = %s"
             data += size,
-        result = executeSQLFetchAll(select, data)
-        all_thumbnails = []
-        for r in result:
-            try:
-                data_ids.remove(r[0])
-            except ValueError:
-                pass
-            all_thumbnails.append(dm.Thumbnail.from_db(r))
-        for not_found in data_ids:
-            all_thumbnails.append(dm.Thumbnail(not_found, None, size, False))
-        return all_thumbnails
+        # if no size is given and there's more than one, the largest is used (the last row wins). The same size is
+        # picked when postgres builds the json of a song's artists (see ytm_db_service.SONG_ARTISTS_SQL)
+        select += " order by size"
+        for r in executeSQLFetchAll(select, data):
+            thumbnails[r[0]] = dm.Thumbnail.from_db(r)
+        for thumbnail_id in missing_ids:
+            # if it isn't in the db: create it
+            if thumbnail_id not in thumbnails:
+                thumbnails[thumbnail_id] = dm.Thumbnail(thumbnail_id, None, size, False)
+            thumbnail_index.put((thumbnail_id, size), thumbnails[thumbnail_id], THUMBNAIL_INDEX_TTL_SECONDS)
+        return list(thumbnails.values())
 
     def getDataFromYTM(self, data_id, extra_data):
         return self.getDataFromDb(data_id, extra_data)
@@ -287,24 +620,23 @@ class CachedAlbum(CachedData):
     def getDataFromDb(self, data_id, extra_data):
         data = data_id,
         result = executeSQLFetchOne(self.select_sql, data)
-        return dm.Album.from_db(result)
+        return dm.Album.from_db(result) if result else None
 
     def getDataFromYTM(self, data_id, extra_data):
-        try:
-            album_json = getYTMClient().get_album(data_id)
-        except Exception as e:
-            if "HTTP 404" in str(e):
-                return None
-            raise e
+        album_json = getYTMClient().get_album(data_id)
 
         # TODO what does data look like when an album track has multiple artists
         # TODO next need to get artist data??
         album = dm.Album.from_json(data_id, album_json, thumbnail_size=extra_data.get("size"))
 
-        album_artists = [dm.Artist.from_json(a) for a in album_json.get("artist", [])]
+        # look up the artists that don't have an id all at once, instead of for each song
+        album_artist_jsons = album_json.get("artist", [])
+        track_jsons = album_json.get("tracks", [])
+        dm.resolveArtistIds(dm.getUnresolvedArtistNames([{"artists": album_artist_jsons}] + track_jsons))
+        album_artists = [dm.Artist.from_json(a) for a in album_artist_jsons]
         album_artists_map = {a.name: a for a in album_artists}
 
-        songs = [dm.Song.from_json(s, album_artists=album_artists_map) for s in album_json.get("tracks", [])]
+        songs = [dm.Song.from_json(s, album_artists=album_artists_map) for s in track_jsons]
         album.songs = songs
 
         persistAlbum(album)
@@ -321,22 +653,37 @@ class CachedArtist(CachedData):
     def __init__(self):
         super().__init__()
         self.data_type = DataType.ARTIST
+        self.select_sql = "SELECT id, name, thumbnail_id, description, views, channel_id, subscribers " \
+                          "FROM artist " \
+                          "WHERE id = %s"
+        self.select_albums = "SELECT album_id, is_single " \
+                             "FROM artist_albums " \
+                             "WHERE artist_id = %s " \
+                             "ORDER BY index"
 
     def getDataFromDb(self, data_id, extra_data):
-        return self.getDataFromYTM(data_id, extra_data)
+        data = data_id,
+        result = executeSQLFetchOne(self.select_sql, data)
+        if not result:
+            return None
+        artist = dm.Artist.from_db(result)
+        artist_albums = executeSQLFetchAll(self.select_albums, data)
+        albums = {a.album_id: a for a in getAlbums([album_id for album_id, _ in artist_albums])}
+        artist.albums = [albums[album_id] for album_id, is_single in artist_albums
+                         if not is_single and album_id in albums]
+        artist.singles = [albums[album_id] for album_id, is_single in artist_albums
+                          if is_single and album_id in albums]
+        return artist
 
     @staticmethod
     def getAlbumsFromDbAndMerge(artist: dm.Artist, albums: List[dm.Album], singles: List[dm.Album]):
         album_ids = [a.album_id for a in albums]
         single_ids = [s.album_id for s in singles]
 
-        db_albums = getAlbums(album_ids + single_ids)
-
-        album_merge = [next((dba for dba in db_albums if dba.album_id == a.album_id), None) or a for a in albums]
-        single_merge = [next((dba for dba in db_albums if dba.album_id == s.album_id), None) or s for s in singles]
+        db_albums = {a.album_id: a for a in getAlbums(album_ids + single_ids)}
 
-        artist.albums = album_merge
-        artist.singles = single_merge
+        artist.albums = [db_albums.get(a.album_id, a) for a in albums]
+        artist.singles = [db_albums.get(s.album_id, s) for s in singles]
 
     def getDataFromYTM(self, data_id, extra_data):
         artist = getYTMClient().get_artist(data_id)
@@ -351,10 +698,13 @@ class CachedArtist(CachedData):
         singles = getYTMClient().get_artist_albums(singles_browse_id, singles_params) \
             if singles_browse_id and singles_params else artist.get("singles", {}).get("results", [])
 
-        artist = dm.Artist.from_json(artist)
+        # the artist's page doesn't include its id
+        artist = dm.Artist.from_json({**artist, "id": data_id})
+        prefetchThumbnails(albums + singles, SONG_THUMBNAIL_SIZE)
         albums = [dm.Album.from_json(album_id=None, album_json=a, release_type="ALBUM") for a in albums]
         singles = [dm.Album.from_json(album_id=None, album_json=s, release_type="SINGLE") for s in singles]
         self.getAlbumsFromDbAndMerge(artist, albums, singles)
+        persistArtist(artist)
         return artist
 
 
@@ -383,8 +733,8 @@ artist_cache = CachedArtist()
 history_cache = CachedHistory()
 
 
-def getAllPlaylists(ignore_cache=False, get_json=True):
-    playlists = library_cache.getData("mine", ignore_cache, {}, get_json=get_json)
+def getAllPlaylists(ignore_cache=False, get_json=True, validator=None):
+    playlists = library_cache.getData(LIBRARY_ID, ignore_cache, {}, get_json=get_json, validator=validator)
     history = getHistoryAsPlaylistShell([], get_json=get_json)
     return playlists + [history]
 
@@ -395,23 +745,198 @@ def getHistory(ignore_cache=False, get_json=True):
 
 
 def getPlaylist(playlist_id, ignore_cache=False, get_json=True, find_dupes=True):
-    try:
-        data = playlist_cache.getData(playlist_id, ignore_cache, extra_data=None, do_additional_processing=find_dupes,
-                                      get_json=get_json)
-    except Exception as e:
-        if "404" in str(e):
-            logMessage(f"404 received for playlist {playlist_id} .. DELETING")
-            ytmdbs.deletePlaylistFromDb(playlist_id, through_ytm=False)
-            data = playlist_cache.getData(playlist_id, ignore_cache, extra_data=None,
-                                          do_additional_processing=find_dupes, get_json=get_json)
-        else:
-            raise e
-    return data
+    """
+    :return: the playlist, or None if it doesn't exist on YTM anymore (it's deleted from the db when YTM returns 404)
+    """
+    return playlist_cache.getData(playlist_id, ignore_cache, extra_data=None, do_additional_processing=find_dupes,
+                                  get_json=get_json)
+
+
+def getFreshValidator(cached_data: CachedData, data_id):
+    """
+    :param cached_data: ie: playlist_cache
+    :param data_id:
+    :return: the validator of an item (see CachedData.getValidator), or None if its cache has expired
+    """
+    validator = cached_data.getValidator(data_id)
+    return validator if cached_data.getCacheTimeRemaining(validator[0]) > timedelta(0) else None
+
+
+def streamPlaylistFromCache(playlist_id, offset=0, limit=None, after_index=None, fields=None):
+    """
+    Get a playlist from the db as json text, in pieces. The songs come from the playlist's snapshot (see
+    iterPlaylistTracksJson), so a large playlist is never held in memory all at once, and no Song objects are created.
+    The result is the same as getPlaylist(playlist_id, get_json=True) (including the duplicate flags).
+    If a page is requested, only the songs in that page are selected from the db (see iterPlaylistPageJson).
+    numSongs is always the number of songs in the whole playlist.
+    If fields are given the songs are built by postgres without the snapshot, and only with the requested fields.
+    :param playlist_id:
+    :param offset: number of songs to skip (after after_index)
+    :param limit: max number of songs in the page
+    :param after_index: the nextAfterIndex of the previous page
+    :param fields: the song fields to include (see dm.projectSongJson). None to include all of them
+    :return: a generator of strings
+    """
+    playlist: dm.Playlist = ytmdbs.getPlaylistsFromDb(convert_to_json=False, playlist_id=playlist_id)
+    playlist_json = playlist.to_json()
+    del playlist_json["tracks"]
+    # write everything but the closing brace, then the tracks
+    yield json.dumps(playlist_json)[:-1] + ', "tracks": '
+    if isPageRequest(offset, limit, after_index):
+        yield from iterPlaylistPageJson(playlist_id, offset, limit, after_index, fields)
+    elif fields is not None:
+        yield from iterPlaylistTracksJsonFromDb(playlist_id, fields)
+    else:
+        yield from iterPlaylistTracksJson(playlist_id)
+    yield "}"
+
+
+def isPageRequest(offset, limit, after_index):
+    return bool(offset) or limit is not None or after_index is not None
+
+
+def iterPlaylistTracksJsonFromDb(playlist_id, fields=None):
+    yield "["
+    for count, (song_json, _) in enumerate(ytmdbs.iterPlaylistSongsJsonFromDb(playlist_id, fields=fields)):
+        yield ("," if count else "") + song_json
+    yield "]"
+
+
+def iterPlaylistPageJson(playlist_id, offset, limit, after_index, fields=None):
+    """
+    Get the json list of the songs in one page of a playlist as text, in pieces, followed by the page's
+    nextAfterIndex: the index of the last song in the page, or null if there are no songs after it.
+    :param playlist_id:
+    :param offset:
+    :param limit:
+    :param after_index:
+    :param fields:
+    :return: a generator of strings
+    """
+    yield "["
+    last_index = None
+    # get one extra song, to find out if there's another page
+    songs = ytmdbs.iterPlaylistSongsJsonFromDb(playlist_id, offset, None if limit is None else limit + 1, after_index,
+                                               fields)
+    for count, (song_json, index) in enumerate(songs):
+        if count == limit:
+            songs.close()
+            yield f'], "nextAfterIndex": {last_index}'
+            return
+        yield ("," if count else "") + song_json
+        last_index = index
+    yield '], "nextAfterIndex": null'
+
+
+def getPlaylistPage(playlist_json, offset=0, limit=None, after_index=None):
+    """
+    Get one page of a playlist that's already been created as json (see streamPlaylistFromCache)
+    :param playlist_json:
+    :param offset:
+    :param limit:
+    :param after_index:
+    :return: a copy of the playlist json, with only the songs in the page
+    """
+    tracks = playlist_json["tracks"]
+    if after_index is not None:
+        tracks = [t for t in tracks if t["index"] > after_index]
+    end = None if limit is None else offset + limit
+    page = tracks[offset:end]
+    has_more = end is not None and end < len(tracks)
+    return {**playlist_json, "tracks": page, "nextAfterIndex": page[-1]["index"] if has_more else None}
+
+
+def projectPlaylistJson(playlist_json, fields):
+    """
+    Remove the song fields that weren't requested from a playlist that's already been created as json
+    :param playlist_json:
+    :param fields: see dm.projectSongJson
+    :return: a copy of the playlist json
+    """
+    if fields is None:
+        return playlist_json
+    return {**playlist_json, "tracks": [dm.projectSongJson(t, fields) for t in playlist_json["tracks"]]}
+
+
+def iterPlaylistTracksJson(playlist_id):
+    """
+    Get the json list of a playlist's songs as text, in pieces.
+    It comes from the playlist's snapshot if there is one for the playlist's current version. Otherwise it's built by
+    postgres, and compressed as it's returned to create a new snapshot.
+    :param playlist_id:
+    :return: a generator of strings
+    """
+    version, snapshot = ytmdbs.getPlaylistSnapshot(playlist_id) or (None, None)
+    if snapshot is not None:
+        decompressor = zlib.decompressobj()
+        # a chunk can end in the middle of a character
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for start in range(0, len(snapshot), SNAPSHOT_CHUNK_SIZE):
+            yield decoder.decode(decompressor.decompress(snapshot[start:start + SNAPSHOT_CHUNK_SIZE]))
+        yield decoder.decode(decompressor.flush(), final=True)
+        return
+
+    compressor = zlib.compressobj()
+    compressed = []
+    for piece in iterPlaylistTracksJsonFromDb(playlist_id):
+        compressed.append(compressor.compress(piece.encode()))
+        yield piece
+    compressed.append(compressor.flush())
+    if version is not None:
+        ytmdbs.persistPlaylistSnapshot(playlist_id, version, b"".join(compressed))
+
+
+def refreshPlaylistSnapshot(playlist_id):
+    """
+    Create a new snapshot of a playlist's songs, if the one in the db isn't for the playlist's current version.
+    Call this outside of a transaction: building the json of a large playlist takes a while.
+    :param playlist_id:
+    :return:
+    """
+    # history isn't a playlist in the db
+    if playlist_id == "history":
+        return
+    versions = ytmdbs.getPlaylistSnapshotVersion(playlist_id)
+    if not versions or versions[0] == versions[1]:
+        return
+    for _ in iterPlaylistTracksJson(playlist_id):
+        pass
+
+
+def invalidateMemoryCache(data_type: DataType, data_id=None):
+    """
+    Remove objects from the memory cache
+    :param data_type:
+    :param data_id: if None, every object of the given type is removed
+    :return:
+    """
+    memory_cache.invalidateWhere(lambda key: key[0] == data_type and (data_id is None or key[1] == data_id))
+
+
+def invalidatePlaylistInMemory(playlist_id):
+    """
+    Called when the songs in a playlist change.
+    Every song lists all the playlists it's in, so every playlist in the memory cache is removed (not just this one).
+    The library is removed too because it contains the number of songs in each playlist.
+    :param playlist_id:
+    :return:
+    """
+    invalidateMemoryCache(DataType.PLAYLIST)
+    invalidateMemoryCache(DataType.LIBRARY)
+    if playlist_id == "history":
+        invalidateMemoryCache(DataType.HISTORY)
+
+
+def getMemoryCacheStats():
+    stats = memory_cache.getStats()
+    stats["sharedYtmFetches"] = ytm_fetches.shared
+    stats.update(not_found_stats)
+    return stats
 
 
 def getPlaylistFromCache(playlist_id, get_json=True):
     pl = playlist_cache.getDataFromDb(playlist_id, {})
-    return pl.to_json() if get_json else pl
+    return pl.to_json() if get_json and pl else pl
 
 
 def getListOfThumbnails(thumbnail_ids, size=None):
@@ -422,34 +947,45 @@ def getListOfThumbnails(thumbnail_ids, size=None):
 def getThumbnail(thumbnail_id, ignore_cache=False, size=None):
     if not thumbnail_id:
         return None
-    extra_data = {} if not size else {"size": size}
     thumbnail_id = dm.getThumbnailIdFromUrl(thumbnail_id)
-    return thumbnail_cache.getData(data_id=thumbnail_id, ignore_cache=ignore_cache,
-                                   extra_data=extra_data)
+    if ignore_cache:
+        thumbnail_index.invalidate((thumbnail_id, size))
+    return getListOfThumbnails([thumbnail_id], size)[0]
+
+
+def prefetchThumbnails(json_objs, size=None):
+    """
+    Get the thumbnails of a list of YTM json objects in one query (and put them in the thumbnail index),
+    so creating objects from the json doesn't query the db for each thumbnail
+    :param json_objs:
+    :param size:
+    :return:
+    """
+    thumbnail_ids = [getThumbnailId(j) for j in json_objs]
+    getListOfThumbnails([t for t in thumbnail_ids if t], size)
 
 
-def getAlbum(album_id, ignore_cache=False, get_json=False, size=SONG_THUMBNAIL_SIZE):
+def getAlbum(album_id, ignore_cache=False, get_json=False, size=SONG_THUMBNAIL_SIZE, validator=None, fields=None):
+    """
+    :param fields: the song fields to include in the json (see dm.projectSongJson). None to include all of them
+    """
     extra_data = {"size": size}
-    return album_cache.getData(album_id, ignore_cache, get_json=get_json, extra_data=extra_data)
+    album = album_cache.getData(album_id, ignore_cache, extra_data=extra_data, validator=validator)
+    return album.to_json(fields=fields) if get_json and album else album
 
 
 def getAlbums(album_ids, ignore_cache=False):
     # get album objects
     albums = album_cache.getListFromDb(album_ids, ignore_cache)
 
-    # map thumbnails to their albums
-    thumbnail_id_map = {}
-    for a in albums:
-        thumbnail_id_map[a.thumbnail_id] = a
-
     # get thumbnails, and set them for each album
-    thumbnails: List[dm.Thumbnail] = getListOfThumbnails(list(thumbnail_id_map.keys()))
-    for t in thumbnails:
-        alb = thumbnail_id_map[t.thumbnail_id]
-        alb.thumbnail = t
+    thumbnail_ids = list({a.thumbnail_id for a in albums if a.thumbnail_id})
+    thumbnails = {t.thumbnail_id: t for t in getListOfThumbnails(thumbnail_ids)} if thumbnail_ids else {}
+    for a in albums:
+        a.thumbnail = thumbnails.get(a.thumbnail_id)
 
     return albums
 
 
-def getArtist(artist_id, ignore_cache=False, get_json=False):
-    return artist_cache.getData(artist_id, ignore_cache, get_json=get_json)
+def getArtist(artist_id, ignore_cache=False, get_json=False, validator=None):
+    return artist_cache.getData(artist_id, ignore_cache, get_json=get_json, validator=validator)
@@ -0,0 +1,102 @@
+"""
+Checks YTM's listening history in the background, so plays are saved even if the history playlist is never opened.
+YTM only returns the last ~200 plays, so the history is checked more often while songs are being played.
+"""
+import threading
+import time
+
+from db.listening_history import persistHistoryFromYTM
+from log import logMessage, logException
+from ytm_api.ytm_client import getYTMClient
+
+# the interval between checks is kept between these
+MIN_POLL_SECONDS = 60
+MAX_POLL_SECONDS = 30 * 60
+# check often enough that about this many songs are played between checks. Fewer new plays per check means the
+# estimated play timestamps are closer (see listening_history.estimateListenTimestamps)
+TARGET_PLAYS_PER_POLL = 2
+# weight of the latest check in the play rate. The rest comes from the previous checks
+RATE_SMOOTHING = 0.5
+
+
+def getHistoryFromYTM():
+    return getYTMClient().get_history()
+
+
+class HistoryPoller:
+    """
+    Calls get_history, and persists the new plays with persist_history(history_json, not_before) when the history has
+    changed since the last check. If the history is the same nothing else is done (no Song objects are created, and
+    the db isn't used).
+    The time between checks adapts to the rate new plays are found: it's short while songs are being played, and
+    grows up to MAX_POLL_SECONDS when nothing is played.
+    """
+
+    def __init__(self, get_history=getHistoryFromYTM, persist_history=persistHistoryFromYTM, clock=time.time,
+                 min_interval=MIN_POLL_SECONDS, max_interval=MAX_POLL_SECONDS):
+        self.get_history = get_history
+        self.persist_history = persist_history
+        self.clock = clock
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # the first checks are close together, until the play rate is known
+        self.interval = min_interval
+        # new plays per second
+        self.play_rate = 0
+        # video ids of the history from the last check, and when that check was done
+        self.last_ids = None
+        self.last_poll = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def poll(self):
+        """
+        Check the history once, and update the interval until the next check
+        :return: the number of new plays
+        """
+        now = self.clock()
+        history_json = self.get_history()
+        ids = [item.get("videoId") for item in history_json]
+        if ids == self.last_ids:
+            num_new = 0
+        else:
+            num_new = len(self.persist_history(history_json, self.last_poll))
+            if self.last_ids and num_new == len(ids):
+                logMessage("No overlap with the last history check. Some plays were probably missed")
+        if self.last_poll is not None:
+            self.updateInterval(num_new, now - self.last_poll)
+        self.last_ids = ids
+        self.last_poll = now
+        return num_new
+
+    def updateInterval(self, num_new, elapsed):
+        """
+        :param num_new: the number of new plays found by the last check
+        :param elapsed: seconds between the last two checks
+        :return:
+        """
+        rate = num_new / elapsed if elapsed > 0 else 0
+        self.play_rate = RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.play_rate
+        interval = TARGET_PLAYS_PER_POLL / self.play_rate if self.play_rate > 0 else self.max_interval
+        self.interval = min(self.max_interval, max(self.min_interval, interval))
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                num_new = self.poll()
+                logMessage(f"Found [{num_new}] new plays in history. Checking again in [{round(self.interval)}]s")
+            except Exception as e:
+                logException(e)
+                # back off while YTM is failing
+                self.interval = min(self.max_interval, self.interval * 2)
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="history_poller", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
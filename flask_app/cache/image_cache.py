@@ -0,0 +1,99 @@
+"""
+Creates resized copies of downloaded thumbnails, and stores them on disk so each size is only created once.
+Resized images are content-addressed: they are named after a hash of the original image, so the name (and ETag)
+only changes when the image does.
+"""
+import hashlib
+import os
+import threading
+
+from PIL import Image
+
+from cache.memory_cache import MemoryCache
+from util import SONG_THUMBNAIL_SIZE, PLAYLIST_THUMBNAIL_SIZE, ARTIST_PAGE_THUMBNAIL_SIZE, IMAGE_DIR
+
+RESIZED_IMAGE_DIR = os.path.join(IMAGE_DIR, "resized")
+RESIZED_IMAGE_SIZES = {SONG_THUMBNAIL_SIZE, PLAYLIST_THUMBNAIL_SIZE, ARTIST_PAGE_THUMBNAIL_SIZE}
+
+# (path, mtime) -> sha256 of the file, so originals aren't read and hashed on every request
+DIGEST_CACHE_MAX_ENTRIES = 20000
+DIGEST_CACHE_TTL_SECONDS = 24 * 60 * 60
+digest_cache = MemoryCache(DIGEST_CACHE_MAX_ENTRIES)
+
+
+class ResizedImage:
+    def __init__(self, filepath, etag):
+        self.filepath = filepath
+        self.etag = etag
+
+
+def getImageDigest(filepath):
+    """
+    Get the sha256 of a file
+    :param filepath:
+    :return:
+    """
+    key = filepath, os.path.getmtime(filepath)
+    digest = digest_cache.get(key)
+    if digest:
+        return digest
+    with open(filepath, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    digest_cache.put(key, digest, DIGEST_CACHE_TTL_SECONDS)
+    return digest
+
+
+def getOriginalImagePath(image_name):
+    """
+    :param image_name:
+    :return: the path of a downloaded image, or None if it hasn't been downloaded (or the name is invalid)
+    """
+    if os.path.basename(image_name) != image_name or image_name.startswith("."):
+        return None
+    filepath = os.path.join(IMAGE_DIR, image_name)
+    return filepath if os.path.isfile(filepath) else None
+
+
+def resizeImage(original_path, resized_path, size):
+    """
+    Write a copy of an image that fits in a size x size square. It's written to a temporary file first so
+    a request never sees a partially written image.
+    :param original_path:
+    :param resized_path:
+    :param size:
+    :return:
+    """
+    os.makedirs(os.path.dirname(resized_path), exist_ok=True)
+    temp_path = f"{resized_path}.{threading.get_ident()}.part"
+    with Image.open(original_path) as img:
+        img.thumbnail((size, size), Image.LANCZOS)
+        img.save(temp_path, format="PNG", optimize=True)
+    os.replace(temp_path, resized_path)
+
+
+def getResizedImage(image_name, size):
+    """
+    Get a resized copy of a downloaded image. It's created the first time it is requested.
+    :param image_name: filename of the downloaded image
+    :param size: one of RESIZED_IMAGE_SIZES
+    :return: ResizedImage, or None if the image hasn't been downloaded
+    """
+    original_path = getOriginalImagePath(image_name)
+    if not original_path:
+        return None
+    digest = getImageDigest(original_path)
+    resized_path = os.path.join(RESIZED_IMAGE_DIR, digest[:2], f"{digest}_{size}.png")
+    if not os.path.exists(resized_path):
+        resizeImage(original_path, resized_path, size)
+    return ResizedImage(resized_path, f"{digest}-{size}")
+
+
+def getResizedImageEtag(image_name, size):
+    """
+    Get the ETag a resized image will have, without creating it
+    :param image_name:
+    :param size:
+    :return: the etag, or None if the image hasn't been downloaded
+    """
+    original_path = getOriginalImagePath(image_name)
+    return f"{getImageDigest(original_path)}-{size}" if original_path else None
@@ -0,0 +1,158 @@
+"""
+Downloads thumbnails that are in the thumbnail_download table but haven't been downloaded yet.
+"""
+import binascii
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from db.data_models import Thumbnail
+from db.db_service import executeSQLFetchAll, executeSQLValues
+from db.ytm_db_service import bumpPlaylistVersions
+from log import logMessage, logException
+from util import IMAGE_DIR
+
+# number of images that are downloaded at the same time (this is also the size of the http connection pool)
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT_SECONDS = 30
+# number of downloaded images that are marked as downloaded in the db at once
+DOWNLOAD_UPDATE_BATCH_SIZE = 100
+
+MARK_DOWNLOADED = "UPDATE thumbnail_download AS td " \
+                  "SET filepath = v.filepath, downloaded = true " \
+                  "FROM (VALUES %s) AS v (thumbnail_id, size, filepath) " \
+                  "WHERE td.thumbnail_id = v.thumbnail_id AND td.size = v.size"
+
+
+class DownloadSummary:
+    def __init__(self):
+        self.downloaded = 0
+        # images that were already on disk (from a download that was interrupted before the db was updated)
+        self.already_on_disk = 0
+        self.failed = 0
+        self.num_bytes = 0
+
+    def __str__(self):
+        return f"{self.downloaded} images downloaded ({round(self.num_bytes / 1024 / 1024, 1)} MB), " \
+               f"{self.already_on_disk} already on disk, {self.failed} failed"
+
+
+def getImageFilename(url):
+    """
+    Create the filename an image is saved as
+    to turn the filename back into a url path: binascii.unhexlify
+    :param url:
+    :return:
+    """
+    parsed_path = urlparse(url).path
+    filename = binascii.hexlify(parsed_path.encode()).decode()
+    if len(filename) > 245:
+        filename = filename[:245]
+    return filename + ".png"
+
+
+def createDownloadSession(pool_size):
+    """
+    Create a requests session that keeps connections open and shares them between threads
+    :param pool_size:
+    :return:
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def getThumbnailsToDownload():
+    select = "SELECT thumbnail_id, downloaded, size, filepath FROM thumbnail_download " \
+             "WHERE downloaded=%s"
+    data = False,
+    return [Thumbnail.from_db(r) for r in executeSQLFetchAll(select, data)]
+
+
+def downloadImage(session, thumbnail, image_dir):
+    """
+    Download one thumbnail. It's written to a temporary file first, so an interrupted download never leaves
+    a partial image behind.
+    :param session:
+    :param thumbnail:
+    :param image_dir:
+    :return: (filename, number of bytes downloaded). number of bytes is 0 if the image was already on disk
+    """
+    filename = getImageFilename(thumbnail.url)
+    full_filepath = os.path.join(image_dir, filename)
+    if os.path.exists(full_filepath):
+        return filename, 0
+
+    temp_filepath = full_filepath + ".part"
+    num_bytes = 0
+    try:
+        with session.get(thumbnail.url, stream=True, timeout=DOWNLOAD_TIMEOUT_SECONDS) as response:
+            response.raise_for_status()
+            with open(temp_filepath, 'wb') as img_file:
+                for block in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    img_file.write(block)
+                    num_bytes += len(block)
+        os.replace(temp_filepath, full_filepath)
+    except Exception:
+        # don't leave the partial image in the images directory
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        raise
+    return filename, num_bytes
+
+
+def markImagesDownloaded(downloaded):
+    """
+    :param downloaded: list of (thumbnail_id, size, filename)
+    :return:
+    """
+    if downloaded:
+        executeSQLValues(MARK_DOWNLOADED, downloaded)
+
+
+def downloadImages(image_dir=IMAGE_DIR, num_workers=DOWNLOAD_WORKERS):
+    """
+    Download every thumbnail that hasn't been downloaded yet
+    :param image_dir:
+    :param num_workers:
+    :return: DownloadSummary
+    """
+    thumbnails = getThumbnailsToDownload()
+    logMessage(f"Downloading {len(thumbnails)} images")
+    summary = DownloadSummary()
+    downloaded = []
+    downloaded_ids = set()
+    with createDownloadSession(num_workers) as session, ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(downloadImage, session, t, image_dir): t for t in thumbnails}
+        for future in as_completed(futures):
+            thumbnail = futures[future]
+            try:
+                filename, num_bytes = future.result()
+            except Exception as e:
+                logMessage(f"Failed to download image from {thumbnail.url}")
+                logException(e)
+                summary.failed += 1
+                continue
+            if num_bytes:
+                summary.downloaded += 1
+                summary.num_bytes += num_bytes
+            else:
+                summary.already_on_disk += 1
+            downloaded.append((thumbnail.thumbnail_id, thumbnail.size, filename))
+            downloaded_ids.add(thumbnail.thumbnail_id)
+            if len(downloaded) >= DOWNLOAD_UPDATE_BATCH_SIZE:
+                markImagesDownloaded(downloaded)
+                downloaded = []
+    markImagesDownloaded(downloaded)
+    if downloaded_ids:
+        # the filepath of album and artist thumbnails is part of the json of the playlists their songs are in.
+        # Playlist thumbnails are only in the library, which is bumped too
+        bumpPlaylistVersions(thumbnail_ids=downloaded_ids)
+    logMessage(str(summary))
+    return summary
@@ -0,0 +1,112 @@
+"""
+An in-process cache that sits in front of the db. It holds recently used objects so a cache hit doesn't need to
+query the db and rebuild the objects.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryCache:
+    """
+    A thread safe LRU cache with a time-to-live for every entry.
+    The size of the cache is bounded by weight: every entry has a weight (ie: the number of songs in a playlist) and
+    the least recently used entries are evicted when the total weight is more than max_weight.
+    """
+
+    def __init__(self, max_weight, weigher=None, clock=time.monotonic):
+        """
+        :param max_weight: max total weight of all entries
+        :param weigher: function(value) that returns the weight of a value. Every value weighs 1 by default
+        :param clock: returns the current time in seconds
+        """
+        self.max_weight = max_weight
+        self.weigher = weigher if weigher else (lambda value: 1)
+        self.clock = clock
+        # key -> (value, weight, expiration time). Ordered from least to most recently used
+        self.entries = OrderedDict()
+        self.total_weight = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        Get a value from the cache
+        :param key:
+        :return: the value, or None if it isn't in the cache or has expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[2] <= self.clock():
+                self.removeEntry(key)
+                self.expirations += 1
+                entry = None
+            if not entry:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, ttl):
+        """
+        Add a value to the cache. Evicts the least recently used entries if the cache is full
+        :param key:
+        :param value:
+        :param ttl: number of seconds until the value expires
+        :return:
+        """
+        weight = self.weigher(value)
+        if ttl <= 0 or weight > self.max_weight:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.removeEntry(key)
+            self.entries[key] = (value, weight, self.clock() + ttl)
+            self.total_weight += weight
+            while self.total_weight > self.max_weight:
+                oldest_key = next(iter(self.entries))
+                self.removeEntry(oldest_key)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.removeEntry(key)
+                self.invalidations += 1
+
+    def invalidateWhere(self, predicate):
+        """
+        Remove every entry whose key matches the predicate
+        :param predicate: function(key) that returns True if the entry should be removed
+        :return:
+        """
+        with self.lock:
+            for key in [k for k in self.entries if predicate(k)]:
+                self.removeEntry(key)
+                self.invalidations += 1
+
+    def clear(self):
+        self.invalidateWhere(lambda key: True)
+
+    def removeEntry(self, key):
+        """
+        Remove an entry. The lock must be held when this is called
+        :param key:
+        :return:
+        """
+        value, weight, expiration = self.entries.pop(key)
+        self.total_weight -= weight
+
+    def getStats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "weight": self.total_weight, "maxWeight": self.max_weight,
+                    "hits": self.hits, "misses": self.misses,
+                    "hitRate": self.hits / lookups if lookups else 0,
+                    "evictions": self.evictions, "expirations": self.expirations,
+                    "invalidations": self.invalidations}
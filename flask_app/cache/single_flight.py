@@ -0,0 +1,65 @@
+"""
+Coordinates concurrent calls that do the same work, so the work is only done once
+"""
+import threading
+
+
+class Call:
+    """
+    A call that is in progress. Waiting callers get its result (or exception) when it's done
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Only one call for a given key runs at a time (in this process).
+    Callers that ask for a key while a call for it is running wait for that call to finish, and get the same result.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        # number of callers that waited for another caller's result instead of doing the work themselves
+        self.shared = 0
+
+    def do(self, key, func):
+        """
+        Call func, unless a call for this key is already running. In that case wait for it and return its result
+        :param key:
+        :param func: function with no arguments
+        :return: the result of func
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = Call()
+                self.calls[key] = call
+            else:
+                self.shared += 1
+
+        if not is_leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def isRunning(self, key):
+        with self.lock:
+            return key in self.calls
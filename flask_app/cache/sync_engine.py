@@ -0,0 +1,218 @@
+"""
+Syncs many items (playlists, albums) from YTM with a pool of workers.
+Every worker shares one rate limiter, so the total rate of YTM requests is bounded no matter how many workers there are.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+
+from log import logMessage, logException
+
+
+class SyncStatus(Enum):
+    # the item was retrieved from YTM and something changed
+    FETCHED = "fetched"
+    # nothing changed (or YTM didn't have to be called)
+    UNCHANGED = "unchanged"
+    # YTM returned 404 for the item
+    NOT_FOUND = "not_found"
+    FAILED = "failed"
+
+
+def isThrottled(e):
+    """
+    Check if an exception is YTM telling me to slow down
+    :param e:
+    :return:
+    """
+    # catch generic Exception here because that's what ytmusicapi throws
+    return "429" in str(e)
+
+
+class RateLimiter:
+    """
+    Token bucket. acquire() blocks until a request is allowed.
+    """
+
+    def __init__(self, requests_per_second, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.last_refill = clock()
+        # no tokens are handed out before this time (see pause)
+        self.paused_until = 0
+
+    def refill(self, now):
+        # tokens don't build up while paused, so requests start slowly again after being throttled
+        elapsed = max(0, now - max(self.last_refill, self.paused_until))
+        self.tokens = min(self.burst, self.tokens + elapsed * self.requests_per_second)
+        self.last_refill = now
+
+    def acquire(self):
+        """
+        Wait until a request is allowed, then use up one token
+        :return: how many seconds were spent waiting
+        """
+        waited = 0
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.refill(now)
+                if now < self.paused_until:
+                    wait_time = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                else:
+                    wait_time = (1 - self.tokens) / self.requests_per_second
+            self.sleep(wait_time)
+            waited += wait_time
+
+    def pause(self, seconds):
+        """
+        Stop handing out tokens for the given number of seconds. Called when YTM throttles a request,
+        so every worker backs off, not just the one that was throttled.
+        :param seconds:
+        :return:
+        """
+        with self.lock:
+            now = self.clock()
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = 0
+            self.last_refill = now
+
+
+class SyncResult:
+    def __init__(self, item_id, status, seconds, attempts, error=None):
+        self.item_id = item_id
+        self.status: SyncStatus = status
+        self.seconds = seconds
+        self.attempts = attempts
+        self.error = error
+
+    def to_json(self):
+        return {
+            "id": self.item_id,
+            "status": self.status.value,
+            "seconds": round(self.seconds, 2),
+            "attempts": self.attempts,
+            "error": str(self.error) if self.error else None
+        }
+
+
+class SyncSummary:
+    def __init__(self, name):
+        self.name = name
+        self.results = []
+        self.seconds = 0
+
+    def addSkipped(self, item_ids):
+        """
+        Count items that were skipped because they haven't changed (no YTM calls were made for them)
+        :param item_ids:
+        :return:
+        """
+        self.results.extend(SyncResult(item_id, SyncStatus.UNCHANGED, 0, 0) for item_id in item_ids)
+
+    def getResults(self, status):
+        return [r for r in self.results if r.status == status]
+
+    @property
+    def fetched(self):
+        return len(self.getResults(SyncStatus.FETCHED))
+
+    @property
+    def unchanged(self):
+        return len(self.getResults(SyncStatus.UNCHANGED))
+
+    @property
+    def not_found(self):
+        return len(self.getResults(SyncStatus.NOT_FOUND))
+
+    @property
+    def failed(self):
+        return len(self.getResults(SyncStatus.FAILED))
+
+    def __str__(self):
+        return f"Synced {len(self.results)} {self.name} in {round(self.seconds, 1)}s: {self.fetched} fetched, " \
+               f"{self.unchanged} unchanged, {self.not_found} not found, {self.failed} failed"
+
+    def to_json(self):
+        return {
+            "name": self.name,
+            "seconds": round(self.seconds, 2),
+            "fetched": self.fetched,
+            "unchanged": self.unchanged,
+            "notFound": self.not_found,
+            "failed": self.failed,
+            "results": [r.to_json() for r in self.results]
+        }
+
+
+class SyncEngine:
+    """
+    Runs sync_func for every item with a pool of workers.
+    sync_func(item_id) does the YTM call(s) and persists the data. It returns True if anything changed, or a
+    SyncStatus (ie: NOT_FOUND).
+    Each call waits for the shared rate limiter first. When YTM throttles a call (HTTP 429), every worker is paused
+    and the call is retried.
+    """
+
+    def __init__(self, name, sync_func, rate_limiter, num_workers=4, max_attempts=3, throttle_pause_seconds=30):
+        self.name = name
+        self.sync_func = sync_func
+        self.rate_limiter = rate_limiter
+        self.num_workers = num_workers
+        self.max_attempts = max_attempts
+        self.throttle_pause_seconds = throttle_pause_seconds
+
+    def syncItem(self, item_id):
+        """
+        Sync one item, retrying it if YTM throttles it
+        :param item_id:
+        :return: SyncResult
+        """
+        start = time.time()
+        attempts = 0
+        while True:
+            attempts += 1
+            self.rate_limiter.acquire()
+            try:
+                changed = self.sync_func(item_id)
+                if isinstance(changed, SyncStatus):
+                    status = changed
+                else:
+                    status = SyncStatus.FETCHED if changed else SyncStatus.UNCHANGED
+                result = SyncResult(item_id, status, time.time() - start, attempts)
+                break
+            except Exception as e:
+                if isThrottled(e) and attempts < self.max_attempts:
+                    pause = self.throttle_pause_seconds * attempts
+                    logMessage(f"Throttled syncing [{self.name}: {item_id}] (attempt {attempts}). "
+                               f"Pausing for {pause}s")
+                    self.rate_limiter.pause(pause)
+                    continue
+                logException(e)
+                result = SyncResult(item_id, SyncStatus.FAILED, time.time() - start, attempts, error=e)
+                break
+        logMessage(f"Synced [{self.name}: {item_id}] in {round(result.seconds, 2)}s: {result.status.value}")
+        return result
+
+    def run(self, item_ids):
+        """
+        Sync all the given items
+        :param item_ids:
+        :return: SyncSummary
+        """
+        summary = SyncSummary(self.name)
+        start = time.time()
+        logMessage(f"Syncing {len(item_ids)} {self.name} with {self.num_workers} workers")
+        with ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix=f"sync_{self.name}") as executor:
+            summary.results = list(executor.map(self.syncItem, item_ids))
+        summary.seconds = time.time() - start
+        logMessage(str(summary))
+        return summary
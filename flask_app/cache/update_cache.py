@@ -1,99 +1,113 @@
 """
 This script is run once a day to update library and playlist data.
 """
-import binascii
-import os
-import time
+from datetime import datetime, timedelta
 from smtplib import SMTP
-from urllib.parse import urlparse
 
-import requests
+from cache import image_downloader
+from cache.cache_service import getPlaylist, getAllPlaylists, getHistory, getAlbum, DataType, album_cache
+from cache.sync_engine import SyncEngine, RateLimiter, SyncStatus
+from db import listening_stats
+from db.db_service import executeSQLFetchAll
+from db.ytm_db_service import getUnchangedPlaylistIds
 
-from cache.cache_service import getPlaylist, getAllPlaylists, getHistory, getAlbum
-from db.data_models import Thumbnail
-from db.db_service import executeSQL, executeSQLFetchAll
-
-# to turn a base64 string back into a url: binascii.unhexlify
 from log import logMessage, setupCustomLogger, logException
 # from api.ApiFactory import getYoutubeApi
 
+# number of playlists/albums that are synced at the same time
+SYNC_WORKERS = 4
+# every sync worker shares this limit on YTM requests (this replaces sleeping between each playlist/album)
+YTM_REQUESTS_PER_SECOND = 0.5
+YTM_REQUESTS_BURST = 4
+# playlists that haven't changed (according to their fingerprint) are still fully synced after this many days
+FULL_SYNC_MAX_AGE_DAYS = 7
+ytm_rate_limiter = RateLimiter(YTM_REQUESTS_PER_SECOND, burst=YTM_REQUESTS_BURST)
+
 
 def downloadImages():
-    # find thumbnails to download
-    select = "SELECT thumbnail_id, downloaded, size, filepath FROM thumbnail_download " \
-             "WHERE downloaded=%s"
-    data = False,
-    results = executeSQLFetchAll(select, data)
-    filepath = os.path.expanduser("~/python/playlist_manager/flask_app/images/")
-    logMessage(f"Downloading {len(results)} images")
-    for index, r in enumerate(results):
-        logMessage(f"Getting image #{index}")
-        thumbnail = Thumbnail.from_db(r)
-        parsed_path = urlparse(thumbnail.url).path
-        filename_from_url = binascii.hexlify(parsed_path.encode()).decode()
-        if len(filename_from_url) > 245:
-            filename_from_url = filename_from_url[:245]
-        filename_from_url += ".png"
-        # download to filepath
-        full_filepath = f"{filepath}{filename_from_url}"
-        logMessage(f"Getting image from {thumbnail.url}")
-        logMessage(f"Saving to: {full_filepath}")
-        with open(full_filepath, 'wb') as img_file:
-            response = requests.get(thumbnail.url, stream=True)
-            if not response:
-                logMessage(response)
-                continue
-            else:
-                for block in response.iter_content(1024):
-                    if not block:
-                        logMessage("Done getting image")
-                        break
-                    img_file.write(block)
-
-        update = "UPDATE thumbnail_download " \
-                 "SET filepath = %s, downloaded=true " \
-                 "WHERE thumbnail_id = %s"
-        data = filename_from_url, thumbnail.thumbnail_id
-        executeSQL(update, data)
-        time.sleep(5)
-
-
-def updatePlaylists(playlist_id=None):
+    return image_downloader.downloadImages()
+
+
+def syncPlaylist(playlist_id):
+    """
+    Get a playlist from YTM and persist it
+    :param playlist_id:
+    :return: True if any songs were added/removed/moved, or SyncStatus.NOT_FOUND if YTM returned 404 for it
+    """
+    playlist_obj = getPlaylist(playlist_id, ignore_cache=True, get_json=False)
+    return playlist_obj.changed if playlist_obj else SyncStatus.NOT_FOUND
+
+
+def syncAlbum(album_id):
+    """
+    Get an album from YTM and persist it
+    :param album_id:
+    :return: True (there's no cheap way to tell if an album changed), or SyncStatus.NOT_FOUND if YTM returned 404
+        for it
+    """
+    album = getAlbum(album_id, ignore_cache=True)
+    return True if album else SyncStatus.NOT_FOUND
+
+
+def getExpiredAlbumIds():
+    """
+    Get the ids of albums (that aren't playlists) that haven't been retrieved from YTM within the album cache time.
+    Only albums that were retrieved before, or that have songs in the db, are synced. Albums that are only listed on
+    an artist's page (see persistArtist) aren't, so opening an artist doesn't add their whole discography.
+    :return:
+    """
+    select = "SELECT a.id FROM album a " \
+             "LEFT JOIN data_cache dc ON dc.data_id = a.id AND dc.data_type = %s " \
+             "WHERE a.playlist_id is null and a.id is not null " \
+             "AND (dc.timestamp is null or dc.timestamp < %s) " \
+             "AND (dc.data_id is not null or a.id in (SELECT album_id FROM song))"
+    expired_before = datetime.now() - timedelta(days=DataType.ALBUM.cache_time)
+    data = DataType.ALBUM.value, expired_before.timestamp()
+    return [a[0] for a in executeSQLFetchAll(select, data)]
+
+
+def updatePlaylists(playlist_id=None, num_workers=SYNC_WORKERS):
     if playlist_id:
-        getPlaylist(playlist_id, ignore_cache=True, get_json=False)
-    else:
-        playlists = getAllPlaylists(ignore_cache=True, get_json=False)
-        for p in playlists:
-            playlist_id = p.playlist_id
-            if playlist_id == "LM":
-                continue
-            # p2 = getYoutubeApi().get_playlist_items(playlist_id)
-            # pd = getYoutubeApi().get_playlist_details(playlist_id)
-            # p3 = getYoutubeApi().getYoutubePlaylistFromYoutubeDl(playlist_id)
-            p = getPlaylist(playlist_id, ignore_cache=True)
-            time.sleep(60)
-
-
-def updateAlbums(album_id=None):
-    if not album_id:
-        select = "SELECT id FROM album where playlist_id is null and id is not null"
-        albums = executeSQLFetchAll(select, None)
-        for a in albums:
-            aid = a[0]
-            if "FEmusic_library_privately_owned_release" in aid:
-                # TODO fix ytmusicapi so getAlbum works with local albums
-                continue
-            a = getAlbum(aid)
-            time.sleep(10)
-    else:
-        a = getAlbum(album_id)
-        time.sleep(1)
+        return SyncEngine("playlists", syncPlaylist, ytm_rate_limiter, num_workers=1).run([playlist_id])
+    # this updates the fingerprint of every playlist
+    playlists = getAllPlaylists(ignore_cache=True, get_json=False)
+    # p2 = getYoutubeApi().get_playlist_items(playlist_id)
+    # pd = getYoutubeApi().get_playlist_details(playlist_id)
+    # p3 = getYoutubeApi().getYoutubePlaylistFromYoutubeDl(playlist_id)
+    playlist_ids = [p.playlist_id for p in playlists if p.playlist_id != "LM"]
+
+    # skip playlists whose fingerprint hasn't changed. they still get a full sync every FULL_SYNC_MAX_AGE_DAYS,
+    # because the fingerprint doesn't notice every change (ie: songs being reordered)
+    synced_after = (datetime.now() - timedelta(days=FULL_SYNC_MAX_AGE_DAYS)).timestamp()
+    unchanged_ids = getUnchangedPlaylistIds(synced_after)
+    ids_to_sync = [pid for pid in playlist_ids if pid not in unchanged_ids]
+    logMessage(f"Skipping {len(playlist_ids) - len(ids_to_sync)} playlists that haven't changed")
+
+    summary = SyncEngine("playlists", syncPlaylist, ytm_rate_limiter, num_workers=num_workers).run(ids_to_sync)
+    summary.addSkipped([pid for pid in playlist_ids if pid in unchanged_ids])
+    return summary
+
+
+def updateAlbums(album_id=None, num_workers=SYNC_WORKERS):
+    if album_id:
+        return SyncEngine("albums", syncAlbum, ytm_rate_limiter, num_workers=1).run([album_id])
+    # TODO fix ytmusicapi so getAlbum works with local albums
+    album_ids = [aid for aid in getExpiredAlbumIds() if "FEmusic_library_privately_owned_release" not in aid]
+    # albums that YTM returned 404 for aren't requested again until their NOT_FOUND entry expires
+    not_found_ids = album_cache.getNotFoundIds(album_ids)
+    logMessage(f"Skipping {len(not_found_ids)} albums that weren't found on YTM")
+
+    ids_to_sync = [aid for aid in album_ids if aid not in not_found_ids]
+    summary = SyncEngine("albums", syncAlbum, ytm_rate_limiter, num_workers=num_workers).run(ids_to_sync)
+    summary.addSkipped(list(not_found_ids))
+    return summary
 
 
 def updateData():
     setupCustomLogger("update")
     updatePlaylists()
     updateAlbums()
+    listening_stats.rebuildListeningStatsIfMissing()
     # updateAlbums("FEmusic_library_privately_owned_release_detailb_po_CJL5kb-93sWy9gESDW5vIGNlaWxpbmdzIDMaCWxpbCB3YXluZSINaHR0cCB1cGxvYWRlcg")
     # downloadImages()
 
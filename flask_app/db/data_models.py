@@ -1,4 +1,5 @@
 """Contains classes for Song, Artist, Album, and Playlist"""
+import hashlib
 import json
 import random
 import re
@@ -9,9 +10,10 @@ from typing import List
 from urllib.parse import urlparse
 
 from cache import cache_service as cs
+from cache.memory_cache import MemoryCache
 from db import ytm_db_service as dbs
 from db.db_service import executeSQLFetchAll
-from db.ytm_db_service import updateDictEntry, getArtistId
+from db.ytm_db_service import updateDictEntry
 from log import logMessage
 from util import iterableToDbTuple, PLAYLIST_THUMBNAIL_SIZE, SONG_THUMBNAIL_SIZE, ARTIST_PAGE_THUMBNAIL_SIZE
 
@@ -32,6 +34,52 @@ def generateArtistId():
     return f"generated_{createRandomCode()}"
 
 
+# lowercase artist name -> artist id, for artists that YTM returns without an id (ie: the artists of album tracks)
+ARTIST_ID_CACHE_TTL_SECONDS = 60 * 60
+ARTIST_ID_CACHE_MAX_ENTRIES = 20000
+artist_ids_by_name = MemoryCache(ARTIST_ID_CACHE_MAX_ENTRIES)
+
+
+def resolveArtistIds(names):
+    """
+    Get the ids of artists by name. Names that haven't been resolved recently are looked up in one query.
+    An artist that isn't in the db gets a generated id, which is remembered so every song by that artist gets the
+    same one.
+    :param names:
+    :return: dict of lowercase name -> artist id
+    """
+    artist_ids = {}
+    for key in {n.strip().lower() for n in names if n}:
+        artist_ids[key] = artist_ids_by_name.get(key)
+    missing = [key for key, artist_id in artist_ids.items() if not artist_id]
+    if missing:
+        found = dbs.getArtistIdsByName(missing)
+        for key in missing:
+            artist_ids[key] = found.get(key) or generateArtistId()
+            artist_ids_by_name.put(key, artist_ids[key], ARTIST_ID_CACHE_TTL_SECONDS)
+    return artist_ids
+
+
+def getUnresolvedArtistNames(song_jsons):
+    """
+    Get the names of the artists in a list of YTM song json objects that don't have an id
+    :param song_jsons:
+    :return:
+    """
+    names = set()
+    for song_json in song_jsons:
+        artists = song_json.get("artists") or []
+        if isinstance(artists, str):
+            names.add(artists)
+            continue
+        for a in artists:
+            if isinstance(a, str):
+                names.add(a)
+            elif not a.get("id"):
+                names.add(a.get("name"))
+    return names
+
+
 def getThumbnailIdFromUrl(url: str):
     if not url:
         return url
@@ -52,6 +100,8 @@ def getThumbnailIdFromUrl(url: str):
 
 def createThumbnailUrl(thumbnail_id: str, size: int):
     parsed = urlparse(thumbnail_id)
+    if not size:
+        return thumbnail_id
     if parsed.hostname == "yt3.ggpht.com" or parsed.hostname == "lh3.googleusercontent.com":
         return thumbnail_id + f"s{size}"
     return thumbnail_id
@@ -70,6 +120,8 @@ def getThumbnailId(json_obj, size=None):
 
 
 class Thumbnail:
+    __slots__ = ("thumbnail_id", "filepath", "size", "downloaded", "url")
+
     def __init__(self, thumbnail_id, filepath, size, downloaded):
         self.thumbnail_id = thumbnail_id
         self.filepath = filepath
@@ -110,8 +162,24 @@ def getLastUpdatedString(last_updated):
     return result_str
 
 
+def getPlaylistFingerprint(playlist_json, thumbnail):
+    """
+    Create a cheap fingerprint for a playlist from my library listing (get_library_playlists).
+    It's made from the track count and the thumbnail (YTM generates it from the first songs in the playlist),
+    so it changes when songs are added/removed, or the first songs change.
+    :param playlist_json:
+    :param thumbnail:
+    :return: the fingerprint, or None if the json doesn't have a track count
+    """
+    count = playlist_json.get("count")
+    if count is None:
+        return None
+    thumbnail_id = thumbnail.thumbnail_id if thumbnail else ""
+    return hashlib.sha1(f"{count}:{thumbnail_id}".encode()).hexdigest()
+
+
 class Playlist:
-    def __init__(self, plid, name, thumbnail, songs, last_updated, num_songs=0):
+    def __init__(self, plid, name, thumbnail, songs, last_updated, num_songs=0, ytm_fingerprint=None):
         self.playlist_id = plid
         self.name = name
         self.thumbnail = thumbnail
@@ -121,20 +189,30 @@ class Playlist:
         else:
             self.last_updated = getLastUpdatedString(last_updated)
         self.num_songs = len(songs) if songs else num_songs
+        # True if this came from the db after its cache expired (it is being refreshed from YTM)
+        self.is_stale = False
+        # True if songs were added/removed/moved in the db when this was retrieved from YTM
+        self.changed = False
+        # see getPlaylistFingerprint
+        self.ytm_fingerprint = ytm_fingerprint
 
     def __str__(self):
         return f"{self.name} ({self.playlist_id})"
 
     def to_db(self):
-        return self.playlist_id, self.name, self.thumbnail.thumbnail_id
+        return self.playlist_id, self.name, self.thumbnail.thumbnail_id, self.ytm_fingerprint
 
     @classmethod
     def from_db(cls, db_tuple):
-        plid, name, thumbnail_id, last_updated = db_tuple
+        plid, name, thumbnail_id, last_updated, num_songs, downloaded, size, filepath = db_tuple
         if last_updated:
             last_updated = datetime.fromtimestamp(last_updated)
-        thumbnail = cs.getThumbnail(thumbnail_id, size=PLAYLIST_THUMBNAIL_SIZE)
-        return cls(plid, name, thumbnail, [], last_updated)
+        thumbnail = None
+        if thumbnail_id:
+            # the thumbnail_download columns are null if this thumbnail isn't in the db yet
+            thumbnail = Thumbnail(thumbnail_id, filepath, size, downloaded) if size \
+                else Thumbnail(thumbnail_id, None, PLAYLIST_THUMBNAIL_SIZE, False)
+        return cls(plid, name, thumbnail, [], last_updated, num_songs=num_songs)
 
     @classmethod
     def from_json(cls, playlist_json):
@@ -145,16 +223,22 @@ class Playlist:
         num_songs = playlist_json.get("count")
         songs = getListOfSongObjects(tracks, from_db=False, include_playlists=True, include_index=True, get_json=False)
         return cls(plid=pl_id, name=name, thumbnail=thumbnail, songs=songs, last_updated=datetime.now(),
-                   num_songs=num_songs)
-
-    def to_json(self):
-        playlist_tracks = [s.to_json() for s in self.songs]
+                   num_songs=num_songs, ytm_fingerprint=getPlaylistFingerprint(playlist_json, thumbnail))
+
+    def to_json(self, fields=None):
+        """
+        :param fields: the song fields to include in the tracks (see projectSongJson). None to include all of them
+        :return:
+        """
+        shared_json = {}
+        playlist_tracks = [s.to_json(shared_json, fields) for s in self.songs]
         return {"playlistId": self.playlist_id,
                 "title": self.name,
                 "lastUpdated": self.last_updated,
                 "numSongs": len(self.songs) if self.songs else self.num_songs,
                 "tracks": playlist_tracks,
-                "thumbnail": self.thumbnail.to_json() if self.thumbnail else None}
+                "thumbnail": self.thumbnail.to_json() if self.thumbnail else None,
+                "isStale": self.is_stale}
 
 
 class ReleaseType(Enum):
@@ -180,6 +264,9 @@ class ReleaseType(Enum):
 
 
 class Album:
+    __slots__ = ("album_id", "name", "thumbnail", "playlist_id", "description", "num_tracks", "release_date",
+                 "release_date_timestamp", "duration", "release_type", "thumbnail_id", "year", "songs")
+
     def __init__(self, aid, name, thumbnail: Thumbnail, playlist_id=None, description=None, num_tracks=None,
                  release_date_timestamp=None, duration=None, release_type=None, thumbnail_id=None, year=None,
                  songs=None):
@@ -253,26 +340,32 @@ class Album:
                    num_tracks=num_tracks, release_date_timestamp=rd_timestamp, duration=duration,
                    release_type=rel_type, thumbnail_id=None, year=year)
 
-    def to_json(self, index=None):
+    def to_json(self, index=None, fields=None):
+        """
+        :param index:
+        :param fields: the keys to include in the json of each song (see projectSongJson). None to include all of them
+        :return:
+        """
         the_json = {"id": self.album_id, "title": self.name, "playlist_id": self.playlist_id,
                     "description": self.description, "duration": self.duration,
                     "release_type": self.release_type.value if self.release_type else "", "num_tracks": self.num_tracks,
                     "release_date": self.release_date, "release_year": self.year,
                     "thumbnail": self.thumbnail.to_json() if self.thumbnail else {},
-                    "songs": [s.to_json() for s in self.songs] if self.songs else []}
+                    "songs": [s.to_json(fields=fields) for s in self.songs] if self.songs else []}
         if index:
             the_json["index"] = index
         return the_json
 
 
 class Artist:
+    __slots__ = ("artist_id", "name", "thumbnail", "description", "views", "channel_id", "subscribers", "albums",
+                 "singles")
+
     def __init__(self, aid, name, thumbnail: Thumbnail, description=None, views=None, channel_id=None,
                  subscribers=None):
         self.artist_id = aid
         if not self.artist_id:
-            self.artist_id = dbs.getArtistId(name)
-        if not self.artist_id:
-            self.artist_id = generateArtistId()
+            self.artist_id = resolveArtistIds([name]).get(name.strip().lower()) if name else generateArtistId()
         self.name = name
         self.thumbnail = thumbnail
         self.description = description
@@ -286,10 +379,17 @@ class Artist:
         return self.name
 
     @classmethod
-    def from_db(cls, artist_tuple):
-        artist_id, artist_name, thumbnail_id = artist_tuple
-        thumbnail = cs.getThumbnail(thumbnail_id)
-        return cls(artist_id, artist_name, thumbnail)
+    def from_db(cls, artist_tuple, thumbnail=None):
+        """
+        :param artist_tuple: (id, name, thumbnail_id), optionally followed by
+            (description, views, channel_id, subscribers)
+        :param thumbnail: the Thumbnail for thumbnail_id. It's looked up if it isn't given
+        :return:
+        """
+        artist_id, artist_name, thumbnail_id, *details = artist_tuple
+        if not thumbnail:
+            thumbnail = cs.getThumbnail(thumbnail_id)
+        return cls(artist_id, artist_name, thumbnail, *details)
 
     @classmethod
     def from_json(cls, artist_json):
@@ -327,10 +427,13 @@ class Artist:
 
     def to_db(self):
         thumbnail_id = self.thumbnail.thumbnail_id if self.thumbnail else None
-        return self.artist_id, self.name, thumbnail_id
+        return self.artist_id, self.name, thumbnail_id, self.description, self.views, self.channel_id, \
+               self.subscribers
 
 
 class SongInPlaylist:
+    __slots__ = ("video_id", "set_video_id", "playlist_id", "playlist_name", "index")
+
     def __init__(self, sip_tuple):
         video_id, set_video_id, index, playlist_id, playlist_name = sip_tuple
         self.video_id = video_id
@@ -345,11 +448,89 @@ class SongInPlaylist:
                 "index": self.index}
 
 
-def getListOfSongObjects(source_data, from_db, include_playlists, include_index=False, get_json=False):
+def getSharedJson(obj, shared_json):
+    """
+    Call obj.to_json(), or return the json that was already created for the same object.
+    Albums and artists are shared by many songs, so their json is only created once per playlist.
+    :param obj:
+    :param shared_json: dict of id(obj) -> json. None to always create new json
+    :return:
+    """
+    if shared_json is None:
+        return obj.to_json()
+    key = id(obj)
+    if key not in shared_json:
+        shared_json[key] = obj.to_json()
+    return shared_json[key]
+
+
+# the keys in the json of a Song
+SONG_FIELDS = ("videoId", "setVideoId", "title", "index", "album", "isAvailable", "artists", "isDupe", "playlists",
+               "duration", "isExplicit", "is_local")
+
+
+def projectSongJson(song_json, fields):
+    """
+    Remove the keys that weren't requested from the json of a song. videoId is always kept
+    :param song_json:
+    :param fields: collection of keys from SONG_FIELDS. None to keep every key
+    :return:
+    """
+    if fields is None:
+        return song_json
+    return {key: value for key, value in song_json.items() if key in fields or key == "videoId"}
+
+
+# number of songs created at a time by iterListOfSongObjects
+SONG_CHUNK_SIZE = 1000
+
+
+def iterListOfSongObjects(source_data, from_db, include_playlists, get_json=False, chunk_size=SONG_CHUNK_SIZE,
+                          fields=None):
+    """
+    Same as getListOfSongObjects, but source_data can be any iterable of rows (ie: a generator from
+    executeSQLFetchIter). Rows are processed chunk_size at a time, and the songs from each chunk are yielded before the
+    next chunk is read. So only one chunk of rows and Song objects is in memory at a time.
+    :param source_data:
+    :param from_db:
+    :param include_playlists:
+    :param get_json:
+    :param chunk_size:
+    :param fields: see getListOfSongObjects
+    :return: a generator of Song objects (or json dicts if get_json is True)
+    """
+    chunk = []
+    for row in source_data:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield from getListOfSongObjects(chunk, from_db, include_playlists, get_json=get_json, fields=fields)
+            chunk = []
+    if chunk:
+        yield from getListOfSongObjects(chunk, from_db, include_playlists, get_json=get_json, fields=fields)
+
+
+def getListOfSongObjects(source_data, from_db, include_playlists, include_index=False, get_json=False, fields=None):
+    """
+    Create Song objects from db rows or YTM json, and get their playlists, artists and albums from the db
+    :param source_data:
+    :param from_db:
+    :param include_playlists:
+    :param include_index:
+    :param get_json:
+    :param fields: the song fields that are needed (see SONG_FIELDS). The playlists, artists and albums aren't selected
+    from the db if they aren't in fields. None to get everything
+    :return:
+    """
     if not source_data:
         return []
+    include_playlists = include_playlists and (fields is None or "playlists" in fields)
+    include_artists = from_db and (fields is None or "artists" in fields)
+    include_albums = fields is None or "album" in fields
 
     logMessage(f"Getting list of songs length [{len(source_data)}] {'from db' if from_db else 'from json'}")
+    if not from_db:
+        # look up the artists that don't have an id all at once, instead of for each song
+        resolveArtistIds(getUnresolvedArtistNames(source_data))
     if include_index:
         songs: List[Song] = [Song.from_db(s, index) for index, s in enumerate(source_data)] \
             if from_db else [Song.from_json(s, index) for index, s in enumerate(source_data)]
@@ -357,19 +538,22 @@ def getListOfSongObjects(source_data, from_db, include_playlists, include_index=
         songs: List[Song] = [Song.from_db(s) for s in source_data] if from_db else [Song.from_json(s) for s in
                                                                                     source_data]
     # logMessage("Done creating objects")
-    song_id_to_source_data = {}
     song_ids = set()
     album_ids = set()
     thumbnail_ids = set()
     thumbnail_id_to_song = {}
-    for index, next_song in enumerate(songs):
+    # album values are repeated on every row. Keep one copy of each instead of one per song
+    shared_values = {}
+    for next_song in songs:
+        next_song.album_id = shared_values.setdefault(next_song.album_id, next_song.album_id)
+        next_song.album_name = shared_values.setdefault(next_song.album_name, next_song.album_name)
+        next_song.thumbnail_id = shared_values.setdefault(next_song.thumbnail_id, next_song.thumbnail_id)
         if next_song.album_id:
             album_ids.add(next_song.album_id)
         if next_song.thumbnail_id:
             thumbnail_ids.add(next_song.thumbnail_id)
         updateDictEntry(thumbnail_id_to_song, next_song.thumbnail_id, next_song)
         song_ids.add(next_song.video_id)
-        song_id_to_source_data[next_song.video_id] = source_data[index]
     thumbnail_ids = list(thumbnail_ids)
     # logMessage("Done creating id lists")
 
@@ -380,23 +564,37 @@ def getListOfSongObjects(source_data, from_db, include_playlists, include_index=
         select = "SELECT sip.song_id, sip.set_video_id, sip.index, p.id, p.name " \
                  "FROM songs_in_playlist as sip, playlist as p " \
                  "WHERE sip.playlist_id = p.id " \
-                 "AND sip.song_id in %s"
+                 "AND sip.song_id in %s " \
+                 "ORDER BY sip.playlist_id, sip.index, sip.set_video_id"
         playlists = dbs.executeSQLFetchAll(select, song_id_data)
         for next_playlist in playlists:
-            updateDictEntry(song_playlist_dict, next_playlist[0], SongInPlaylist(next_playlist))
+            video_id, set_video_id, index, playlist_id, playlist_name = next_playlist
+            playlist_id = shared_values.setdefault(playlist_id, playlist_id)
+            playlist_name = shared_values.setdefault(playlist_name, playlist_name)
+            sip = SongInPlaylist((video_id, set_video_id, index, playlist_id, playlist_name))
+            updateDictEntry(song_playlist_dict, video_id, sip)
     # logMessage("Done getting playlists")
 
     song_artist_dict = {}
     # get artist data (only do this if from_db, otherwise artist data is already in the json
-    if from_db:
+    if include_artists:
         select_artists = "SELECT a.id, a.name, a.thumbnail_id, ass.song_id " \
                          "from artist as a, artist_songs as ass " \
                          "WHERE a.id = ass.artist_id " \
-                         "and ass.song_id in %s"
+                         "and ass.song_id in %s " \
+                         "ORDER BY ass.index, ass.artist_id"
         artists = executeSQLFetchAll(select_artists, song_id_data) if song_ids else []
+        # get all the artist thumbnails at once
+        artist_thumbnail_ids = {a[2] for a in artists if a[2]}
+        artist_thumbnails = {t.thumbnail_id: t for t in cs.getListOfThumbnails(list(artist_thumbnail_ids))}
+        # one Artist object per artist, shared by all of their songs
+        artist_objs = {}
         for next_artist in artists:
             song_id = next_artist[3]
-            artist_obj = Artist.from_db(next_artist[:3])
+            artist_obj = artist_objs.get(next_artist[0])
+            if not artist_obj:
+                artist_obj = Artist.from_db(next_artist[:3], artist_thumbnails.get(next_artist[2]))
+                artist_objs[artist_obj.artist_id] = artist_obj
             updateDictEntry(song_artist_dict, song_id, artist_obj)
     # logMessage("Done getting artists")
 
@@ -404,7 +602,7 @@ def getListOfSongObjects(source_data, from_db, include_playlists, include_index=
     album_id_map = {}
     # TODO next make sure this works from db and json
     #  and make sure I'm not doing anything twice (like grabbing thumbnail data)
-    if len(album_ids) > 0:
+    if include_albums and len(album_ids) > 0:
         select_albums = "SELECT id, name, thumbnail_id, playlist_id, description, num_tracks, release_date, " \
                         "release_date_timestamp, duration, release_type, year " \
                         "FROM album " \
@@ -416,13 +614,16 @@ def getListOfSongObjects(source_data, from_db, include_playlists, include_index=
             album_id_map[a.album_id] = a
 
     # get thumbnail data, then create album objects for each song
-    thumbnails: List[Thumbnail] = cs.getListOfThumbnails(thumbnail_ids, size=SONG_THUMBNAIL_SIZE)
+    thumbnails: List[Thumbnail] = cs.getListOfThumbnails(thumbnail_ids, size=SONG_THUMBNAIL_SIZE) \
+        if include_albums else []
     for next_thumb in thumbnails:
         songs_with_thumb: List[Song] = thumbnail_id_to_song[next_thumb.thumbnail_id]
         for s in songs_with_thumb:
             album = album_id_map.get(s.album_id)
             if not album:
                 album = Album(s.album_id, s.album_name, next_thumb)
+                if s.album_id:
+                    album_id_map[s.album_id] = album
             album.thumbnail = next_thumb
             s.album = album
 
@@ -430,14 +631,21 @@ def getListOfSongObjects(source_data, from_db, include_playlists, include_index=
     for next_song in songs:
         if include_playlists:
             next_song.playlists = song_playlist_dict.get(next_song.video_id, [])
-        if from_db:
+        if include_artists:
             next_song.artists = song_artist_dict.get(next_song.video_id, [])
     logMessage("Done")
 
-    return [s.to_json() for s in songs] if get_json else songs
+    if get_json:
+        shared_json = {}
+        return [s.to_json(shared_json, fields) for s in songs]
+    return songs
 
 
 class Song:
+    # there's one Song per row of a playlist, so these don't get a __dict__
+    __slots__ = ("video_id", "set_video_id", "title", "index", "artists", "album", "album_id", "thumbnail_id",
+                 "album_name", "duration", "explicit", "is_available", "local", "playlists", "is_dupe")
+
     def __init__(self, vid_id, title, artists, length, explicit, local, set_vid_id, album_id, album_name, thumbnail_id,
                  is_available, index=None):
         self.video_id = vid_id
@@ -459,14 +667,22 @@ class Song:
     def __str__(self):
         return f"{self.title} by {', '.join([str(a) for a in self.artists])} on {self.album}"
 
-    def to_json(self):
-        album_json = self.album.to_json() if self.album else {}
-        artist_json = [a.to_json() for a in self.artists]
-        playlist_json = [sip.to_json() for sip in self.playlists]
-        return {"videoId": self.video_id, "setVideoId": self.set_video_id, "title": self.title, "index": self.index,
-                "album": album_json, "isAvailable": self.is_available, "artists": artist_json, "isDupe": self.is_dupe,
-                "playlists": playlist_json, "duration": self.duration, "isExplicit": self.explicit,
-                "is_local": self.local}
+    def to_json(self, shared_json=None, fields=None):
+        """
+        :param shared_json: see getSharedJson. Pass the same dict when converting many songs
+        :param fields: the keys to include (see projectSongJson). None to include all of them
+        :return:
+        """
+        album_json = getSharedJson(self.album, shared_json) if self.album and \
+            (fields is None or "album" in fields) else {}
+        artist_json = [getSharedJson(a, shared_json) for a in self.artists] \
+            if fields is None or "artists" in fields else []
+        playlist_json = [sip.to_json() for sip in self.playlists] if fields is None or "playlists" in fields else []
+        song_json = {"videoId": self.video_id, "setVideoId": self.set_video_id, "title": self.title,
+                     "index": self.index, "album": album_json, "isAvailable": self.is_available,
+                     "artists": artist_json, "isDupe": self.is_dupe, "playlists": playlist_json,
+                     "duration": self.duration, "isExplicit": self.explicit, "is_local": self.local}
+        return projectSongJson(song_json, fields)
 
     @classmethod
     def from_db(cls, db_tuple, index=None):
@@ -492,11 +708,7 @@ class Song:
         try:
             artist = song_json.get("artists", [])
             if isinstance(artist, str):
-                artist = album_artists.get(artist)
-                if not artist:
-                    artist_id = getArtistId(artist)
-                    artist = cs.getArtist(artist_id)
-                artist = [artist]
+                artist = [album_artists.get(artist) or Artist(None, artist, None)]
             else:
                 artist = [Artist.from_json(a) for a in artist]
         except TypeError as e:
@@ -1,5 +1,10 @@
 """Contains helper functions for querying the database"""
+import itertools
+import threading
+from contextlib import contextmanager
+
 from psycopg2._psycopg import connection, cursor as psy_curs, OperationalError, InternalError
+from psycopg2.extras import execute_values
 from psycopg2.pool import ThreadedConnectionPool, PoolError
 
 from log import logException
@@ -8,6 +13,17 @@ ytm_cursor: psy_curs = None
 ytm_conn: connection = None
 db_conn_pool: ThreadedConnectionPool = None
 
+# max number of rows sent in a single multi-row statement by executeSQLValues
+VALUES_PAGE_SIZE = 1000
+
+# number of rows a server-side cursor fetches per round trip in executeSQLFetchIter
+DEFAULT_ITERSIZE = 2000
+# used to give every server-side cursor a unique name
+cursor_name_counter = itertools.count()
+
+# holds the connection of the transaction that is open on the current thread (see transaction())
+transaction_state = threading.local()
+
 
 def initializeDbConnectionPool():
     """
@@ -26,15 +42,196 @@ class DbCursor:
             initializeDbConnectionPool()
         self.conn = None
         self.cursor = None
+        self.in_transaction = False
 
     def __enter__(self):
-        self.conn: connection = db_conn_pool.getconn()
-        self.conn.autocommit = True
-        curs: psy_curs = self.conn.cursor()
-        return curs
+        transaction_conn = getTransactionConnection()
+        if transaction_conn:
+            # use the connection that is pinned by transaction(). It is returned to the pool when the transaction ends
+            self.conn = transaction_conn
+            self.in_transaction = True
+        else:
+            self.conn: connection = db_conn_pool.getconn()
+            self.conn.autocommit = True
+        self.cursor: psy_curs = self.conn.cursor()
+        return self.cursor
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        closeConnection(self.conn)
+        if self.in_transaction:
+            self.cursor.close()
+        else:
+            closeConnection(self.conn)
+
+
+def getTransactionConnection():
+    """
+    Get the connection of the transaction that is open on this thread
+    :return: the connection, or None if there's no open transaction
+    """
+    return getattr(transaction_state, "conn", None)
+
+
+def inTransaction():
+    return getTransactionConnection() is not None
+
+
+@contextmanager
+def transaction():
+    """
+    Runs every executeSQL* call made inside this block (on the current thread) on one connection, in one transaction.
+    The transaction is committed when the block ends, and rolled back if an exception is raised.
+    Nested transaction() blocks use a savepoint, so an exception inside them only rolls back the nested block.
+
+    ie:
+        with transaction():
+            executeSQL(delete, data)
+            executeSQL(insert, data)
+    :return:
+    """
+    conn = getTransactionConnection()
+    if conn:
+        yield from savepoint(conn)
+        return
+
+    global db_conn_pool
+    if not db_conn_pool:
+        initializeDbConnectionPool()
+    conn = db_conn_pool.getconn()
+    conn.autocommit = False
+    transaction_state.conn = conn
+    transaction_state.depth = 0
+    before_commit = transaction_state.before_commit = []
+    after_commit = transaction_state.after_commit = []
+    try:
+        yield
+        for func in before_commit:
+            func()
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        transaction_state.conn = None
+        conn.autocommit = True
+        closeConnection(conn)
+    for func in after_commit:
+        func()
+
+
+def savepoint(conn):
+    """
+    Runs a nested transaction() block inside a savepoint
+    :param conn: the connection of the outer transaction
+    :return:
+    """
+    transaction_state.depth += 1
+    name = f"savepoint_{transaction_state.depth}"
+    num_before_commit = len(transaction_state.before_commit)
+    num_after_commit = len(transaction_state.after_commit)
+    with conn.cursor() as curs:
+        curs.execute(f"SAVEPOINT {name}")
+        try:
+            yield
+        except BaseException:
+            curs.execute(f"ROLLBACK TO SAVEPOINT {name}")
+            # the changes they were waiting for won't be committed
+            del transaction_state.before_commit[num_before_commit:]
+            del transaction_state.after_commit[num_after_commit:]
+            raise
+        else:
+            curs.execute(f"RELEASE SAVEPOINT {name}")
+        finally:
+            transaction_state.depth -= 1
+
+
+def beforeCommit(func):
+    """
+    Call func at the end of the current transaction(), right before it commits, ie: to update a row that every
+    transaction changes last, so its lock is only held while committing. It is only called once, even if it was added
+    more than once, and it isn't called if the transaction (or the nested block it was added in) is rolled back.
+    If there's no open transaction it is called right away.
+    :param func: function with no arguments
+    :return:
+    """
+    if not inTransaction():
+        func()
+    elif func not in transaction_state.before_commit:
+        transaction_state.before_commit.append(func)
+
+
+def afterCommit(func):
+    """
+    Call func after the current transaction() commits, ie: to remove objects from the memory cache only once other
+    connections can see the new rows. It isn't called if the transaction (or the nested block it was added in) is
+    rolled back. If there's no open transaction it is called right away.
+    :param func: function with no arguments
+    :return:
+    """
+    if inTransaction():
+        transaction_state.after_commit.append(func)
+    else:
+        func()
+
+
+@contextmanager
+def advisoryLock(lock_name):
+    """
+    Take a postgres advisory lock that is held until this block ends.
+    Blocks while another connection (from this process or any other process) holds a lock with the same name.
+    The lock is held by a connection of its own, so no transaction is kept open while the block runs
+    (ie: while it waits for YTM), and the block's own transactions commit as usual.
+    :param lock_name:
+    :return:
+    """
+    global db_conn_pool
+    if not db_conn_pool:
+        initializeDbConnectionPool()
+    conn = db_conn_pool.getconn()
+    conn.autocommit = True
+    try:
+        with conn.cursor() as curs:
+            curs.execute("SELECT pg_advisory_lock(hashtext(%s))", (lock_name,))
+        try:
+            yield
+        finally:
+            with conn.cursor() as curs:
+                curs.execute("SELECT pg_advisory_unlock(hashtext(%s))", (lock_name,))
+    finally:
+        closeConnection(conn)
+
+
+def lockForTransaction(lock_name):
+    """
+    Take a postgres advisory lock that is held until the current transaction() ends.
+    Blocks while another connection (from this process or any other process) holds a lock with the same name.
+    :param lock_name:
+    :return:
+    """
+    if not inTransaction():
+        raise Exception("lockForTransaction has to be called inside transaction()")
+    select = "SELECT pg_advisory_xact_lock(hashtext(%s))"
+    data = lock_name,
+    executeSQLFetchOne(select, data)
+
+
+def commit(cursor):
+    """
+    Commit the statement that was just executed. Does nothing if a transaction() is open, it commits when it ends.
+    :param cursor:
+    :return:
+    """
+    if not inTransaction():
+        cursor.connection.commit()
+
+
+def shouldRetry(should_retry):
+    """
+    A failed statement is retried once. It can't be retried inside a transaction(), because postgres ignores every
+    statement after an error until the transaction is rolled back.
+    :param should_retry:
+    :return:
+    """
+    return should_retry and not inTransaction()
 
 
 def closeConnection(conn):
@@ -76,11 +273,11 @@ def executeSQL(query, data=None, should_retry=True):
     with DbCursor() as cursor:
         try:
             ret_val = cursor.execute(query, data) if data else cursor.execute(query)
-            cursor.connection.commit()
+            commit(cursor)
             return ret_val
         except (OperationalError, InternalError) as e:
             logException(e)
-            if not should_retry:
+            if not shouldRetry(should_retry):
                 raise e
             return executeSQL(query, data, should_retry=False)
 
@@ -97,11 +294,11 @@ def executeSQLFetchOne(query, data, should_retry=True):
         try:
             cursor.execute(query, data)
             fetch = cursor.fetchone()
-            cursor.connection.commit()
+            commit(cursor)
             return fetch
         except (OperationalError, InternalError) as e:
             logException(e)
-            if not should_retry:
+            if not shouldRetry(should_retry):
                 raise e
             return executeSQLFetchOne(query, data, should_retry=False)
 
@@ -122,10 +319,65 @@ def executeSQLFetchAll(query, data, should_retry=True):
                 cursor.execute(query, data)
 
             fetch = cursor.fetchall()
-            cursor.connection.commit()
+            commit(cursor)
             return fetch
         except (OperationalError, InternalError) as e:
             logException(e)
-            if not should_retry:
+            if not shouldRetry(should_retry):
                 raise e
             return executeSQLFetchAll(query, data, should_retry=False)
+
+
+def executeSQLValues(query, values, template=None, page_size=VALUES_PAGE_SIZE, should_retry=True):
+    """
+    Executes the given sql once for every page of values, using psycopg2's execute_values.
+    The query must contain a single %s placeholder, which is replaced by a multi-row VALUES list.
+    ie: INSERT INTO x (a, b) VALUES %s
+    :param query:
+    :param values: list of tuples, one for each row
+    :param template: optional template for a single row. ie: (%s, %s)
+    :param page_size: max number of rows sent in one statement
+    :param should_retry:
+    :return:
+    """
+    if not values:
+        return
+    with DbCursor() as cursor:
+        try:
+            execute_values(cursor, query, values, template=template, page_size=page_size)
+            commit(cursor)
+        except (OperationalError, InternalError) as e:
+            logException(e)
+            if not shouldRetry(should_retry):
+                raise e
+            executeSQLValues(query, values, template, page_size, should_retry=False)
+
+
+def executeSQLFetchIter(query, data, itersize=DEFAULT_ITERSIZE):
+    """
+    Execute the given query with a server-side (named) cursor, and yield the rows one at a time.
+    Rows are fetched from postgres itersize at a time, so the full result is never held in memory.
+    Named cursors only exist inside a transaction, so the query runs on a connection of its own, in a transaction of
+    its own. It isn't a transaction() block: executeSQL* calls made while the rows are being read run as usual.
+    The connection is returned to the pool when the generator is exhausted, closed or garbage collected.
+    :param query:
+    :param data:
+    :param itersize: number of rows fetched per round trip
+    :return: a generator of rows
+    """
+    global db_conn_pool
+    if not db_conn_pool:
+        initializeDbConnectionPool()
+    conn = db_conn_pool.getconn()
+    conn.autocommit = False
+    try:
+        with conn.cursor(name=f"fetch_iter_{next(cursor_name_counter)}") as cursor:
+            cursor.itersize = itersize
+            cursor.execute(query, data)
+            for row in cursor:
+                yield row
+    finally:
+        # nothing was written, this only ends the transaction
+        conn.rollback()
+        conn.autocommit = True
+        closeConnection(conn)
@@ -1,89 +1,121 @@
 from datetime import datetime, timedelta
 from typing import List
 
-from db.data_models import Song, Playlist
-from db.db_service import executeSQLFetchAll, executeSQL
+from cache import cache_service
+from db.data_models import Song, Playlist, getListOfSongObjects
+from db import listening_stats
+from db.db_service import executeSQLFetchAll, executeSQLValues, transaction, lockForTransaction
 from db.ytm_db_service import getSongsFromDb, persistAllSongData
 from log import logMessage
-from ytm_api.ytm_client import getYTMClient
-from ytm_api.ytm_service import getSongsInHistoryFromYTM, getSongsFromYTM
-
-
-def persistHistoryItem(next_history_item: Song):
-    insert = "INSERT INTO listening_history (song_id) " \
-             "VALUES (%s)"
-    data = next_history_item.video_id,
-    try:
-        executeSQL(insert, data)
-    except Exception as e:
-        if "listening_history_song_id_fkey" in str(e):
-            logMessage(
-                f"Song doesn't exist in db. Getting data from YTM for song [{next_history_item.title}: {next_history_item.video_id}]")
-            # get the song data from YTM and insert into song table
-            song = getSongsFromYTM(next_history_item.video_id)
-            persistAllSongData([song], None)
-            executeSQL(insert, data)
-
-
-def persistHistory(history_items: List[Song]):
-    # find which section of the history has already been persisted
-    # new_history = findHistoryNotYetInDb(history_items)
-
-    # noinspection SqlWithoutWhere
-    delete = "DELETE FROM listening_history"
-    executeSQL(delete, None)
-    for next_history_item in history_items:
-        persistHistoryItem(next_history_item)
-
-
-# def findHistoryNotYetInDb(history_items: List[Song]):
-#     """
-#     YTM returns the 200 most recently listened songs. This method finds the portion of that list that
-#     is not already in the database. (Once it finds 5 songs in a row that are already in the listen_history table it stops looking)
-#     :param history_items:
-#     :return:
-#     """
-#     existing_history = getSongsInHistoryFromDb(limit=10, get_json=False)
-#     # reverse both lists, try to find a 3 song streak of matchings songs from the beginning to the end.
-#     # This is because if you listen to a song twice it will be removed its existing spot in history and put at the top of the list
-#     # so if we looked for matches starting at the beginning we could miss some of the history
-#     existing_history = [r for r in reversed(existing_history)]
-#     history_items = [r for r in reversed(history_items)]
-#
-#     if not existing_history:
-#         return history_items
-#
-#     end_match_streak_index = 200
-#     match_streak_goal = 3
-#     match_streak = 0
-#     old_match_index = None
-#     match_index = None
-#     for existing_history_item in existing_history:
-#         print(f"Next song: {existing_history_item.title}")
-#         match_in_new = next((song_and_index
-#                              for song_and_index in enumerate(history_items)
-#                              if song_and_index[1].video_id == existing_history_item.video_id), None)
-#         if match_in_new:
-#             match_index, song = match_in_new
-#             print(f"Found match: [{existing_history_item.title}]. index: {match_index}. Streak: [{match_streak+1}]")
-#             if not old_match_index:
-#                 match_streak += 1
-#                 old_match_index = match_index
-#                 continue
-#             elif match_index and match_index == old_match_index + 1:
-#                 match_streak += 1
-#                 old_match_index = match_index
-#                 continue
-#         print(f"Streak broken. Old index: [{old_match_index}, new index: [{match_index}]")
-#         if match_streak >= match_streak_goal:
-#             print(f"This streak is long enough. Streak: {match_streak}. End index: {match_index}")
-#             # end_match_streak_index = old_match_index
-#             break
-#         match_streak = 0
-#
-#     new_history = history_items[old_match_index:]
-#     # new_history = [r for r in reversed(new_history)]
-#     return new_history
+from util import iterableToDbTuple
+from ytm_api.ytm_service import getSongsInHistoryFromYTM
+
+
+# number of songs in a row that have to match the stored history to find where the new plays end
+MATCH_STREAK_GOAL = 3
+
+INSERT_HISTORY = "INSERT INTO listening_history (song_id, listen_timestamp) VALUES %s"
+
+
+def persistHistory(history_items: List[Song], not_before=None):
+    """
+    Add the songs that were played since the last time history was retrieved from YTM to the listening_history table.
+    Old plays are never deleted, so the table keeps growing past the 200 songs that YTM returns.
+    :param history_items: the history from YTM (most recent first)
+    :param not_before: timestamp that the new plays are known to be after (ie: when the history was last checked)
+    :return: the new plays (most recent first)
+    """
+    with transaction():
+        # only one refresh at a time, otherwise both could append the same plays
+        lockForTransaction("listening_history")
+        select = "SELECT song_id, listen_timestamp FROM listening_history ORDER BY listen_order DESC LIMIT %s"
+        data = len(history_items) * 2 + MATCH_STREAK_GOAL,
+        existing_history = executeSQLFetchAll(select, data)
+        new_history = findHistoryNotYetInDb(history_items, [song_id for song_id, _ in existing_history])
+        if new_history:
+            persistMissingSongs(new_history)
+            known_timestamps = [existing_history[0][1] if existing_history else None, not_before]
+            last_timestamp = max((t for t in known_timestamps if t is not None), default=None)
+            timestamps = estimateListenTimestamps(new_history, last_timestamp, int(datetime.now().timestamp()))
+            # insert the oldest play first, so listen_order goes up with time
+            values = [(song.video_id, timestamp) for song, timestamp in zip(new_history, timestamps)]
+            executeSQLValues(INSERT_HISTORY, list(reversed(values)))
+            listening_stats.persistPlays(list(zip(new_history, timestamps)))
+    logMessage(f"Added [{len(new_history)}] new songs to the listening history")
+    cache_service.invalidatePlaylistInMemory("history")
+    return new_history
+
+
+def persistHistoryFromYTM(history_json, not_before=None):
+    """
+    Same as persistHistory, for the history json from YTM (getYTMClient().get_history())
+    :param history_json:
+    :param not_before:
+    :return: the new plays (most recent first)
+    """
+    history_items = getListOfSongObjects(history_json, from_db=False, include_playlists=False, include_index=True)
+    return persistHistory(history_items, not_before)
+
+
+def persistMissingSongs(songs: List[Song]):
+    """
+    Persist the songs that aren't in the song table yet. The history from YTM has all of the song data, so YTM
+    doesn't have to be called for each of them.
+    :param songs:
+    :return:
+    """
+    select = "SELECT id FROM song WHERE id in %s"
+    data = iterableToDbTuple({song.video_id for song in songs}),
+    existing_ids = {row[0] for row in executeSQLFetchAll(select, data)}
+    missing_songs = {song.video_id: song for song in songs if song.video_id not in existing_ids}
+    if missing_songs:
+        persistAllSongData(list(missing_songs.values()), None)
+
+
+def findHistoryNotYetInDb(history_items: List[Song], existing_history: List[str]):
+    """
+    YTM returns the 200 most recently listened songs. This method finds the portion of that list that
+    is not already in the database.
+    When a song is listened to again YTM removes it from its existing spot in history and puts it at the top of the
+    list. So after the new plays, the rest of the history from YTM is the same as the stored history without the songs
+    that were played again. The new plays end at the first song where MATCH_STREAK_GOAL songs in a row match.
+    If nothing matches, (more than 200 songs were played, or the table is empty) every song is new.
+    :param history_items: the history from YTM (most recent first)
+    :param existing_history: the song ids of the most recent plays in the db (most recent first)
+    :return: the songs that were played since the history was last persisted (most recent first)
+    """
+    # YTM only lists each song once, at its most recent play
+    latest_plays = list(dict.fromkeys(existing_history))
+    new_ids = set()
+    for num_new, history_item in enumerate(history_items):
+        expected = [song_id for song_id in latest_plays if song_id not in new_ids][:MATCH_STREAK_GOAL]
+        actual = [song.video_id for song in history_items[num_new:num_new + len(expected)]]
+        if expected and actual == expected[:len(actual)]:
+            return history_items[:num_new]
+        new_ids.add(history_item.video_id)
+    return history_items
+
+
+def estimateListenTimestamps(new_history: List[Song], last_timestamp, now):
+    """
+    YTM doesn't say when a song was played. Assume the new plays were listened to back to back, ending now, but not
+    before the last play that's already in the db. The estimates are only stored to the minute.
+    :param new_history: the new plays (most recent first)
+    :param last_timestamp: listen_timestamp of the most recent play in the db (or the earliest time the new plays could
+    have happened). None if there isn't one
+    :param now:
+    :return: a timestamp for each play in new_history
+    """
+    timestamps = []
+    timestamp = now
+    if last_timestamp is not None:
+        last_timestamp -= last_timestamp % 60
+    for song in new_history:
+        minute = timestamp - timestamp % 60
+        timestamps.append(minute if last_timestamp is None else max(minute, last_timestamp))
+        timestamp -= listening_stats.getSongSeconds(song)
+    return timestamps
+
 
 def getHistoryAsPlaylistShell(tracks, get_json):
     pl_json = {"playlistId": "history", "title": "History", "tracks": tracks, "count": len(tracks)}
@@ -99,18 +131,23 @@ def getHistoryAsPlaylist(limit=None, use_cache=False, get_json=True):
 
 
 def getSongsInHistoryFromDb(limit=None, get_json=True):
-    select = "SELECT song_id, listen_timestamp, listen_order " \
+    """
+    Get the most recent plays from the listening_history table
+    :param limit:
+    :param get_json:
+    :return: a song for each play (most recent first). A song that was played more than once is listed each time
+    """
+    select = "SELECT song_id " \
              "FROM listening_history " \
-             "ORDER BY listen_order "
+             "ORDER BY listen_order DESC "
+    data = None
     if limit:
-        select += f"LIMIT {limit} "
-    results = executeSQLFetchAll(select, None)
-    song_ids = [history[0] for history in results]
-    song_id_indices = {history[0]: history[2] for history in results}
-    # TODO does this still work if the same song is in history twice
-    songs = getSongsFromDb(song_id=song_ids, playlist_id=None, include_song_playlists=True, get_json=get_json)
-    if get_json:
-        sorted_songs = sorted(songs, key=lambda x: song_id_indices[x["videoId"]])
-    else:
-        sorted_songs = sorted(songs, key=lambda x: song_id_indices[x.video_id])
-    return sorted_songs
+        select += "LIMIT %s "
+        data = limit,
+    song_ids = [history[0] for history in executeSQLFetchAll(select, data)]
+    if not song_ids:
+        return []
+    songs = getSongsFromDb(song_id=list(set(song_ids)), playlist_id=None, include_song_playlists=True,
+                           get_json=get_json)
+    songs_by_id = {song["videoId"] if get_json else song.video_id: song for song in songs}
+    return [songs_by_id[song_id] for song_id in song_ids if song_id in songs_by_id]
@@ -0,0 +1,160 @@
+"""Play counts and listening time for each day, week and month of the listening history"""
+from datetime import datetime, date, timedelta
+from itertools import islice
+from typing import List, Tuple
+
+from db.data_models import Song
+from db.db_service import executeSQLFetchAll, executeSQLFetchOne, executeSQLValues, executeSQL, transaction, \
+    lockForTransaction, executeSQLFetchIter
+from db.ytm_db_service import getSongsFromDb
+from log import logMessage
+
+PERIODS = ("day", "week", "month")
+# used if a song's length is unknown
+DEFAULT_SONG_SECONDS = 210
+# number of songs/artists/albums returned for a period by default
+DEFAULT_TOP_LIMIT = 10
+# number of history rows that are rolled up at a time by rebuildListeningStats
+REBUILD_CHUNK_SIZE = 5000
+
+UPSERT_STATS = "INSERT INTO listening_stats (period, period_start, item_type, item_id, plays, seconds) " \
+               "VALUES %s " \
+               "ON CONFLICT (period, period_start, item_type, item_id) DO UPDATE " \
+               "SET plays = listening_stats.plays + EXCLUDED.plays, " \
+               "seconds = listening_stats.seconds + EXCLUDED.seconds"
+
+# the top songs, artists and albums of one period, and its total. Names come from the song/artist/album tables
+# noinspection SqlResolve
+SELECT_TOP_STATS = \
+    "SELECT ls.item_type, ls.item_id, coalesce(s.name, a.name, alb.name), ls.plays, ls.seconds " \
+    "FROM (SELECT item_type, item_id, plays, seconds, " \
+    "  row_number() OVER (PARTITION BY item_type ORDER BY plays DESC, seconds DESC, item_id) AS rank " \
+    "  FROM listening_stats WHERE period = %(period)s AND period_start = %(period_start)s) AS ls " \
+    "LEFT JOIN song AS s ON ls.item_type = 'song' AND s.id = ls.item_id " \
+    "LEFT JOIN artist AS a ON ls.item_type = 'artist' AND a.id = ls.item_id " \
+    "LEFT JOIN album AS alb ON ls.item_type = 'album' AND alb.id = ls.item_id " \
+    "WHERE ls.rank <= %(limit)s " \
+    "ORDER BY ls.item_type, ls.rank"
+
+
+def getSongSeconds(song: Song):
+    """
+    :param song:
+    :return: the length of the song in seconds (its duration is a string like 3:30)
+    """
+    try:
+        seconds = 0
+        for part in song.duration.split(":"):
+            seconds = seconds * 60 + int(part)
+        return seconds
+    except (AttributeError, ValueError):
+        return DEFAULT_SONG_SECONDS
+
+
+def getPeriodStart(period, day: date):
+    """
+    :param period: day, week or month
+    :param day:
+    :return: the first day of the period that day is in (weeks start on monday)
+    """
+    if period == "day":
+        return day
+    if period == "week":
+        return day - timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    raise ValueError(f"Unknown period [{period}]. Valid periods are {list(PERIODS)}")
+
+
+def rollupPlays(plays: List[Tuple[Song, int]]):
+    """
+    Add up the plays and seconds listened for every period that the plays are in, for each song, artist and album.
+    :param plays: (song, listen_timestamp) for each play. The song's artists and album_id are used
+    :return: dict of (period, period_start, item_type, item_id) -> [plays, seconds]
+    """
+    stats = {}
+    for song, listen_timestamp in plays:
+        seconds = getSongSeconds(song)
+        day = datetime.fromtimestamp(listen_timestamp).date()
+        items = [("song", song.video_id), ("total", "")]
+        items += [("artist", artist_id) for artist_id in dict.fromkeys(a.artist_id for a in song.artists) if artist_id]
+        if song.album_id:
+            items.append(("album", song.album_id))
+        for period in PERIODS:
+            period_start = getPeriodStart(period, day)
+            for item_type, item_id in items:
+                totals = stats.setdefault((period, period_start, item_type, item_id), [0, 0])
+                totals[0] += 1
+                totals[1] += seconds
+    return stats
+
+
+def persistPlays(plays: List[Tuple[Song, int]]):
+    """
+    Add new plays to the listening_stats rollup. Call this in the same transaction that adds them to
+    listening_history, so both tables always agree.
+    :param plays: see rollupPlays
+    :return:
+    """
+    values = [key + tuple(totals) for key, totals in rollupPlays(plays).items()]
+    executeSQLValues(UPSERT_STATS, values)
+
+
+def rebuildListeningStats():
+    """
+    Recreate listening_stats from every row in listening_history (ie: for plays from before the rollup existed)
+    :return:
+    """
+    with transaction():
+        # the history can't be appended to while this runs
+        lockForTransaction("listening_history")
+        # noinspection SqlWithoutWhere
+        executeSQL("DELETE FROM listening_stats", None)
+        select = "SELECT song_id, listen_timestamp FROM listening_history " \
+                 "WHERE listen_timestamp IS NOT NULL ORDER BY listen_order"
+        # the history is streamed, so only one chunk of it is in memory at a time
+        history = executeSQLFetchIter(select, None, itersize=REBUILD_CHUNK_SIZE)
+        num_plays = 0
+        while True:
+            chunk = list(islice(history, REBUILD_CHUNK_SIZE))
+            if not chunk:
+                break
+            songs = getSongsFromDb(song_id=list({song_id for song_id, _ in chunk}), playlist_id=None,
+                                   include_song_playlists=False, fields=["artists"])
+            songs_by_id = {song.video_id: song for song in songs}
+            persistPlays([(songs_by_id[song_id], timestamp) for song_id, timestamp in chunk if song_id in songs_by_id])
+            num_plays += len(chunk)
+    logMessage(f"Rebuilt listening stats from [{num_plays}] plays")
+
+
+def rebuildListeningStatsIfMissing():
+    """
+    Rebuild listening_stats if there's history, but no stats for it
+    :return:
+    """
+    select = "SELECT EXISTS (SELECT 1 FROM listening_history WHERE listen_timestamp IS NOT NULL), " \
+             "EXISTS (SELECT 1 FROM listening_stats)"
+    has_history, has_stats = executeSQLFetchOne(select, None)
+    if has_history and not has_stats:
+        rebuildListeningStats()
+
+
+def getListeningStats(period, period_start: date = None, limit=DEFAULT_TOP_LIMIT):
+    """
+    Get the number of plays and time listened in a period, and its most played songs, artists and albums.
+    Only reads the rows of listening_stats for that period, so it doesn't get slower as the history grows.
+    :param period: day, week or month
+    :param period_start: any day in the period. Defaults to the current period
+    :param limit: max number of songs/artists/albums
+    :return:
+    """
+    period_start = getPeriodStart(period, period_start or date.today())
+    data = {"period": period, "period_start": period_start, "limit": limit}
+    stats = {"period": period, "start": period_start.isoformat(), "plays": 0, "seconds": 0,
+             "songs": [], "artists": [], "albums": []}
+    for item_type, item_id, name, plays, seconds in executeSQLFetchAll(SELECT_TOP_STATS, data):
+        if item_type == "total":
+            stats["plays"], stats["seconds"] = plays, seconds
+        else:
+            stats[f"{item_type}s"].append({"id": item_id, "name": name, "plays": plays, "seconds": seconds})
+    return stats
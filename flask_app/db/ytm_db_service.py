@@ -4,65 +4,165 @@ from typing import List
 
 from cache import cache_service
 from db import data_models as dm
-from db.db_service import executeSQL, executeSQLFetchAll, executeSQLFetchOne
+from db.db_service import executeSQL, executeSQLFetchAll, executeSQLFetchOne, executeSQLValues, transaction, \
+    executeSQLFetchIter, DEFAULT_ITERSIZE, afterCommit, beforeCommit
 from log import logException, logMessage
-from util import iterableToDbTuple
+from util import iterableToDbTuple, PLAYLIST_THUMBNAIL_SIZE, SONG_THUMBNAIL_SIZE, LIBRARY_ID
 from ytm_api.ytm_service import getSongsFromYTM
 
+# Insert statements shared by the single-row and multi-row persist functions.
+# Each one contains a single "VALUES %s" placeholder, to be used with executeSQLValues
+INSERT_THUMBNAIL = "INSERT INTO thumbnail (id) VALUES %s " \
+                   "ON CONFLICT ON CONSTRAINT thumbnail_pkey DO NOTHING "
+INSERT_THUMBNAIL_DOWNLOAD = "INSERT INTO thumbnail_download (thumbnail_id, downloaded, size, filepath) " \
+                            "VALUES %s " \
+                            "ON CONFLICT ON CONSTRAINT thumbnail_download_pkey " \
+                            "DO UPDATE SET downloaded = thumbnail_download.downloaded or excluded.downloaded, " \
+                            "size = excluded.size, " \
+                            "filepath = coalesce(excluded.filepath, thumbnail_download.filepath)"
+INSERT_ALBUM = "INSERT INTO album (id, name, thumbnail_id, playlist_id, description, num_tracks, release_date, " \
+               "release_date_timestamp, duration, release_type, year) VALUES %s "
+ALBUM_CONFLICT_UPDATE = "ON CONFLICT ON CONSTRAINT album_pkey DO UPDATE SET name=excluded.name, " \
+                        "thumbnail_id=excluded.thumbnail_id, " \
+                        "playlist_id=excluded.playlist_id, description=excluded.description, " \
+                        "num_tracks=excluded.num_tracks, release_date=excluded.release_date, " \
+                        "release_date_timestamp=excluded.release_date_timestamp, duration=excluded.duration, " \
+                        "release_type=excluded.release_type, year=excluded.year"
+# added to ALBUM_CONFLICT_UPDATE to only update (and return) albums that changed
+ALBUM_CHANGED = " WHERE (album.name, album.thumbnail_id, album.playlist_id, album.description, album.num_tracks, " \
+                "album.release_date, album.release_date_timestamp, album.duration, album.release_type, album.year) " \
+                "IS DISTINCT FROM (excluded.name, excluded.thumbnail_id, excluded.playlist_id, " \
+                "excluded.description, excluded.num_tracks, excluded.release_date, " \
+                "excluded.release_date_timestamp, excluded.duration, excluded.release_type, excluded.year) "
+INSERT_SONG = "INSERT INTO song (id, name, album_id, length, explicit, is_local, is_available) " \
+              "VALUES %s ON CONFLICT ON CONSTRAINT song_pkey DO NOTHING "
+INSERT_SONG_IN_PLAYLIST = "INSERT INTO songs_in_playlist " \
+                          "(playlist_id, song_id, set_video_id, datetime_added, index) " \
+                          "VALUES %s " \
+                          "ON CONFLICT ON CONSTRAINT songs_in_playlist_pkey " \
+                          "DO NOTHING "
+INSERT_ARTIST = "INSERT INTO artist (id, name, thumbnail_id, description, views, channel_id, subscribers) " \
+                "VALUES %s ON CONFLICT ON CONSTRAINT artist_pkey DO NOTHING "
+# added to INSERT_ARTIST (instead of DO NOTHING) to save the details from the artist's page
+ARTIST_CONFLICT_UPDATE = "ON CONFLICT ON CONSTRAINT artist_pkey DO UPDATE SET name=excluded.name, " \
+                         "thumbnail_id=excluded.thumbnail_id, description=excluded.description, " \
+                         "views=excluded.views, channel_id=excluded.channel_id, subscribers=excluded.subscribers"
+INSERT_ARTIST_ALBUM = "INSERT INTO artist_albums (album_id, artist_id, index, is_single) VALUES %s"
+INSERT_ARTIST_SONG = "INSERT INTO artist_songs (song_id, artist_id, index) VALUES %s " \
+                     "ON CONFLICT ON CONSTRAINT artist_songs_pkey DO UPDATE SET index = excluded.index " \
+                     "WHERE artist_songs.index IS DISTINCT FROM excluded.index"
+INSERT_PLAYLIST_ACTION = "INSERT INTO playlist_action_log (action_type, timestamp, done_through_ytm, was_success, " \
+                         "playlist_id, playlist_name, song_id, song_name) " \
+                         "VALUES %s"
+
+
+def sortedByKey(rows):
+    """
+    Playlists are synced at the same time (see update_cache.SYNC_WORKERS), and playlists share songs, artists and
+    albums. If two transactions lock the same rows in a different order they can deadlock, so rows are always written
+    in primary key order.
+    :param rows: dict of primary key -> row
+    :return: the rows, ordered by their primary key
+    """
+    # str: a key can contain None (ie: a thumbnail without a size)
+    return [rows[key] for key in sorted(rows, key=str)]
 
-def getArtistId(name):
+
+def getArtistIdsByName(names):
     """
-    Get the id for an artist
-    :param name:
-    :return:
+    Get the ids of artists by name (case insensitive), with one query
+    :param names: lowercase artist names
+    :return: dict of lowercase name -> artist id, for the names that are in the db
     """
-    select = "SELECT id " \
+    if not names:
+        return {}
+    select = "SELECT DISTINCT ON (lower(name)) lower(name), id " \
              "FROM artist " \
-             "WHERE name ilike %s"
-    data = name.strip(),
-    result = executeSQLFetchOne(select, data)
-    return result[0] if result else None
-
-
-def updateSongInPlaylist(new_song_object, playlist_id):
-    update = "UPDATE songs_in_playlist " \
-             "set index = %s " \
-             "where set_video_id = %s " \
-             "and playlist_id = %s"
-    data = new_song_object.index, new_song_object.set_video_id, playlist_id
-    executeSQL(update, data)
+             "WHERE lower(name) in %s " \
+             "ORDER BY lower(name), id"
+    data = iterableToDbTuple(names),
+    return {name: artist_id for name, artist_id in executeSQLFetchAll(select, data)}
 
 
-def persistAlbum(album: 'dm.Album'):
-    insert = "INSERT INTO album (id, name, thumbnail_id, playlist_id, description, num_tracks, release_date, " \
-             "release_date_timestamp, duration, release_type, year) values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) "
+def updateSongIndicesInPlaylist(playlist_id, index_updates):
+    """
+    Set the index of songs in a playlist, with one UPDATE statement
+    :param playlist_id:
+    :param index_updates: list of (set_video_id, new index) tuples
+    :return:
+    """
+    update = "UPDATE songs_in_playlist AS sip " \
+             "SET index = v.index " \
+             "FROM (VALUES %s) AS v (playlist_id, set_video_id, index) " \
+             "WHERE sip.playlist_id = v.playlist_id " \
+             "AND sip.set_video_id = v.set_video_id"
+    data = [(playlist_id, set_video_id, index) for set_video_id, index in index_updates]
+    # one statement for every row, so the index changes are applied all at once
+    executeSQLValues(update, data, page_size=len(data))
+
 
+def persistAlbum(album: 'dm.Album'):
+    insert = INSERT_ALBUM.replace("VALUES %s", "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
     if album.playlist_id:
-        insert += "ON CONFLICT ON CONSTRAINT album_pkey DO UPDATE SET name=excluded.name, thumbnail_id=excluded.thumbnail_id, " \
-                  "playlist_id=excluded.playlist_id, description=excluded.description, " \
-                  "num_tracks=excluded.num_tracks, release_date=excluded.release_date, " \
-                  "release_date_timestamp=excluded.release_date_timestamp, duration=excluded.duration, " \
-                  "release_type=excluded.release_type, year=excluded.year"
+        insert += ALBUM_CONFLICT_UPDATE + ALBUM_CHANGED
     else:
         insert += "ON CONFLICT DO NOTHING"
+    insert += " RETURNING id"
     data = album.to_db()
     persistThumbnail(album.thumbnail)
-    executeSQL(insert, data)
+    if executeSQLFetchOne(insert, data):
+        # the album is part of the json of every song on it
+        bumpPlaylistVersions(album_ids=[album.album_id])
+
+
+def persistArtist(artist: 'dm.Artist'):
+    """
+    Persist an artist's page: its details, and its albums and singles in the order they're shown.
+    Albums that are already in the db are kept as they are (the album's own page has more details).
+    :param artist:
+    :return:
+    """
+    releases = [(a, False) for a in artist.albums] + [(s, True) for s in artist.singles]
+    thumbnails = [r.thumbnail for r, _ in releases if r.thumbnail]
+    if artist.thumbnail:
+        thumbnails.append(artist.thumbnail)
+
+    # DO NOTHING: the first value wins
+    albums = {}
+    artist_albums = {}
+    for index, (album, is_single) in enumerate(releases):
+        if album.album_id:
+            albums.setdefault(album.album_id, album.to_db())
+            artist_albums.setdefault(album.album_id, (album.album_id, artist.artist_id, index, is_single))
+
+    with transaction():
+        old_artist = executeSQLFetchOne("SELECT name, thumbnail_id FROM artist WHERE id = %s", (artist.artist_id,))
+        persistThumbnails(thumbnails)
+        executeSQLValues(INSERT_ALBUM + "ON CONFLICT DO NOTHING", sortedByKey(albums))
+        insert = INSERT_ARTIST.replace("VALUES %s", "VALUES (%s, %s, %s, %s, %s, %s, %s)")
+        insert = insert.replace("ON CONFLICT ON CONSTRAINT artist_pkey DO NOTHING ", ARTIST_CONFLICT_UPDATE)
+        executeSQL(insert, artist.to_db())
+        executeSQL("DELETE FROM artist_albums WHERE artist_id = %s", (artist.artist_id,))
+        executeSQLValues(INSERT_ARTIST_ALBUM, sortedByKey(artist_albums))
+        if old_artist and tuple(old_artist) != artist.to_db()[1:3]:
+            # the artist's name and thumbnail are part of the json of every song by them
+            bumpPlaylistVersions(artist_ids=[artist.artist_id])
 
 
 def persistSong(song: "dm.Song"):
     # persist the song
-    insert_song = "INSERT INTO song (id, name, album_id, length, explicit, is_local, is_available) " \
-                  "VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT ON CONSTRAINT song_pkey DO NOTHING "
+    insert_song = INSERT_SONG.replace("VALUES %s", "VALUES (%s, %s, %s, %s, %s, %s, %s)")
     song_data = song.to_db()
     executeSQL(insert_song, song_data)
 
 
 def persistAllSongData(songs_to_add, playlist_id):
     """
-    Persists songs to the database if it doesn't exist.
-    Persists the song's artists to the database if they don't exist.
-    Persists the song's album to the database if it doesn't exist.
+    Persists songs to the database if they don't exist.
+    Persists the songs' artists to the database if they don't exist.
+    Persists the songs' albums to the database if they don't exist.
+    All rows for the batch are collected and de-duplicated first, then each table is written with one multi-row
+    INSERT (instead of one INSERT per row).
     :param songs_to_add:
     :param playlist_id:
     :return:
@@ -70,38 +170,146 @@ def persistAllSongData(songs_to_add, playlist_id):
     if not isinstance(songs_to_add, list):
         songs_to_add = [songs_to_add]
     datetime_added = datetime.now().timestamp()
+
+    # rows are keyed by primary key so duplicates are removed before they reach the db.
+    # A multi-row "ON CONFLICT DO UPDATE" fails if it affects the same row twice.
+    thumbnails = {}
+    albums_to_upsert = {}
+    albums_to_insert = {}
+    songs = {}
+    songs_in_playlist = {}
+    artists = {}
+    artist_songs = {}
     for song in songs_to_add:
         if song.album:
-            # persist the album thumbnail
-            persistThumbnail(song.album.thumbnail)
+            if song.album.thumbnail:
+                # DO UPDATE: the last value wins
+                thumbnails[(song.album.thumbnail.thumbnail_id, song.album.thumbnail.size)] = song.album.thumbnail
             if song.album.album_id:
-                # persist the album
-                persistAlbum(song.album)
+                album_data = song.album.to_db()
+                if song.album.playlist_id:
+                    # DO UPDATE: the last value wins
+                    albums_to_upsert[song.album.album_id] = album_data
+                else:
+                    # DO NOTHING: the first value wins
+                    albums_to_insert.setdefault(song.album.album_id, album_data)
 
-        persistSong(song)
+        songs.setdefault(song.video_id, song.to_db())
 
         if song.set_video_id and playlist_id:
-            # persist the song/playlist relationship
-            insert_song_playlist = "INSERT INTO songs_in_playlist " \
-                                   "(playlist_id, song_id, set_video_id, datetime_added, index) " \
-                                   "VALUES (%s, %s, %s, %s, %s) " \
-                                   "ON CONFLICT ON CONSTRAINT songs_in_playlist_pkey " \
-                                   "DO NOTHING "
             sip_data = playlist_id, song.video_id, song.set_video_id, datetime_added, song.index
-            executeSQL(insert_song_playlist, sip_data)
+            songs_in_playlist.setdefault((playlist_id, song.video_id, song.set_video_id), sip_data)
+
+        for index, artist in enumerate(song.artists):
+            artists.setdefault(artist.artist_id, artist.to_db())
+            artist_songs.setdefault((song.video_id, artist.artist_id), (song.video_id, artist.artist_id, index))
+
+    persistThumbnails(list(thumbnails.values()))
+    # albums that are DO UPDATE are written first. Any DO NOTHING row with the same id would have been a no-op after it
+    executeSQLValues(INSERT_ALBUM + ALBUM_CONFLICT_UPDATE, sortedByKey(albums_to_upsert))
+    executeSQLValues(INSERT_ALBUM + "ON CONFLICT DO NOTHING", sortedByKey(albums_to_insert))
+    executeSQLValues(INSERT_SONG, sortedByKey(songs))
+    executeSQLValues(INSERT_SONG_IN_PLAYLIST, sortedByKey(songs_in_playlist))
+    executeSQLValues(INSERT_ARTIST, sortedByKey(artists))
+    executeSQLValues(INSERT_ARTIST_SONG, sortedByKey(artist_songs))
+
+
+def bumpPlaylistVersions(playlist_ids=(), song_ids=(), album_ids=(), artist_ids=(), thumbnail_ids=()):
+    """
+    Increment the version of playlists whose json changed, so their snapshots aren't used anymore.
+    Every song lists the playlists it's in (and its index in each), so a change to one playlist also changes the json
+    of every other playlist that shares a song with it.
+    :param playlist_ids: playlists that changed
+    :param song_ids: songs that changed. Every playlist that contains one of them is updated
+    :param album_ids: albums that changed. Every playlist that contains a song from one of them is updated
+    :param artist_ids: artists that changed. Every playlist that contains a song by one of them is updated
+    :param thumbnail_ids: thumbnails that changed (ie: were downloaded). Every playlist that contains a song whose
+        album or artist has one of them is updated
+    :return:
+    """
+    conditions = []
+    data = []
+    if playlist_ids:
+        conditions.append("id in %s")
+        data.append(tuple(playlist_ids))
+    if song_ids:
+        conditions.append("id in (SELECT playlist_id FROM songs_in_playlist WHERE song_id in %s)")
+        data.append(tuple(song_ids))
+    if album_ids:
+        conditions.append("id in (SELECT sip.playlist_id FROM songs_in_playlist AS sip "
+                          "JOIN song AS s ON s.id = sip.song_id WHERE s.album_id in %s)")
+        data.append(tuple(album_ids))
+    if artist_ids:
+        conditions.append("id in (SELECT sip.playlist_id FROM songs_in_playlist AS sip "
+                          "JOIN artist_songs AS ars ON ars.song_id = sip.song_id WHERE ars.artist_id in %s)")
+        data.append(tuple(artist_ids))
+    if thumbnail_ids:
+        conditions.append("id in (SELECT sip.playlist_id FROM songs_in_playlist AS sip "
+                          "JOIN song AS s ON s.id = sip.song_id JOIN album AS a ON a.id = s.album_id "
+                          "WHERE a.thumbnail_id in %s)")
+        conditions.append("id in (SELECT sip.playlist_id FROM songs_in_playlist AS sip "
+                          "JOIN artist_songs AS ars ON ars.song_id = sip.song_id "
+                          "JOIN artist AS ar ON ar.id = ars.artist_id WHERE ar.thumbnail_id in %s)")
+        data += [tuple(thumbnail_ids)] * 2
+    if not conditions:
+        return
+    # the playlists are locked in id order first, so concurrent syncs can't deadlock on them (see sortedByKey)
+    update = "UPDATE playlist SET version = version + 1 " \
+             "WHERE id in (SELECT id FROM playlist WHERE " + " OR ".join(conditions) + " ORDER BY id FOR UPDATE)"
+    executeSQL(update, tuple(data))
+    beforeCommit(bumpLibraryVersion)
+
+
+def bumpLibraryVersion():
+    """
+    Increment the version of my library, after any of its playlists changed (see CachedLibrary.getValidator).
+    Every transaction that changes a playlist updates this one row, so it's done right before committing
+    (see beforeCommit): the row is always the last one locked, and only for as long as the commit takes
+    :return:
+    """
+    executeSQL("UPDATE library_version SET version = version + 1 WHERE id = %s", (LIBRARY_ID,))
+
+
+def getPlaylistSnapshot(playlist_id):
+    """
+    :param playlist_id:
+    :return: (the playlist's version, its snapshot at that version or None if there isn't one),
+        or None if the playlist isn't in the db
+    """
+    select = "SELECT p.version, ps.tracks FROM playlist AS p " \
+             "LEFT JOIN playlist_snapshot AS ps ON ps.playlist_id = p.id AND ps.version = p.version " \
+             "WHERE p.id = %s"
+    data = playlist_id,
+    return executeSQLFetchOne(select, data)
 
-        # persist the song/artist relationships
-        insert_song_artist = "INSERT INTO artist_songs (song_id, artist_id) VALUES (%s, %s) " \
-                             "ON CONFLICT ON CONSTRAINT artist_songs_pkey DO NOTHING"
-        # persist the artists
-        insert_artist = "INSERT INTO artist (id, name, thumbnail_id) " \
-                        "VALUES (%s, %s, %s) ON CONFLICT ON CONSTRAINT artist_pkey DO NOTHING "
-        for artist in song.artists:
-            artist_data = artist.to_db()
-            executeSQL(insert_artist, artist_data)
 
-            song_artist_data = song.video_id, artist.artist_id
-            executeSQL(insert_song_artist, song_artist_data)
+def getPlaylistSnapshotVersion(playlist_id):
+    """
+    Check if a playlist's snapshot is current, without reading the snapshot itself
+    :param playlist_id:
+    :return: (the playlist's version, the version of its snapshot or None if it doesn't have one),
+        or None if the playlist isn't in the db
+    """
+    select = "SELECT p.version, (SELECT version FROM playlist_snapshot WHERE playlist_id = p.id) " \
+             "FROM playlist AS p " \
+             "WHERE p.id = %s"
+    data = playlist_id,
+    return executeSQLFetchOne(select, data)
+
+
+def persistPlaylistSnapshot(playlist_id, version, tracks):
+    """
+    :param playlist_id:
+    :param version: the version of the playlist the snapshot was created from
+    :param tracks: the compressed json of the playlist's songs
+    :return:
+    """
+    insert = "INSERT INTO playlist_snapshot (playlist_id, version, tracks) VALUES (%s, %s, %s) " \
+             "ON CONFLICT ON CONSTRAINT playlist_snapshot_pkey " \
+             "DO UPDATE SET version = excluded.version, tracks = excluded.tracks " \
+             "WHERE playlist_snapshot.version <= excluded.version"
+    data = playlist_id, version, tracks
+    executeSQL(insert, data)
 
 
 def deleteSongsFromPlaylistInDb(playlist_id, set_video_ids):
@@ -118,54 +326,112 @@ def deleteSongsFromPlaylistInDb(playlist_id, set_video_ids):
     executeSQL(delete, delete_data)
 
 
+def getPlaylistSongKey(song: 'dm.Song'):
+    """
+    set_video_id identifies a song within a playlist. (The same song can be in a playlist more than once)
+    :param song:
+    :return:
+    """
+    return song.set_video_id or song.video_id
+
+
+def diffPlaylistSongs(existing_songs: 'List[dm.Song]', new_songs: 'List[dm.Song]'):
+    """
+    Compare the songs in the db with the songs that are in the playlist now
+    :param existing_songs: songs in the playlist according to the db
+    :param new_songs: songs in the playlist according to YTM
+    :return: songs to delete, songs to add, and a list of (set_video_id, new index) for songs that moved
+    """
+    existing_by_key = {getPlaylistSongKey(s): s for s in existing_songs}
+    new_by_key = {getPlaylistSongKey(s): s for s in new_songs}
+
+    songs_to_delete = []
+    index_updates = []
+    for key, existing_song in existing_by_key.items():
+        new_song = new_by_key.get(key)
+        if not new_song or new_song.video_id != existing_song.video_id:
+            songs_to_delete.append(existing_song)
+        elif new_song.index != existing_song.index:
+            index_updates.append((new_song.set_video_id, new_song.index))
+
+    songs_to_add = [new_song for key, new_song in new_by_key.items()
+                    if key not in existing_by_key or existing_by_key[key].video_id != new_song.video_id]
+    return songs_to_delete, songs_to_add, index_updates
+
+
 def persistPlaylistSongs(playlist_obj):
     """
     This is called after I get all the songs that are in a playlist from the YTM api.
     Deletes any songs that are no longer in the playlist since the last time I checked. And persists any new ones.
     :param playlist_obj:
-    :return:
+    :return: True if anything changed
     """
     new_songs = playlist_obj.songs
     playlist_id = playlist_obj.playlist_id
 
-    # get Song objects for existing songs in the database
-    existing_songs = getPlaylistSongsFromDb(playlist_id)
-
-    # get ids for new and existing songs
-    existing_song_ids = {(s.video_id, s.set_video_id) for s in existing_songs}
-    new_song_ids = {(s.video_id, s.set_video_id) for s in new_songs}
-
-    # find which songs to add/update/delete
-    song_ids_to_delete = existing_song_ids.difference(new_song_ids)
-    song_ids_to_add = new_song_ids.difference(existing_song_ids)
-    song_ids_to_update = existing_song_ids.intersection(new_song_ids)
-    logMessage(f"Persisting songs to db for playlist [{playlist_obj.name}] ({len(song_ids_to_add)} new)")
-
-    # delete songs from songs_in_playlist that have been removed
-    if song_ids_to_delete:
-        set_video_ids_to_delete = [s[1] for s in song_ids_to_delete]
-        deleteSongsFromPlaylistInDb(playlist_id, set_video_ids_to_delete)
-        songs_to_delete = [song for song in new_songs
-                           if song.set_video_id in set_video_ids_to_delete]
-        persistSongAction(playlist_obj, songs_to_delete, through_ytm=True, success=True,
-                          action_type=dm.ActionType.REMOVE_SONG)
-    # persist new songs
-    if song_ids_to_add:
-        set_video_ids_to_add = [s[1] for s in song_ids_to_add]
-        songs_to_add = [song for song in new_songs if song.set_video_id in set_video_ids_to_add]
-        persistAllSongData(songs_to_add, playlist_id)
-        persistSongAction(playlist_obj, songs_to_add, through_ytm=True, success=True,
-                          action_type=dm.ActionType.ADD_SONG)
-
-    # Check if the index of the song needs to be updated
-    if song_ids_to_update:
-        # TODO - optimization - this could be done in one SQL query
-        set_video_ids_to_update = [s[1] for s in song_ids_to_update]
-        for set_video_id in set_video_ids_to_update:
-            existing_song_to_update = next((s for s in existing_songs if s.set_video_id == set_video_id))
-            new_song_to_update = next((s for s in new_songs if s.set_video_id == set_video_id))
-            if existing_song_to_update.index != new_song_to_update.index:
-                updateSongInPlaylist(new_song_to_update, playlist_id)
+    # the whole sync is one transaction, so a sync that fails part way through is rolled back
+    with transaction():
+        # get Song objects for existing songs in the database
+        existing_songs = getPlaylistSongsFromDb(playlist_id)
+
+        # find which songs to add/update/delete
+        songs_to_delete, songs_to_add, index_updates = diffPlaylistSongs(existing_songs, new_songs)
+        logMessage(f"Persisting songs to db for playlist [{playlist_obj.name}] ({len(songs_to_add)} new)")
+
+        # delete songs from songs_in_playlist that have been removed
+        if songs_to_delete:
+            deleteSongsFromPlaylistInDb(playlist_id, [s.set_video_id for s in songs_to_delete])
+            persistSongAction(playlist_obj, songs_to_delete, through_ytm=True, success=True,
+                              action_type=dm.ActionType.REMOVE_SONG)
+        # persist new songs
+        if songs_to_add:
+            persistAllSongData(songs_to_add, playlist_id)
+            persistSongAction(playlist_obj, songs_to_add, through_ytm=True, success=True,
+                              action_type=dm.ActionType.ADD_SONG)
+
+        # update the index of songs that moved
+        if index_updates:
+            updateSongIndicesInPlaylist(playlist_id, index_updates)
+
+        # the db matches YTM now
+        markPlaylistSynced(playlist_id)
+
+        changed = bool(songs_to_delete or songs_to_add or index_updates)
+        if changed:
+            moved_set_video_ids = {set_video_id for set_video_id, index in index_updates}
+            moved_songs = [s for s in new_songs if s.set_video_id in moved_set_video_ids]
+            bumpPlaylistVersions([playlist_id], {s.video_id for s in songs_to_delete + songs_to_add + moved_songs})
+        # removed once the new rows are committed, so readers can't put the old rows back in memory
+        afterCommit(lambda: cache_service.invalidatePlaylistInMemory(playlist_id))
+    # the snapshot isn't rebuilt here: it's rebuilt the next time the playlist is read (see iterPlaylistTracksJson)
+    return changed
+
+
+def markPlaylistSynced(playlist_id):
+    """
+    Record that all of a playlist's songs were just retrieved from YTM, so its fingerprint from my library
+    listing matches what is in the db
+    :param playlist_id:
+    :return:
+    """
+    update = "UPDATE playlist SET synced_fingerprint = ytm_fingerprint WHERE id = %s"
+    data = playlist_id,
+    executeSQL(update, data)
+
+
+def getUnchangedPlaylistIds(synced_after):
+    """
+    Get the ids of playlists that haven't changed since they were last synced (according to their fingerprint),
+    and were synced after the given time
+    :param synced_after: timestamp
+    :return: set of playlist ids
+    """
+    select = "SELECT p.id FROM playlist p " \
+             "JOIN data_cache dc ON dc.data_id = p.id AND dc.data_type = 'playlist' " \
+             "WHERE p.ytm_fingerprint = p.synced_fingerprint " \
+             "AND dc.timestamp >= %s"
+    data = synced_after,
+    return {r[0] for r in executeSQLFetchAll(select, data)}
 
 
 def updateDictEntry(the_dict, key, new_val):
@@ -186,19 +452,21 @@ def updateDictEntry(the_dict, key, new_val):
 
 
 def persistThumbnail(thumbnail):
-    insert = "INSERT INTO thumbnail (id) VALUES (%s) " \
-             "ON CONFLICT ON CONSTRAINT thumbnail_pkey DO NOTHING "
-    data = thumbnail.thumbnail_id,
-    executeSQL(insert, data)
+    persistThumbnails([thumbnail])
 
-    insert_dl = "INSERT INTO thumbnail_download (thumbnail_id, downloaded, size, filepath) " \
-                "VALUES (%s, %s, %s, %s) " \
-                "ON CONFLICT ON CONSTRAINT thumbnail_download_pkey " \
-                "DO UPDATE SET downloaded = excluded.downloaded, " \
-                "size = excluded.size, " \
-                "filepath = excluded.filepath"
-    data = thumbnail.to_db()
-    executeSQL(insert_dl, data)
+
+def persistThumbnails(thumbnails):
+    """
+    Persist thumbnails, and their thumbnail_download rows, to the db
+    :param thumbnails:
+    :return:
+    """
+    thumbnail_ids = {t.thumbnail_id: (t.thumbnail_id,) for t in thumbnails}
+    executeSQLValues(INSERT_THUMBNAIL, sortedByKey(thumbnail_ids))
+
+    # thumbnail_download is DO UPDATE, so only the last row for each (id, size) is kept
+    downloads = {(t.thumbnail_id, t.size): t.to_db() for t in thumbnails}
+    executeSQLValues(INSERT_THUMBNAIL_DOWNLOAD, sortedByKey(downloads))
 
 
 def persistAllPlaylists(playlist_list):
@@ -207,57 +475,87 @@ def persistAllPlaylists(playlist_list):
     :param playlist_list:
     :return:
     """
-    insert = "INSERT INTO playlist (id, name, thumbnail_id) VALUES (%s, %s, %s) " \
+    insert = "INSERT INTO playlist (id, name, thumbnail_id, ytm_fingerprint) VALUES (%s, %s, %s, %s) " \
              "ON CONFLICT ON CONSTRAINT playlist_pkey " \
-             "DO UPDATE SET thumbnail_id=excluded.thumbnail_id, name=excluded.name "
+             "DO UPDATE SET thumbnail_id=excluded.thumbnail_id, name=excluded.name, " \
+             "ytm_fingerprint=excluded.ytm_fingerprint "
+    existing_names = dict(executeSQLFetchAll("SELECT id, name FROM playlist", None))
     for playlist in playlist_list:
         persistThumbnail(playlist.thumbnail)
         data = playlist.to_db()
         executeSQL(insert, data)
 
+    # playlist names are part of the json of every song in them
+    renamed_ids = [p.playlist_id for p in playlist_list
+                   if p.playlist_id in existing_names and existing_names[p.playlist_id] != p.name]
+    if renamed_ids:
+        select = "SELECT DISTINCT song_id FROM songs_in_playlist WHERE playlist_id in %s"
+        data = tuple(renamed_ids),
+        bumpPlaylistVersions(renamed_ids, [r[0] for r in executeSQLFetchAll(select, data)])
+    # playlists may have been added, or have a new thumbnail
+    beforeCommit(bumpLibraryVersion)
+
 
-def getNumSongsInPlaylist(playlist_id):
-    select = "SELECT count(*) " \
+def getNumSongsInPlaylists(playlist_ids):
+    """
+    Count the songs in each of the given playlists, with one query
+    :param playlist_ids:
+    :return: dict of playlist id -> number of songs
+    """
+    if not playlist_ids:
+        return {}
+    select = "SELECT playlist_id, count(*) " \
              "FROM songs_in_playlist " \
-             "WHERE playlist_id = %s"
-    data = playlist_id,
-    result = executeSQLFetchOne(select, data)
-    return result[0]
+             "WHERE playlist_id in %s " \
+             "GROUP BY playlist_id"
+    data = tuple(playlist_ids),
+    result = executeSQLFetchAll(select, data)
+    return {playlist_id: num_songs for playlist_id, num_songs in result}
 
 
 def getPlaylistsFromDb(convert_to_json=False, playlist_id=None):
     """
-    Get all playlist metadata from the db
+    Get all playlist metadata from the db.
+    The cache timestamp, number of songs and thumbnail for every playlist are all selected in one query
     :param playlist_id:
     :param convert_to_json:
     :return:
     """
-    select = "SELECT p.id, p.name, p.thumbnail_id, dc.timestamp " \
-             "from playlist as p left join data_cache as dc on p.id=dc.data_id "
-    data = None
+    select = "SELECT p.id, p.name, p.thumbnail_id, dc.timestamp, coalesce(counts.num_songs, 0), " \
+             "td.downloaded, td.size, td.filepath " \
+             "from playlist as p " \
+             "left join data_cache as dc on p.id=dc.data_id and dc.data_type = 'playlist' " \
+             "left join (SELECT playlist_id, count(*) as num_songs FROM songs_in_playlist GROUP BY playlist_id) " \
+             "as counts on p.id=counts.playlist_id " \
+             "left join thumbnail_download as td on p.thumbnail_id=td.thumbnail_id and td.size = %s "
+    data = PLAYLIST_THUMBNAIL_SIZE,
     if playlist_id:
         # only get data for a specific playlist
         select += " where p.id = %s"
-        data = playlist_id,
+        data += playlist_id,
 
     select += " order by p.name"
     result = executeSQLFetchAll(select, data)
 
     # create Playlist objects from db tuples
     playlist_objs = [dm.Playlist.from_db(r) for r in result]
-    for pl_obj in playlist_objs:
-        pl_obj.num_songs = getNumSongsInPlaylist(pl_obj.playlist_id)
 
     if convert_to_json:
         playlist_objs = [playlist.to_json() for playlist in playlist_objs]
 
-    # return a single Playlist if playlist_id was given, otherwise return the full list
-    return playlist_objs[0] if playlist_id else playlist_objs
+    # return a single Playlist (or None if it isn't in the db) if playlist_id was given, otherwise return the full list
+    if playlist_id:
+        return playlist_objs[0] if playlist_objs else None
+    return playlist_objs
 
 
-def getSongsFromDb(song_id, playlist_id, include_song_playlists, get_json=False):
-    if not song_id and not playlist_id:
-        return []
+def createSongsSelect(song_id, playlist_id):
+    """
+    Create the query used to get songs from the db, either by id or by playlist
+    :param song_id: a song id or a list of song ids
+    :param playlist_id:
+    :return: the query and its data
+    """
     # use inner join if getting songs from a playlist because we only want songs that are in that playlist
     # use left join if getting a specific song because we don't care if the song is in songs_in_playlist
     # noinspection SqlResolve
@@ -280,25 +578,183 @@ def getSongsFromDb(song_id, playlist_id, include_song_playlists, get_json=False)
         select += f" {'AND' if song_id else 'WHERE'} sip.playlist_id = %s"
         data += playlist_id,
         select += " order by sip.index"
+    return select, data
+
+
+def getSongsFromDb(song_id, playlist_id, include_song_playlists, get_json=False, fields=None):
+    if not song_id and not playlist_id:
+        return []
+    select, data = createSongsSelect(song_id, playlist_id)
     result = executeSQLFetchAll(select, data)
     song_lst = dm.getListOfSongObjects(result, from_db=True, include_playlists=include_song_playlists,
-                                       include_index=False, get_json=get_json)
+                                       include_index=False, get_json=get_json, fields=fields)
 
     return song_lst
 
 
-def getPlaylistSongsFromDb(playlist_id, convert_to_json=False):
+def getPlaylistSongsFromDb(playlist_id, convert_to_json=False, fields=None):
     """
     Get all the songs that belong to a playlist from the db
     :param playlist_id:
     :param convert_to_json:
+    :param fields: the song fields that are needed (see data_models.getListOfSongObjects). None to get everything
     :return:
     """
     song_lst = getSongsFromDb(song_id=None, playlist_id=playlist_id, include_song_playlists=True,
-                              get_json=convert_to_json)
+                              get_json=convert_to_json, fields=fields)
     return song_lst
 
 
+def iterPlaylistSongsFromDb(playlist_id, convert_to_json=False, chunk_size=None, itersize=DEFAULT_ITERSIZE,
+                            fields=None):
+    """
+    Same as getPlaylistSongsFromDb, but returns a generator. Rows are read with a server-side cursor and turned into
+    Song objects chunk_size at a time, so memory use depends on chunk_size instead of the size of the playlist.
+    :param playlist_id:
+    :param convert_to_json:
+    :param chunk_size: number of songs that are created at a time (defaults to data_models.SONG_CHUNK_SIZE)
+    :param itersize: number of rows fetched from the db per round trip
+    :param fields: the song fields that are needed (see data_models.getListOfSongObjects). None to get everything
+    :return:
+    """
+    select, data = createSongsSelect(song_id=None, playlist_id=playlist_id)
+    rows = executeSQLFetchIter(select, data, itersize=itersize)
+    return dm.iterListOfSongObjects(rows, from_db=True, include_playlists=True, get_json=convert_to_json,
+                                    chunk_size=chunk_size or dm.SONG_CHUNK_SIZE, fields=fields)
+
+
+# sql for the url of a thumbnail (the same as data_models.createThumbnailUrl)
+THUMBNAIL_URL_SQL = "CASE WHEN lower(substring({id} from '^[a-z]+://([^/:?#]+)')) " \
+                    "in ('yt3.ggpht.com', 'lh3.googleusercontent.com') AND {size} IS NOT NULL " \
+                    "THEN {id} || 's' || {size} ELSE {id} END"
+
+# The queries below build the json for a page of the songs in a playlist in postgres (see
+# createPlaylistSongsJsonSelect).
+# The page is read in order from the songs_in_playlist_index index. A song is a duplicate if the same song is earlier
+# in the playlist, even if that's on another page.
+# noinspection SqlResolve
+PLAYLIST_PAGE_SQL = \
+    "page AS (" \
+    "  SELECT sip.song_id, sip.set_video_id, sip.index, {is_dupe} AS is_dupe " \
+    "  FROM songs_in_playlist AS sip " \
+    "  WHERE sip.playlist_id = %(playlist_id)s AND (%(after_index)s::int IS NULL OR sip.index > %(after_index)s) " \
+    "  ORDER BY sip.index LIMIT %(limit)s OFFSET %(offset)s" \
+    "), tracks AS (" \
+    "  SELECT s.id, s.name, s.length, s.explicit, s.is_local, s.is_available, sip.set_video_id, sip.index, " \
+    "  alb.id AS album_id, alb.name AS album_name, alb.thumbnail_id AS album_thumbnail_id, alb.playlist_id, " \
+    "  alb.description, alb.duration, alb.release_type, alb.num_tracks, alb.year, " \
+    "  CASE WHEN alb.release_date_timestamp IS NOT NULL THEN alb.release_date END AS release_date, sip.is_dupe " \
+    "  FROM page AS sip " \
+    "  JOIN song AS s ON s.id = sip.song_id " \
+    "  LEFT JOIN album AS alb ON s.album_id = alb.id" \
+    ")"
+IS_DUPE_SQL = "EXISTS (SELECT 1 FROM songs_in_playlist AS prev WHERE prev.playlist_id = sip.playlist_id " \
+              "AND prev.song_id = sip.song_id AND prev.index < sip.index)"
+# noinspection SqlResolve
+SONG_PLAYLISTS_SQL = \
+    "song_playlists AS (" \
+    "  SELECT sip.song_id, json_agg(json_build_object('videoId', sip.song_id, 'setVideoId', sip.set_video_id, " \
+    "  'playlistId', p.id, 'playlistName', p.name, 'index', sip.index) " \
+    "  ORDER BY sip.playlist_id, sip.index, sip.set_video_id) AS playlists " \
+    "  FROM songs_in_playlist AS sip " \
+    "  JOIN playlist AS p ON p.id = sip.playlist_id " \
+    "  WHERE sip.song_id IN (SELECT id FROM tracks) " \
+    "  GROUP BY sip.song_id" \
+    ")"
+# noinspection SqlResolve
+SONG_ARTISTS_SQL = \
+    "song_artists AS (" \
+    "  SELECT ass.song_id, json_agg(CASE WHEN a.thumbnail_id IS NULL " \
+    "  THEN json_build_object('id', a.id, 'name', a.name, 'description', null, 'views', null, " \
+    "  'channel_id', null, 'subscribers', null, 'albums', '[]'::json, 'singles', '[]'::json) " \
+    "  ELSE json_build_object('id', a.id, 'name', a.name, 'description', null, 'views', null, " \
+    "  'channel_id', null, 'subscribers', null, 'albums', '[]'::json, 'singles', '[]'::json, " \
+    "  'thumbnail', json_build_object('url', " + THUMBNAIL_URL_SQL.format(id="a.thumbnail_id", size="td.size") + \
+    ", 'size', td.size, 'filepath', td.filepath)) END ORDER BY ass.index, ass.artist_id) AS artists " \
+    "  FROM artist_songs AS ass " \
+    "  JOIN artist AS a ON a.id = ass.artist_id " \
+    "  LEFT JOIN LATERAL (SELECT size, filepath FROM thumbnail_download " \
+    "    WHERE thumbnail_id = a.thumbnail_id ORDER BY size DESC LIMIT 1) AS td ON true " \
+    "  WHERE ass.song_id IN (SELECT id FROM tracks) " \
+    "  GROUP BY ass.song_id" \
+    ")"
+# the value of each key in the json of a song (in the same order as data_models.SONG_FIELDS)
+SONG_JSON_SQL = {
+    "videoId": "t.id",
+    "setVideoId": "t.set_video_id",
+    "title": "t.name",
+    "index": "t.index",
+    "album": "CASE WHEN t.album_thumbnail_id IS NULL THEN '{}'::json "
+             "ELSE json_build_object('id', t.album_id, 'title', t.album_name, 'playlist_id', t.playlist_id, "
+             "'description', t.description, 'duration', t.duration, "
+             "'release_type', coalesce(t.release_type::text, ''), "
+             "'num_tracks', t.num_tracks, 'release_date', t.release_date, 'release_year', t.year, "
+             "'thumbnail', json_build_object('url', " +
+             THUMBNAIL_URL_SQL.format(id="t.album_thumbnail_id", size="%(thumbnail_size)s") +
+             ", 'size', %(thumbnail_size)s, 'filepath', td.filepath), 'songs', '[]'::json) END",
+    "isAvailable": "t.is_available",
+    "artists": "coalesce(sa.artists, '[]'::json)",
+    "isDupe": "t.is_dupe",
+    "playlists": "coalesce(sp.playlists, '[]'::json)",
+    "duration": "t.length",
+    "isExplicit": "t.explicit",
+    "is_local": "CASE WHEN t.is_local THEN true WHEN t.album_id IS NULL THEN null "
+                "ELSE position('FEmusic_library_privately_owned_release' in t.album_id) > 0 END",
+}
+
+
+def createPlaylistSongsJsonSelect(fields=None):
+    """
+    Create the query that builds the json for a page of the songs in a playlist in postgres. Each row is the json text
+    of one song, in the same format as Song.to_json (with isDupe set like findDuplicatesAndAddFlag does), and the
+    song's index.
+    :param fields: the keys to include in the json (see data_models.projectSongJson). The playlists, artists and
+    album of the songs are only selected if they're in fields. None to include every key
+    :return:
+    """
+    fields = SONG_JSON_SQL.keys() if fields is None else {"videoId", *fields}
+    ctes = [PLAYLIST_PAGE_SQL.format(is_dupe=IS_DUPE_SQL if "isDupe" in fields else "false")]
+    joins = ""
+    if "playlists" in fields:
+        ctes.append(SONG_PLAYLISTS_SQL)
+        joins += "LEFT JOIN song_playlists AS sp ON sp.song_id = t.id "
+    if "artists" in fields:
+        ctes.append(SONG_ARTISTS_SQL)
+        joins += "LEFT JOIN song_artists AS sa ON sa.song_id = t.id "
+    if "album" in fields:
+        joins += "LEFT JOIN thumbnail_download AS td ON td.thumbnail_id = t.album_thumbnail_id " \
+                 "AND td.size = %(thumbnail_size)s "
+    json_args = ", ".join(f"'{key}', {value}" for key, value in SONG_JSON_SQL.items() if key in fields)
+    return f"WITH {', '.join(ctes)} " \
+           f"SELECT json_build_object({json_args})::text, t.index " \
+           f"FROM tracks AS t " \
+           f"{joins}" \
+           f"ORDER BY t.index"
+
+
+SELECT_PLAYLIST_SONGS_JSON = createPlaylistSongsJsonSelect()
+
+
+def iterPlaylistSongsJsonFromDb(playlist_id, offset=0, limit=None, after_index=None, fields=None,
+                                itersize=DEFAULT_ITERSIZE):
+    """
+    Get the json for the songs in a playlist, built entirely by postgres (see createPlaylistSongsJsonSelect).
+    This skips creating Song/Album/Artist objects, so python does much less work and memory use stays flat.
+    :param playlist_id:
+    :param offset: number of songs to skip (after after_index)
+    :param limit: max number of songs to get. If None, every song is returned
+    :param after_index: only get the songs after this index in the playlist
+    :param fields: the keys to include in the json of each song. None to include every key
+    :param itersize: number of rows fetched from the db per round trip
+    :return: a generator of (json string, index) tuples, one per song
+    """
+    select = SELECT_PLAYLIST_SONGS_JSON if fields is None else createPlaylistSongsJsonSelect(fields)
+    data = {"playlist_id": playlist_id, "thumbnail_size": SONG_THUMBNAIL_SIZE, "offset": offset, "limit": limit,
+            "after_index": after_index}
+    for row in executeSQLFetchIter(select, data, itersize=itersize):
+        yield row[0], row[1]
+
+
 def flattenList(parent_list):
     flat_list = []
     for sublist in parent_list:
@@ -311,15 +767,24 @@ def flattenList(parent_list):
 
 
 def deletePlaylistFromDb(playlist_id, through_ytm):
-    playlist = cache_service.getPlaylist(playlist_id)
-    # persist changes in playlist_action_log
-    persistSongAction(playlist, playlist.songs, through_ytm, success=True, action_type=dm.ActionType.REMOVE_SONG)
-    persistDeletePlaylistAction(playlist_id, playlist.name, through_ytm)
+    # only the db is used: this is called when YTM returns 404 for the playlist
+    playlist = cache_service.getPlaylistFromCache(playlist_id, get_json=False)
+    if not playlist:
+        return
+    with transaction():
+        # persist changes in playlist_action_log
+        persistSongAction(playlist, playlist.songs, through_ytm, success=True,
+                          action_type=dm.ActionType.REMOVE_SONG)
+        persistDeletePlaylistAction(playlist_id, playlist.name, through_ytm)
 
-    # delete from db
-    delete = "DELETE FROM playlist where id = %s"
-    data = playlist_id,
-    executeSQL(delete, data)
+        # delete from db
+        delete = "DELETE FROM playlist where id = %s"
+        data = playlist_id,
+        executeSQL(delete, data)
+        # the other playlists its songs are in don't list it anymore
+        bumpPlaylistVersions(song_ids={s.video_id for s in playlist.songs})
+        beforeCommit(bumpLibraryVersion)
+        afterCommit(lambda: cache_service.invalidatePlaylistInMemory(playlist_id))
 
 
 def persistDeletePlaylistAction(playlist_id, playlist_name, through_ytm):
@@ -343,19 +808,27 @@ def persistSongActionFromSongIds(playlist, song_ids: List[str], through_ytm, suc
 
 
 def persistSongAction(playlist: 'dm.Playlist', songs: 'List[dm.Song]', through_ytm, success, action_type):
-    for song in songs:
-        action = dm.PlaylistActionLog(action_type, datetime.now().timestamp(), through_ytm, success,
-                                      playlist.playlist_id, playlist.name, song.video_id, song.title)
-        persistPlaylistAction(action)
+    timestamp = datetime.now().timestamp()
+    actions = [dm.PlaylistActionLog(action_type, timestamp, through_ytm, success, playlist.playlist_id,
+                                    playlist.name, song.video_id, song.title) for song in songs]
+    try:
+        with transaction():
+            executeSQLValues(INSERT_PLAYLIST_ACTION, [action.to_db() for action in actions])
+    except Exception as e:
+        if "playlist_action_log_song_id_fkey" not in str(e):
+            raise e
+        # at least one of the songs isn't in the db. persist them one at a time so the missing songs are fetched
+        for action in actions:
+            persistPlaylistAction(action)
 
 
 def persistPlaylistAction(playlist_action: 'dm.PlaylistActionLog'):
-    insert = "INSERT INTO playlist_action_log (action_type, timestamp, done_through_ytm, was_success, playlist_id," \
-             " playlist_name, song_id, song_name) " \
-             "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
+    insert = INSERT_PLAYLIST_ACTION.replace("VALUES %s", "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)")
     data = playlist_action.to_db()
     try:
-        executeSQL(insert, data)
+        # run in a nested transaction so a failed insert doesn't abort an open transaction
+        with transaction():
+            executeSQL(insert, data)
     except Exception as e:
         if "playlist_action_log_song_id_fkey" in str(e):
             logMessage(
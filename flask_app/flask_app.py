@@ -1,20 +1,31 @@
 """Flask endpoints"""
+import os
 import random
 import time
+from datetime import date
 
 import json
 
-from flask import Flask, request, send_file, make_response, g
+from flask import Flask, request, send_file, make_response, g, Response, stream_with_context
 
 from cache import cache_service as cs
+from cache import history_poller
+from cache import image_cache
+from db import listening_stats
+from db.data_models import SONG_FIELDS
 from log import setupCustomLogger, logMessage
-from util import ALBUM_PAGE_THUMBNAIL_SIZE
+from util import ALBUM_PAGE_THUMBNAIL_SIZE, IMAGE_DIR, LIBRARY_ID
 from ytm_api import ytm_service
 
 app = Flask(__name__)
 
 channel_id = "UCrfCekSTtlSSUhchrtKBzcA"
 
+# for responses that never change at the same url (ie: content-addressed images)
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# for responses with an ETag: the browser can keep a copy, but has to check that it's up to date before using it
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
 
 @app.before_request
 def before_request():
@@ -37,6 +48,37 @@ def httpResponse(json_data, http_code=200):
     return json.dumps(json_data), http_code, {'ContentType': 'application/json'}
 
 
+def streamingResponse(json_generator, http_code=200):
+    """
+    Convenience method for returning json data to the frontend, that is generated in pieces
+    :param json_generator: generator of strings that make up the json response
+    :param http_code:
+    :return:
+    """
+    return Response(stream_with_context(json_generator), status=http_code, mimetype="application/json")
+
+
+def cachedDataResponse(validator, get_response):
+    """
+    Returns 304 (Not Modified) if the frontend already has this version of the data. Otherwise returns the response
+    from get_response.
+    :param validator: from cs.getFreshValidator. If it's None no ETag is sent, and get_response is always called
+    :param get_response: function that creates the response
+    :return:
+    """
+    etag = "-".join(str(v) for v in validator) if validator else None
+    if etag and request.if_none_match.contains_weak(etag):
+        resp = make_response("", 304)
+    else:
+        resp = make_response(get_response())
+    if etag:
+        # weak, because the json includes values like "5 minutes ago"
+        resp.set_etag(etag, weak=True)
+        resp.last_modified = validator[0]
+        resp.headers['Cache-Control'] = REVALIDATE_CACHE_CONTROL
+    return resp
+
+
 def successResponse(success_message, http_code=200):
     """
     Convenience method for returning a success response
@@ -57,6 +99,16 @@ def errorResponse(error_msg, http_code=500):
     return httpResponse({"error": error_msg}, http_code)
 
 
+def dataResponse(data, not_found_msg):
+    """
+    Convenience method for returning cached data, or a 404 if YTM doesn't have it (see cs.CachedData.isNotFound)
+    :param data: the json data, or None if it wasn't found
+    :param not_found_msg:
+    :return:
+    """
+    return httpResponse(data) if data is not None else errorResponse(not_found_msg, 404)
+
+
 @app.route("/addSongs", methods=["PUT"])
 def addSongsToPlaylistEndpoint():
     """
@@ -103,14 +155,32 @@ def removeSongsFromPlaylistEndpoint():
 @app.route("/playlist/<playlist_id>", methods=["GET"])
 def getPlaylistEndpoint(playlist_id):
     """
-    This endpoint returns all the songs that are in a given playlist
+    This endpoint returns all the songs that are in a given playlist.
+    To get one page of songs use offset and limit, and/or afterIndex (the nextAfterIndex of the previous page).
+    To only get some of the fields of each song use fields (ie: fields=title,artists,duration)
     :param playlist_id:
     :return:
     """
     ignore_cache = shouldIgnoreCache(request_args=request.args)
+    try:
+        offset, limit, after_index = getPageArgs(request_args=request.args)
+        fields = getFieldsArg(request_args=request.args)
+    except ValueError as e:
+        return errorResponse(str(e), 400)
+    validator = None if playlist_id == "history" or ignore_cache \
+        else cs.getFreshValidator(cs.playlist_cache, playlist_id)
+    if validator:
+        # stream the playlist's snapshot from the db, so large playlists aren't held in memory all at once
+        return cachedDataResponse(validator, lambda: streamingResponse(
+            cs.streamPlaylistFromCache(playlist_id, offset, limit, after_index, fields)))
     result = cs.getHistory(ignore_cache=ignore_cache, get_json=True) if playlist_id == "history" \
         else cs.getPlaylist(playlist_id=playlist_id, ignore_cache=ignore_cache)
-    return httpResponse(result)
+    if result is None:
+        return errorResponse(f"Playlist not found [{playlist_id}]", 404)
+    if cs.isPageRequest(offset, limit, after_index):
+        result = cs.getPlaylistPage(result, offset, limit, after_index)
+    # the full playlist was loaded (and is cached in memory), so the fields are only removed from the response
+    return httpResponse(cs.projectPlaylistJson(result, fields))
 
 
 @app.route("/artist/<artist_id>", methods=["GET"])
@@ -120,19 +190,28 @@ def getArtistEndpoint(artist_id):
     :return:
     """
     ignore_cache = shouldIgnoreCache(request_args=request.args)
-    result = cs.getArtist(artist_id, ignore_cache, get_json=True)
-    return httpResponse(result)
+    validator = None if ignore_cache else cs.getFreshValidator(cs.artist_cache, artist_id)
+    return cachedDataResponse(validator, lambda: dataResponse(
+        cs.getArtist(artist_id, ignore_cache, get_json=True, validator=validator), f"Artist not found [{artist_id}]"))
 
 
 @app.route("/album/<album_id>", methods=["GET"])
 def getAlbumEndpoint(album_id):
     """
-    Returns all album data
+    Returns all album data.
+    To only get some of the fields of each song use fields (ie: fields=title,duration)
     :return:
     """
     ignore_cache = shouldIgnoreCache(request_args=request.args)
-    result = cs.getAlbum(album_id, ignore_cache, get_json=True, size=ALBUM_PAGE_THUMBNAIL_SIZE)
-    return httpResponse(result)
+    try:
+        fields = getFieldsArg(request_args=request.args)
+    except ValueError as e:
+        return errorResponse(str(e), 400)
+    validator = None if ignore_cache else cs.getFreshValidator(cs.album_cache, album_id)
+    return cachedDataResponse(validator, lambda: dataResponse(
+        cs.getAlbum(album_id, ignore_cache, get_json=True, size=ALBUM_PAGE_THUMBNAIL_SIZE, validator=validator,
+                    fields=fields),
+        f"Album not found [{album_id}]"))
 
 
 @app.route('/library', methods=["GET"])
@@ -142,17 +221,71 @@ def getAllPlaylistsEndpoint():
     :return:
     """
     ignore_cache = shouldIgnoreCache(request_args=request.args)
-    result = cs.getAllPlaylists(ignore_cache)
-    return httpResponse(result)
+    validator = None if ignore_cache else cs.getFreshValidator(cs.library_cache, LIBRARY_ID)
+    return cachedDataResponse(validator, lambda: httpResponse(cs.getAllPlaylists(ignore_cache, validator=validator)))
+
+
+@app.route("/stats", methods=["GET"])
+def getListeningStatsEndpoint():
+    """
+    Returns the number of plays and time listened in a day, week or month, and its most played songs, artists and
+    albums. ie: /stats?period=week&start=2024-03-04&limit=10
+    (start can be any day in the period, and defaults to today)
+    :return:
+    """
+    try:
+        period = request.args.get("period", "week")
+        start = request.args.get("start")
+        start = date.fromisoformat(start) if start else None
+        limit = int(request.args.get("limit", listening_stats.DEFAULT_TOP_LIMIT))
+        return httpResponse(listening_stats.getListeningStats(period, start, limit))
+    except ValueError as e:
+        return errorResponse(str(e), 400)
+
+
+@app.route("/cacheStats", methods=["GET"])
+def getCacheStatsEndpoint():
+    """
+    Returns hit/miss/eviction counts for the in-memory cache, and the number of YTM fetches that were avoided
+    because the item was already known to be 404
+    :return:
+    """
+    return httpResponse(cs.getMemoryCacheStats())
 
 
 @app.route("/images/<image_name>", methods=["GET"])
 def get_image(image_name):
-    resp = make_response(send_file(filename_or_fp="./images/" + image_name, mimetype="image/png"))
+    resp = make_response(send_file(filename_or_fp=os.path.join(IMAGE_DIR, image_name), mimetype="image/png"))
     resp.headers['Content-Transfer-Encoding'] = 'base64'
     return resp
 
 
+@app.route("/images/<int:size>/<image_name>", methods=["GET"])
+def getResizedImageEndpoint(size, image_name):
+    """
+    Returns a downloaded image resized to fit in a size x size square.
+    The ETag is based on the image content, so browsers can cache it forever
+    :param size: one of the thumbnail sizes in util.py
+    :param image_name:
+    :return:
+    """
+    if size not in image_cache.RESIZED_IMAGE_SIZES:
+        return errorResponse(f"Invalid image size [{size}]", 404)
+    etag = image_cache.getResizedImageEtag(image_name, size)
+    if not etag:
+        return errorResponse(f"Image not found [{image_name}]", 404)
+
+    if request.if_none_match.contains(etag):
+        resp = make_response("", 304)
+    else:
+        resized_image = image_cache.getResizedImage(image_name, size)
+        resp = make_response(send_file(filename_or_fp=resized_image.filepath, mimetype="image/png",
+                                       add_etags=False, conditional=False))
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return resp
+
+
 def shouldIgnoreCache(request_args):
     """
     Looks for ignoreCache=true in the request query parameters
@@ -163,6 +296,43 @@ def shouldIgnoreCache(request_args):
     return True if should_ignore.lower() == "true" else False
 
 
+def getPageArgs(request_args):
+    """
+    Looks for offset, limit and afterIndex in the request query parameters
+    :param request_args:
+    :return: (offset, limit, after_index). offset is 0 if it isn't given, the others are None
+    """
+    try:
+        offset = int(request_args.get("offset", 0))
+        limit = request_args.get("limit")
+        limit = int(limit) if limit is not None else None
+        after_index = request_args.get("afterIndex")
+        after_index = int(after_index) if after_index is not None else None
+    except ValueError:
+        raise ValueError("offset, limit and afterIndex must be integers")
+    if offset < 0 or (limit is not None and limit < 1):
+        raise ValueError("offset can't be negative, and limit must be at least 1")
+    return offset, limit, after_index
+
+
+def getFieldsArg(request_args):
+    """
+    Looks for fields (a comma separated list of song fields) in the request query parameters
+    :param request_args:
+    :return: a set of song fields, or None if fields wasn't given
+    """
+    fields = request_args.get("fields")
+    if fields is None:
+        return None
+    fields = {f.strip() for f in fields.split(",") if f.strip()}
+    unknown = fields.difference(SONG_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields {sorted(unknown)}. Valid fields are {list(SONG_FIELDS)}")
+    return fields
+
+
 if __name__ == '__main__':
     setupCustomLogger("flask")
+    # save the listening history in the background, even if the history playlist isn't opened
+    history_poller.HistoryPoller().start()
     app.run(host="localhost", port=5050)
@@ -0,0 +1,141 @@
+from contextlib import contextmanager
+
+from cache import cache_service  # imported before db, to avoid a circular import
+from cache.cache_service import CachedArtist
+from db import data_models as dm
+from db import ytm_db_service
+from db.ytm_db_service import INSERT_ARTIST_ALBUM
+
+
+class RecordingDb:
+    """
+    Records the statements persistArtist sends, in order. BEGIN and COMMIT mark the transaction() block
+    """
+
+    def __init__(self, monkeypatch, old_artist=None):
+        self.old_artist = old_artist
+        self.statements = []
+        self.bumped = []
+        monkeypatch.setattr(ytm_db_service, "transaction", self.transaction)
+        monkeypatch.setattr(ytm_db_service, "executeSQL", lambda query, data=None: self.record(query, data))
+        monkeypatch.setattr(ytm_db_service, "executeSQLValues", lambda query, values: self.record(query, values))
+        monkeypatch.setattr(ytm_db_service, "executeSQLFetchOne", self.fetchOne)
+        monkeypatch.setattr(ytm_db_service, "persistThumbnails", lambda thumbnails: None)
+        monkeypatch.setattr(ytm_db_service, "bumpPlaylistVersions", lambda **kwargs: self.bumped.append(kwargs))
+
+    @contextmanager
+    def transaction(self):
+        self.record("BEGIN")
+        yield
+        self.record("COMMIT")
+
+    def record(self, query, data=None):
+        self.statements.append((query, data))
+
+    def fetchOne(self, query, data):
+        self.record(query, data)
+        return self.old_artist
+
+    def getQueries(self, prefix):
+        return [(query, data) for query, data in self.statements if query.startswith(prefix)]
+
+
+def createAlbum(album_id, name=None):
+    return dm.Album(album_id, name or album_id, None, thumbnail_id=f"thumb_{album_id}")
+
+
+def createArtist(name="Artist", thumbnail_id=None, albums=(), singles=()):
+    thumbnail = dm.Thumbnail(thumbnail_id, None, 60, False) if thumbnail_id else None
+    artist = dm.Artist("UC_artist", name, thumbnail)
+    artist.albums = list(albums)
+    artist.singles = list(singles)
+    return artist
+
+
+def test_artist_albums_are_replaced_in_page_order(monkeypatch):
+    db = RecordingDb(monkeypatch)
+    artist = createArtist(albums=[createAlbum("MPREb_b"), createAlbum(None), createAlbum("MPREb_a"),
+                                  createAlbum("MPREb_b", "duplicate")],
+                          singles=[createAlbum("MPREb_single")])
+    ytm_db_service.persistArtist(artist)
+
+    queries = [query for query, _ in db.statements]
+    delete = queries.index("DELETE FROM artist_albums WHERE artist_id = %s")
+    insert = queries.index(INSERT_ARTIST_ALBUM)
+    assert queries[0] == "BEGIN" and queries[-1] == "COMMIT"
+    assert delete < insert
+    assert db.statements[delete][1] == ("UC_artist",)
+    # written in album id order. The index is the position on the artist's page, and the first duplicate wins
+    assert db.statements[insert][1] == [("MPREb_a", "UC_artist", 2, False), ("MPREb_b", "UC_artist", 0, False),
+                                        ("MPREb_single", "UC_artist", 4, True)]
+    album_inserts = db.getQueries("INSERT INTO album")
+    assert len(album_inserts) == 1
+    # albums that are already in the db are kept as they are
+    assert album_inserts[0][0].endswith("ON CONFLICT DO NOTHING")
+    assert [row[:2] for row in album_inserts[0][1]] == [("MPREb_a", "MPREb_a"), ("MPREb_b", "MPREb_b"),
+                                                        ("MPREb_single", "MPREb_single")]
+
+
+def test_artist_without_albums_loses_its_old_ones(monkeypatch):
+    db = RecordingDb(monkeypatch)
+    ytm_db_service.persistArtist(createArtist())
+    assert db.getQueries("DELETE FROM artist_albums") == [("DELETE FROM artist_albums WHERE artist_id = %s",
+                                                            ("UC_artist",))]
+    assert db.getQueries(INSERT_ARTIST_ALBUM) == [(INSERT_ARTIST_ALBUM, [])]
+
+
+def test_playlists_are_only_bumped_when_the_artist_json_changed(monkeypatch):
+    # a new artist isn't in any song's json yet
+    db = RecordingDb(monkeypatch, old_artist=None)
+    ytm_db_service.persistArtist(createArtist(thumbnail_id="thumb"))
+    assert db.bumped == []
+
+    db = RecordingDb(monkeypatch, old_artist=("Artist", "thumb"))
+    ytm_db_service.persistArtist(createArtist(thumbnail_id="thumb"))
+    assert db.bumped == []
+
+    for name, thumbnail_id in [("Renamed", "thumb"), ("Artist", "new_thumb")]:
+        db = RecordingDb(monkeypatch, old_artist=("Artist", "thumb"))
+        ytm_db_service.persistArtist(createArtist(name, thumbnail_id))
+        assert db.bumped == [{"artist_ids": ["UC_artist"]}]
+
+
+def test_page_albums_are_replaced_by_their_db_version(monkeypatch):
+    db_album = createAlbum("MPREb_a", "from the db")
+    requested = []
+
+    def getAlbums(album_ids):
+        requested.append(album_ids)
+        return [db_album]
+
+    monkeypatch.setattr(cache_service, "getAlbums", getAlbums)
+    page_albums = [createAlbum("MPREb_b"), createAlbum("MPREb_a")]
+    page_singles = [createAlbum("MPREb_single")]
+    artist = createArtist()
+    CachedArtist.getAlbumsFromDbAndMerge(artist, page_albums, page_singles)
+
+    assert requested == [["MPREb_b", "MPREb_a", "MPREb_single"]]
+    assert artist.albums == [page_albums[0], db_album]
+    assert artist.singles == page_singles
+
+
+def test_artist_from_db_keeps_the_page_order(monkeypatch):
+    albums = {album_id: createAlbum(album_id) for album_id in ["MPREb_a", "MPREb_b", "MPREb_single"]}
+    artist_albums = [("MPREb_b", False), ("MPREb_single", True), ("MPREb_missing", False), ("MPREb_a", False)]
+    monkeypatch.setattr(cache_service, "executeSQLFetchOne",
+                        lambda query, data: ("UC_artist", "Artist", None, None, "1M", None, None))
+    monkeypatch.setattr(cache_service, "executeSQLFetchAll", lambda query, data: artist_albums)
+    # in a different order than the artist's page
+    monkeypatch.setattr(cache_service, "getAlbums", lambda album_ids: sorted(
+        [albums[album_id] for album_id in album_ids if album_id in albums], key=lambda a: a.album_id))
+
+    artist = CachedArtist().getDataFromDb("UC_artist", None)
+    assert artist.views == "1M"
+    # albums that aren't in the db anymore are skipped
+    assert artist.albums == [albums["MPREb_b"], albums["MPREb_a"]]
+    assert artist.singles == [albums["MPREb_single"]]
+
+
+def test_artist_that_isnt_in_the_db(monkeypatch):
+    monkeypatch.setattr(cache_service, "executeSQLFetchOne", lambda query, data: None)
+    assert CachedArtist().getDataFromDb("UC_artist", None) is None
@@ -0,0 +1,69 @@
+import pytest
+
+from cache import cache_service
+from cache.memory_cache import MemoryCache
+from db import data_models as dm
+from db import ytm_db_service
+
+# lowercase name -> id of the artists in the fake db
+ARTISTS_IN_DB = {"known artist": "UC_known"}
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    """
+    :return: the names given to every getArtistIdsByName call
+    """
+    lookups = []
+
+    def getArtistIdsByName(names):
+        lookups.append(sorted(names))
+        return {name: ARTISTS_IN_DB[name] for name in names if name in ARTISTS_IN_DB}
+
+    monkeypatch.setattr(dm, "artist_ids_by_name", MemoryCache(100))
+    monkeypatch.setattr(ytm_db_service, "getArtistIdsByName", getArtistIdsByName)
+    return lookups
+
+
+def test_unresolved_names_are_the_artists_without_an_id():
+    song_jsons = [{"artists": [{"name": "With Id", "id": "UC_1"}, {"name": "Without Id", "id": None}]},
+                  {"artists": ["Bare String"]},
+                  {"artists": "Whole String"},
+                  {"artists": None},
+                  {}]
+    assert dm.getUnresolvedArtistNames(song_jsons) == {"Without Id", "Bare String", "Whole String"}
+
+
+def test_names_are_resolved_in_one_lookup_and_then_from_memory(lookups):
+    artist_ids = dm.resolveArtistIds(["Known Artist", " known artist ", "New Artist", "", None])
+    assert lookups == [["known artist", "new artist"]]
+    assert artist_ids["known artist"] == "UC_known"
+    assert artist_ids["new artist"].startswith("generated_")
+
+    # a generated id is remembered, so every song by the artist gets the same one
+    assert dm.resolveArtistIds(["NEW ARTIST", "Known Artist"]) == artist_ids
+    assert len(lookups) == 1
+
+
+def test_songs_by_the_same_unknown_artist_share_an_id(lookups, monkeypatch):
+    def getArtist(*args, **kwargs):
+        raise AssertionError("the artist's page shouldn't be fetched")
+
+    monkeypatch.setattr(cache_service, "getArtist", getArtist)
+    track_jsons = [{"videoId": f"video{i}", "title": f"Song {i}", "artists": "New Artist"} for i in range(3)] + \
+                  [{"videoId": "video3", "title": "Song 3", "artists": [{"name": "Known Artist", "id": None}]}]
+    dm.resolveArtistIds(dm.getUnresolvedArtistNames(track_jsons))
+    songs = [dm.Song.from_json(track_json) for track_json in track_jsons]
+
+    assert len(lookups) == 1
+    artist_ids = [song.artists[0].artist_id for song in songs]
+    assert artist_ids[0].startswith("generated_")
+    assert artist_ids == [artist_ids[0]] * 3 + ["UC_known"]
+
+
+def test_album_artists_are_used_for_bare_string_track_artists(lookups):
+    album_artist = dm.Artist("UC_album_artist", "Album Artist", None)
+    song = dm.Song.from_json({"videoId": "video", "artists": "Album Artist"},
+                             album_artists={"Album Artist": album_artist})
+    assert song.artists == [album_artist]
+    assert lookups == []
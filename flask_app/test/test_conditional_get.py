@@ -0,0 +1,42 @@
+from flask_app.flask_app import app, cachedDataResponse
+
+
+class ResponseCounter:
+    def __init__(self):
+        self.calls = 0
+
+    def getResponse(self):
+        self.calls += 1
+        return '{"title": "playlist"}', 200, {'ContentType': 'application/json'}
+
+
+def test_matching_etag_returns_not_modified_without_creating_the_response():
+    counter = ResponseCounter()
+    with app.test_request_context(headers={"If-None-Match": 'W/"1700000000-3"'}):
+        app.preprocess_request()
+        resp = cachedDataResponse((1700000000, 3), counter.getResponse)
+    assert resp.status_code == 304
+    assert counter.calls == 0
+    assert resp.headers["ETag"] == 'W/"1700000000-3"'
+
+
+def test_changed_data_returns_the_response_with_validators():
+    counter = ResponseCounter()
+    with app.test_request_context(headers={"If-None-Match": 'W/"1700000000-2"'}):
+        app.preprocess_request()
+        resp = cachedDataResponse((1700000000, 3), counter.getResponse)
+    assert resp.status_code == 200
+    assert counter.calls == 1
+    assert resp.get_data(as_text=True) == '{"title": "playlist"}'
+    assert resp.headers["ETag"] == 'W/"1700000000-3"'
+    assert resp.headers["Last-Modified"] == "Tue, 14 Nov 2023 22:13:20 GMT"
+    assert resp.headers["Cache-Control"] == "no-cache"
+
+
+def test_expired_data_has_no_etag():
+    counter = ResponseCounter()
+    with app.test_request_context(headers={"If-None-Match": "*"}):
+        app.preprocess_request()
+        resp = cachedDataResponse(None, counter.getResponse)
+    assert resp.status_code == 200
+    assert "ETag" not in resp.headers
@@ -0,0 +1,104 @@
+import pytest
+from psycopg2 import OperationalError
+
+from cache import cache_service  # imported before db, to avoid a circular import
+from benchmark.fake_db import installFakePool
+from db import db_service
+from db.db_service import beforeCommit, executeSQL, executeSQLFetchIter, inTransaction, transaction
+
+
+@pytest.fixture
+def pool():
+    real_pool = db_service.db_conn_pool
+    yield installFakePool(lambda query, data: [(query,)])
+    db_service.db_conn_pool = real_pool
+
+
+def failingResponder(query, data):
+    raise OperationalError("server closed the connection unexpectedly")
+
+
+def test_transaction_commits_once_on_one_connection(pool):
+    with transaction():
+        executeSQL("DELETE a")
+        executeSQL("INSERT b")
+        assert inTransaction()
+    assert pool.queries == ["DELETE a", "INSERT b"]
+    assert pool.commits == 1
+    assert pool.checkouts == 1
+    assert not inTransaction()
+
+
+def test_transaction_is_rolled_back_on_an_exception(pool):
+    with pytest.raises(ValueError):
+        with transaction():
+            executeSQL("DELETE a")
+            raise ValueError()
+    assert pool.commits == 0
+    assert pool.rollbacks == 1
+    assert not inTransaction()
+
+
+def test_nested_block_is_rolled_back_to_its_savepoint(pool):
+    with transaction():
+        executeSQL("DELETE a")
+        with pytest.raises(ValueError):
+            with transaction():
+                executeSQL("INSERT b")
+                raise ValueError()
+        executeSQL("INSERT c")
+    assert pool.queries == ["DELETE a", "SAVEPOINT savepoint_1", "INSERT b", "ROLLBACK TO SAVEPOINT savepoint_1",
+                            "INSERT c"]
+    assert pool.commits == 1
+    assert pool.rollbacks == 0
+
+
+def test_before_commit_runs_once_at_the_end_unless_rolled_back(pool):
+    def bump():
+        executeSQL("UPDATE version")
+
+    def skipped():
+        executeSQL("UPDATE skipped")
+
+    with transaction():
+        beforeCommit(bump)
+        executeSQL("INSERT a")
+        beforeCommit(bump)
+        with pytest.raises(ValueError):
+            with transaction():
+                beforeCommit(skipped)
+                raise ValueError()
+    assert pool.queries == ["INSERT a", "SAVEPOINT savepoint_1", "ROLLBACK TO SAVEPOINT savepoint_1",
+                            "UPDATE version"]
+    assert pool.commits == 1
+
+    pool.reset()
+    beforeCommit(bump)
+    assert pool.queries == ["UPDATE version"]
+
+
+def test_failed_statement_is_only_retried_outside_a_transaction(pool):
+    pool.responder = failingResponder
+    with pytest.raises(OperationalError):
+        executeSQL("INSERT a")
+    assert pool.queries == ["INSERT a", "INSERT a"]
+
+    pool.reset()
+    with pytest.raises(OperationalError):
+        with transaction():
+            executeSQL("INSERT a")
+    assert pool.queries == ["INSERT a"]
+    assert pool.rollbacks == 1
+
+
+def test_fetch_iter_has_its_own_connection_and_transaction(pool):
+    rows = executeSQLFetchIter("SELECT a", None)
+    assert next(rows) == ("SELECT a",)
+    assert not inTransaction()
+    # runs and commits on its own, while the rows are being read
+    executeSQL("INSERT b")
+    assert pool.commits == 1
+    assert pool.checkouts == 2
+
+    rows.close()
+    assert pool.rollbacks == 1
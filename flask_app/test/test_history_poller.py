@@ -0,0 +1,129 @@
+from types import SimpleNamespace
+
+from cache import cache_service  # imported before db, to avoid a circular import
+from cache.history_poller import HistoryPoller
+from db import listening_history
+
+SONG_SECONDS = 200
+
+
+class FakeClock:
+    def __init__(self, now=0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class FakeListeningStream:
+    """
+    Pretends to be YTM while songs are being played: get_history returns the last 200 songs played before the current
+    time (most recent first). A song that's played again is moved to the top.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        # (timestamp, video id) in the order they were played
+        self.plays = []
+        self.calls = 0
+
+    def listen(self, start, video_ids):
+        self.plays += [(start + n * SONG_SECONDS, video_id) for n, video_id in enumerate(video_ids)]
+
+    def get_history(self):
+        self.calls += 1
+        history = []
+        for timestamp, video_id in reversed(self.plays):
+            if timestamp <= self.clock.now and video_id not in history:
+                history.append(video_id)
+        return [{"videoId": video_id, "duration": "3:20"} for video_id in history[:200]]
+
+
+class FakeHistoryDb:
+    """
+    Persists history the same way as listening_history.persistHistory, in a list of (video id, timestamp)
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        # most recent first
+        self.plays = []
+        self.calls = 0
+
+    def persist_history(self, history_json, not_before):
+        self.calls += 1
+        history_items = [SimpleNamespace(video_id=s["videoId"], duration=s["duration"]) for s in history_json]
+        new_history = listening_history.findHistoryNotYetInDb(history_items, [video_id for video_id, _ in self.plays])
+        known_timestamps = [t for t in [self.plays[0][1] if self.plays else None, not_before] if t is not None]
+        timestamps = listening_history.estimateListenTimestamps(new_history, max(known_timestamps, default=None),
+                                                                self.clock.now)
+        self.plays = [(s.video_id, t) for s, t in zip(new_history, timestamps)] + self.plays
+        return new_history
+
+
+def runPoller(poller, clock, until):
+    intervals = []
+    while clock.now < until:
+        poller.poll()
+        intervals.append(poller.interval)
+        clock.now += poller.interval
+    return intervals
+
+
+def test_every_play_is_saved_once_with_close_timestamps():
+    clock = FakeClock(now=100000)
+    stream = FakeListeningStream(clock)
+    db = FakeHistoryDb(clock)
+    # two listening sessions with a few quiet hours between them. Some songs are played in both
+    first_session = [f"song{n}" for n in range(60)]
+    second_session = [f"song{n}" for n in range(50, 110)]
+    stream.listen(clock.now + 600, first_session)
+    stream.listen(clock.now + 30000, second_session)
+    poller = HistoryPoller(stream.get_history, db.persist_history, clock=clock.time)
+
+    runPoller(poller, clock, until=clock.now + 50000)
+
+    assert [video_id for video_id, _ in reversed(db.plays)] == first_session + second_session
+    for (video_id, saved_timestamp), (played_timestamp, _) in zip(reversed(db.plays), stream.plays):
+        assert abs(saved_timestamp - played_timestamp) <= 5 * 60
+        assert saved_timestamp % 60 == 0
+
+
+def test_interval_adapts_to_the_play_rate():
+    clock = FakeClock(now=100000)
+    stream = FakeListeningStream(clock)
+    db = FakeHistoryDb(clock)
+    stream.listen(clock.now + 3600, [f"song{n}" for n in range(100)])
+    session_end = clock.now + 3600 + 100 * SONG_SECONDS
+    poller = HistoryPoller(stream.get_history, db.persist_history, clock=clock.time, min_interval=60,
+                           max_interval=1800)
+
+    intervals = []
+    while clock.now < session_end + 4 * 3600:
+        poller.poll()
+        intervals.append((clock.now, poller.interval))
+        clock.now += poller.interval
+
+    before = [interval for now, interval in intervals if now < 100000 + 3000]
+    during = [interval for now, interval in intervals if 100000 + 2 * 3600 < now < session_end - 600]
+    after = [interval for now, interval in intervals if now > session_end + 3 * 3600]
+    # nothing is played: check as little as possible
+    assert before[-1] == 1800 and after[-1] == 1800
+    # about TARGET_PLAYS_PER_POLL songs between checks
+    assert all(300 <= interval <= 500 for interval in during)
+    # the history only changed on some of the checks, and the others didn't persist anything
+    assert db.calls < stream.calls
+    assert len(db.plays) == 100
+
+
+def test_unchanged_history_isnt_persisted():
+    clock = FakeClock(now=100000)
+    stream = FakeListeningStream(clock)
+    db = FakeHistoryDb(clock)
+    stream.listen(0, ["song1", "song2"])
+    poller = HistoryPoller(stream.get_history, db.persist_history, clock=clock.time)
+
+    assert poller.poll() == 2
+    clock.now += poller.interval
+    assert poller.poll() == 0
+    assert (stream.calls, db.calls) == (2, 1)
@@ -0,0 +1,29 @@
+import os
+
+from PIL import Image
+
+from cache import image_cache
+
+
+def test_resized_images_are_created_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_cache, "IMAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(image_cache, "RESIZED_IMAGE_DIR", str(tmp_path / "resized"))
+    Image.new("RGB", (544, 300)).save(tmp_path / "original.png")
+
+    resized = image_cache.getResizedImage("original.png", 60)
+    with Image.open(resized.filepath) as img:
+        assert img.size == (60, 33)
+    assert resized.etag == image_cache.getResizedImageEtag("original.png", 60)
+
+    mtime = os.path.getmtime(resized.filepath)
+    assert image_cache.getResizedImage("original.png", 60).filepath == resized.filepath
+    assert os.path.getmtime(resized.filepath) == mtime
+
+    # a copy of the same image shares the resized file
+    (tmp_path / "copy.png").write_bytes((tmp_path / "original.png").read_bytes())
+    assert image_cache.getResizedImage("copy.png", 60).filepath == resized.filepath
+
+
+def test_invalid_image_names():
+    assert image_cache.getResizedImage("../flask_app.py", 60) is None
+    assert image_cache.getResizedImageEtag("not_downloaded.png", 60) is None
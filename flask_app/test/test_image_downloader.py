@@ -0,0 +1,69 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from cache import cache_service  # imported before db, to avoid a circular import
+from cache import image_downloader
+
+
+class FakeResponse:
+    """
+    A streamed response that fails after its first block
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield b"first block"
+        raise ConnectionError("Connection reset by peer")
+
+
+class FakeSession:
+    def get(self, url, stream, timeout):
+        return FakeResponse()
+
+
+def test_failed_download_leaves_no_partial_file(tmp_path):
+    thumbnail = SimpleNamespace(url="https://lh3.googleusercontent.com/abc=w120-h120-l90-rj")
+    with pytest.raises(ConnectionError):
+        image_downloader.downloadImage(FakeSession(), thumbnail, str(tmp_path))
+    assert os.listdir(tmp_path) == []
+
+
+def test_only_playlists_using_the_downloaded_thumbnails_are_bumped(monkeypatch, tmp_path):
+    thumbnails = [SimpleNamespace(thumbnail_id=thumbnail_id, url=f"https://lh3.googleusercontent.com/{thumbnail_id}=",
+                                  size=size)
+                  for thumbnail_id, size in [("album1", 60), ("album1", 200), ("artist1", 60), ("broken", 60)]]
+
+    def downloadImage(session, thumbnail, image_dir):
+        if thumbnail.thumbnail_id == "broken":
+            raise ConnectionError()
+        return f"{thumbnail.thumbnail_id}.png", 10
+
+    bumped = []
+    monkeypatch.setattr(image_downloader, "getThumbnailsToDownload", lambda: thumbnails)
+    monkeypatch.setattr(image_downloader, "downloadImage", downloadImage)
+    monkeypatch.setattr(image_downloader, "markImagesDownloaded", lambda downloaded: None)
+    monkeypatch.setattr(image_downloader, "bumpPlaylistVersions", lambda **kwargs: bumped.append(kwargs))
+
+    summary = image_downloader.downloadImages(str(tmp_path), num_workers=2)
+    assert (summary.downloaded, summary.failed) == (3, 1)
+    assert bumped == [{"thumbnail_ids": {"album1", "artist1"}}]
+
+
+def test_nothing_is_bumped_when_nothing_was_downloaded(monkeypatch, tmp_path):
+    bumped = []
+    monkeypatch.setattr(image_downloader, "getThumbnailsToDownload", lambda: [])
+    monkeypatch.setattr(image_downloader, "markImagesDownloaded", lambda downloaded: None)
+    monkeypatch.setattr(image_downloader, "bumpPlaylistVersions", lambda **kwargs: bumped.append(kwargs))
+
+    image_downloader.downloadImages(str(tmp_path))
+    assert bumped == []
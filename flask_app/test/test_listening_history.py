@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+from cache import cache_service  # imported before db, to avoid a circular import
+from db import listening_history
+
+
+def createHistory(song_ids, duration="3:00"):
+    return [SimpleNamespace(video_id=song_id, duration=duration) for song_id in song_ids]
+
+
+def getIds(songs):
+    return [song.video_id for song in songs]
+
+
+def test_new_plays_are_the_songs_before_the_stored_history():
+    history = createHistory(["e", "d", "a", "b", "c"])
+    assert getIds(listening_history.findHistoryNotYetInDb(history, ["a", "b", "c"])) == ["e", "d"]
+
+
+def test_no_new_plays():
+    history = createHistory(["a", "b", "c", "d"])
+    assert listening_history.findHistoryNotYetInDb(history, ["a", "b", "c", "d"]) == []
+
+
+def test_songs_played_again_are_moved_to_the_top():
+    # b was played again, so YTM removed it from its old spot
+    history = createHistory(["b", "x", "a", "c", "d"])
+    new_history = listening_history.findHistoryNotYetInDb(history, ["a", "b", "c", "d"])
+    assert getIds(new_history) == ["b", "x"]
+
+
+def test_repeated_plays_in_the_db_are_only_matched_once():
+    history = createHistory(["x", "a", "b", "c"])
+    assert getIds(listening_history.findHistoryNotYetInDb(history, ["a", "b", "a", "c", "b"])) == ["x"]
+
+
+def test_every_song_is_new_without_an_overlap():
+    history = createHistory(["x", "y", "z"])
+    assert getIds(listening_history.findHistoryNotYetInDb(history, ["a", "b", "c"])) == ["x", "y", "z"]
+    assert getIds(listening_history.findHistoryNotYetInDb(history, [])) == ["x", "y", "z"]
+
+
+def test_timestamps_go_back_from_now_by_song_length():
+    history = createHistory(["c", "b", "a"]) + [SimpleNamespace(video_id="d", duration=None)]
+    # rounded down to the minute
+    assert listening_history.estimateListenTimestamps(history, None, 10000) == [9960, 9780, 9600, 9420]
+    # never before the minute of the most recent play in the db
+    assert listening_history.estimateListenTimestamps(history, 9700, 10000) == [9960, 9780, 9660, 9660]
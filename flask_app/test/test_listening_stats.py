@@ -0,0 +1,69 @@
+from datetime import date, datetime
+from types import SimpleNamespace
+
+import pytest
+
+from cache import cache_service  # imported before db, to avoid a circular import
+from benchmark.fake_db import FakeConnectionPool
+from db import db_service, listening_stats
+
+
+def createSong(song_id, artist_ids, album_id="album1", duration="3:00"):
+    artists = [SimpleNamespace(artist_id=artist_id) for artist_id in artist_ids]
+    return SimpleNamespace(video_id=song_id, artists=artists, album_id=album_id, duration=duration)
+
+
+def test_period_start():
+    # a thursday
+    day = date(2024, 3, 14)
+    assert listening_stats.getPeriodStart("day", day) == day
+    assert listening_stats.getPeriodStart("week", day) == date(2024, 3, 11)
+    assert listening_stats.getPeriodStart("month", day) == date(2024, 3, 1)
+    with pytest.raises(ValueError):
+        listening_stats.getPeriodStart("year", day)
+
+
+def test_song_seconds():
+    assert listening_stats.getSongSeconds(createSong("s", [], duration="3:30")) == 210
+    assert listening_stats.getSongSeconds(createSong("s", [], duration="1:02:03")) == 3723
+    assert listening_stats.getSongSeconds(createSong("s", [], duration=None)) == listening_stats.DEFAULT_SONG_SECONDS
+
+
+def test_rollup_adds_up_plays_for_each_period():
+    thursday = datetime(2024, 3, 14, 12).timestamp()
+    friday = datetime(2024, 3, 15, 12).timestamp()
+    song1 = createSong("song1", ["artist1", "artist2"])
+    song2 = createSong("song2", ["artist1", None], album_id=None, duration="2:00")
+    stats = listening_stats.rollupPlays([(song1, thursday), (song1, friday), (song2, friday)])
+
+    week = date(2024, 3, 11)
+    assert stats[("week", week, "song", "song1")] == [2, 360]
+    assert stats[("week", week, "artist", "artist1")] == [3, 480]
+    assert stats[("week", week, "artist", "artist2")] == [2, 360]
+    assert stats[("week", week, "album", "album1")] == [2, 360]
+    assert stats[("week", week, "total", "")] == [3, 480]
+    assert stats[("day", date(2024, 3, 14), "total", "")] == [1, 180]
+    assert stats[("day", date(2024, 3, 15), "song", "song2")] == [1, 120]
+    assert stats[("month", date(2024, 3, 1), "total", "")] == [3, 480]
+    # artists without an id, and songs without an album, aren't counted
+    assert not [key for key in stats if key[3] is None]
+
+
+def test_rebuild_rolls_up_the_history_one_chunk_at_a_time(monkeypatch):
+    rows_read = []
+
+    def fetchHistory(query, data, itersize):
+        for n in range(5):
+            rows_read.append(n)
+            yield f"song{n % 2}", datetime(2024, 3, 14, 12).timestamp()
+
+    chunks = []
+    monkeypatch.setattr(db_service, "db_conn_pool", FakeConnectionPool())
+    monkeypatch.setattr(listening_stats, "REBUILD_CHUNK_SIZE", 2)
+    monkeypatch.setattr(listening_stats, "executeSQLFetchIter", fetchHistory)
+    monkeypatch.setattr(listening_stats, "getSongsFromDb",
+                        lambda song_id, **kwargs: [createSong(s, ["artist1"]) for s in song_id])
+    monkeypatch.setattr(listening_stats, "persistPlays", lambda plays: chunks.append((len(rows_read), len(plays))))
+    listening_stats.rebuildListeningStats()
+    # (rows read from the db so far, plays rolled up): each chunk is rolled up before the next one is read
+    assert chunks == [(2, 2), (4, 2), (5, 1)]
@@ -0,0 +1,59 @@
+from cache.memory_cache import MemoryCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_least_recently_used_is_evicted():
+    cache = MemoryCache(max_weight=2)
+    cache.put("a", 1, ttl=60)
+    cache.put("b", 2, ttl=60)
+    # use "a" so "b" is the least recently used
+    assert cache.get("a") == 1
+    cache.put("c", 3, ttl=60)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.getStats()["evictions"] == 1
+
+
+def test_entries_expire():
+    clock = FakeClock()
+    cache = MemoryCache(max_weight=10, clock=clock)
+    cache.put("a", 1, ttl=60)
+    clock.now = 59
+    assert cache.get("a") == 1
+    clock.now = 60
+    assert cache.get("a") is None
+    stats = cache.getStats()
+    assert stats["expirations"] == 1
+    assert stats["entries"] == 0
+
+
+def test_eviction_uses_weight():
+    cache = MemoryCache(max_weight=10, weigher=len)
+    cache.put("small", [1, 2], ttl=60)
+    cache.put("big", list(range(9)), ttl=60)
+    assert cache.get("small") is None
+    assert cache.getStats()["weight"] == 9
+    # values heavier than the whole cache are never stored
+    cache.put("too big", list(range(11)), ttl=60)
+    assert cache.get("too big") is None
+    assert cache.get("big") is not None
+
+
+def test_invalidate_where():
+    cache = MemoryCache(max_weight=10)
+    cache.put(("playlist", "a"), 1, ttl=60)
+    cache.put(("playlist", "b"), 2, ttl=60)
+    cache.put(("album", "a"), 3, ttl=60)
+    cache.invalidateWhere(lambda key: key[0] == "playlist")
+    assert cache.get(("playlist", "a")) is None
+    assert cache.get(("playlist", "b")) is None
+    assert cache.get(("album", "a")) == 3
+    assert cache.getStats()["invalidations"] == 2
@@ -0,0 +1,68 @@
+import pytest
+
+from cache import cache_service
+from cache.cache_service import CachedData, DataType
+
+
+class FakeNotFoundCache(CachedData):
+    """
+    An album cache whose YTM always returns 404. The not found entries are kept in a set instead of data_cache
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.data_type = DataType.ALBUM
+        self.use_memory_cache = False
+        self.coordinate_fetches = False
+        self.ytm_calls = 0
+        self.not_found = set()
+        self.removed_from_db = []
+
+    def getValidator(self, item_id):
+        return None,
+
+    def getNotFoundIds(self, item_ids):
+        return {item_id for item_id in item_ids if item_id in self.not_found}
+
+    def persistNotFound(self, item_id):
+        self.not_found.add(item_id)
+        self.onNotFound(item_id)
+
+    def onNotFound(self, item_id):
+        self.removed_from_db.append(item_id)
+
+    def updateCache(self, item_id, data_type=None):
+        pass
+
+    def getDataFromYTM(self, data_id, extra_data):
+        self.ytm_calls += 1
+        raise Exception("Server returned HTTP 404: Not Found.")
+
+
+def test_404_is_only_requested_from_ytm_once():
+    cache = FakeNotFoundCache()
+    avoided_before = cache_service.not_found_stats["avoidedYtmFetches"]
+
+    assert cache.getData("dead_album", ignore_cache=False, get_json=True) is None
+    assert cache.getData("dead_album", ignore_cache=False, get_json=True) is None
+    assert cache.getData("dead_album", ignore_cache=True, do_additional_processing=True) is None
+
+    assert cache.ytm_calls == 1
+    assert cache.removed_from_db == ["dead_album"]
+    assert cache_service.not_found_stats["avoidedYtmFetches"] - avoided_before == 2
+
+
+class FakeFailingCache(FakeNotFoundCache):
+    def getDataFromYTM(self, data_id, extra_data):
+        self.ytm_calls += 1
+        raise Exception("Server returned HTTP 500: Internal Server Error.")
+
+
+def test_other_errors_arent_cached_as_not_found():
+    cache = FakeFailingCache()
+    with pytest.raises(Exception, match="HTTP 500"):
+        cache.getData("album", ignore_cache=False)
+    with pytest.raises(Exception, match="HTTP 500"):
+        cache.getData("album", ignore_cache=False)
+    assert cache.ytm_calls == 2
+    assert not cache.not_found
@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+from cache import cache_service  # imported before db, to avoid a circular import
+from db.ytm_db_service import diffPlaylistSongs
+
+
+def createSong(video_id, set_video_id, index):
+    return SimpleNamespace(video_id=video_id, set_video_id=set_video_id, index=index)
+
+
+def createPlaylist(*songs):
+    """
+    :param songs: (video_id, set_video_id) for each song, in playlist order
+    :return:
+    """
+    return [createSong(video_id, set_video_id, index) for index, (video_id, set_video_id) in enumerate(songs)]
+
+
+def getKeys(songs):
+    return [(song.video_id, song.set_video_id) for song in songs]
+
+
+def test_empty_playlist_in_the_db():
+    new_songs = createPlaylist(("a", "set_a"), ("b", "set_b"))
+    songs_to_delete, songs_to_add, index_updates = diffPlaylistSongs([], new_songs)
+    assert songs_to_delete == []
+    assert getKeys(songs_to_add) == [("a", "set_a"), ("b", "set_b")]
+    assert index_updates == []
+
+
+def test_every_song_was_removed():
+    existing_songs = createPlaylist(("a", "set_a"), ("b", "set_b"))
+    songs_to_delete, songs_to_add, index_updates = diffPlaylistSongs(existing_songs, [])
+    assert getKeys(songs_to_delete) == [("a", "set_a"), ("b", "set_b")]
+    assert songs_to_add == []
+    assert index_updates == []
+
+
+def test_unchanged_playlist():
+    songs = [("a", "set_a"), ("b", "set_b"), ("c", "set_c")]
+    assert diffPlaylistSongs(createPlaylist(*songs), createPlaylist(*songs)) == ([], [], [])
+
+
+def test_only_moved_songs_get_new_indices():
+    existing_songs = createPlaylist(("a", "set_a"), ("b", "set_b"), ("c", "set_c"), ("d", "set_d"))
+    new_songs = createPlaylist(("a", "set_a"), ("c", "set_c"), ("b", "set_b"), ("d", "set_d"))
+    songs_to_delete, songs_to_add, index_updates = diffPlaylistSongs(existing_songs, new_songs)
+    assert songs_to_delete == []
+    assert songs_to_add == []
+    assert sorted(index_updates) == [("set_b", 2), ("set_c", 1)]
+
+
+def test_duplicates_are_told_apart_by_set_video_id():
+    existing_songs = createPlaylist(("a", "set_a1"), ("b", "set_b"), ("a", "set_a2"))
+    # the first copy of a was removed, and another copy was added at the end
+    new_songs = createPlaylist(("b", "set_b"), ("a", "set_a2"), ("a", "set_a3"))
+    songs_to_delete, songs_to_add, index_updates = diffPlaylistSongs(existing_songs, new_songs)
+    assert getKeys(songs_to_delete) == [("a", "set_a1")]
+    assert getKeys(songs_to_add) == [("a", "set_a3")]
+    assert sorted(index_updates) == [("set_a2", 1), ("set_b", 0)]
+
+
+def test_set_video_id_used_for_a_different_song_is_replaced():
+    existing_songs = createPlaylist(("a", "set_1"))
+    new_songs = createPlaylist(("b", "set_1"))
+    songs_to_delete, songs_to_add, index_updates = diffPlaylistSongs(existing_songs, new_songs)
+    assert getKeys(songs_to_delete) == [("a", "set_1")]
+    assert getKeys(songs_to_add) == [("b", "set_1")]
+    assert index_updates == []
+
+
+def test_songs_without_set_video_id_are_keyed_by_video_id():
+    existing_songs = createPlaylist(("a", None), ("b", None))
+    new_songs = createPlaylist(("a", None), ("c", None))
+    songs_to_delete, songs_to_add, index_updates = diffPlaylistSongs(existing_songs, new_songs)
+    assert getKeys(songs_to_delete) == [("b", None)]
+    assert getKeys(songs_to_add) == [("c", None)]
+    assert index_updates == []
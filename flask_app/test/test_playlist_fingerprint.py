@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from cache import cache_service  # imported before db, to avoid a circular import
+from cache import update_cache
+from cache.sync_engine import RateLimiter, SyncStatus
+from db.data_models import getPlaylistFingerprint
+
+
+def createThumbnail(thumbnail_id):
+    return SimpleNamespace(thumbnail_id=thumbnail_id)
+
+
+def test_fingerprint_changes_with_the_track_count_and_thumbnail():
+    fingerprint = getPlaylistFingerprint({"count": 10}, createThumbnail("thumb"))
+    assert getPlaylistFingerprint({"count": 10, "title": "renamed"}, createThumbnail("thumb")) == fingerprint
+    assert getPlaylistFingerprint({"count": 11}, createThumbnail("thumb")) != fingerprint
+    # YTM creates the thumbnail from the first songs, so it changes when they do
+    assert getPlaylistFingerprint({"count": 10}, createThumbnail("other_thumb")) != fingerprint
+
+
+def test_fingerprint_without_a_thumbnail():
+    assert getPlaylistFingerprint({"count": 0}, None) == getPlaylistFingerprint({"count": 0}, None)
+    assert getPlaylistFingerprint({"count": 0}, None) != getPlaylistFingerprint({"count": 1}, None)
+
+
+def test_no_fingerprint_without_a_track_count():
+    # the playlist is always synced
+    assert getPlaylistFingerprint({}, createThumbnail("thumb")) is None
+
+
+def test_only_playlists_whose_fingerprint_changed_are_synced(monkeypatch):
+    playlists = [SimpleNamespace(playlist_id=playlist_id) for playlist_id in ["PL1", "PL2", "PL3", "LM"]]
+    synced = []
+    requested_after = []
+
+    def getUnchangedPlaylistIds(synced_after):
+        requested_after.append(synced_after)
+        return {"PL2", "LM"}
+
+    def syncPlaylist(playlist_id):
+        synced.append(playlist_id)
+        return playlist_id == "PL1"
+
+    monkeypatch.setattr(update_cache, "getAllPlaylists", lambda ignore_cache, get_json: playlists)
+    monkeypatch.setattr(update_cache, "getUnchangedPlaylistIds", getUnchangedPlaylistIds)
+    monkeypatch.setattr(update_cache, "syncPlaylist", syncPlaylist)
+    monkeypatch.setattr(update_cache, "ytm_rate_limiter", RateLimiter(1000, burst=10))
+
+    summary = update_cache.updatePlaylists(num_workers=2)
+    # liked songs (LM) is never synced
+    assert sorted(synced) == ["PL1", "PL3"]
+    # PL2 was skipped, PL3 was synced but nothing changed
+    assert sorted(r.item_id for r in summary.getResults(SyncStatus.UNCHANGED)) == ["PL2", "PL3"]
+    assert [r.item_id for r in summary.getResults(SyncStatus.FETCHED)] == ["PL1"]
+    # playlists that haven't been synced for FULL_SYNC_MAX_AGE_DAYS aren't skipped
+    expected_after = datetime.now() - timedelta(days=update_cache.FULL_SYNC_MAX_AGE_DAYS)
+    assert abs(requested_after[0] - expected_after.timestamp()) < 60
+
+
+def test_single_playlist_is_synced_without_checking_its_fingerprint(monkeypatch):
+    synced = []
+    monkeypatch.setattr(update_cache, "getAllPlaylists", None)
+    monkeypatch.setattr(update_cache, "getUnchangedPlaylistIds", None)
+    monkeypatch.setattr(update_cache, "syncPlaylist", lambda playlist_id: synced.append(playlist_id))
+    monkeypatch.setattr(update_cache, "ytm_rate_limiter", RateLimiter(1000, burst=10))
+
+    update_cache.updatePlaylists("PL2")
+    assert synced == ["PL2"]
@@ -0,0 +1,39 @@
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from flask_app.flask_app import getPageArgs
+from cache import cache_service
+
+
+def createPlaylistJson(num_songs):
+    tracks = [{"videoId": f"video{i % 3}", "index": i, "isDupe": i >= 3} for i in range(num_songs)]
+    return {"id": "PL1", "numSongs": num_songs, "tracks": tracks}
+
+
+def test_pages_by_after_index_cover_the_playlist_once():
+    playlist_json = createPlaylistJson(7)
+    tracks, after_index = [], None
+    while True:
+        page = cache_service.getPlaylistPage(playlist_json, limit=3, after_index=after_index)
+        assert page["numSongs"] == 7
+        tracks += page["tracks"]
+        after_index = page["nextAfterIndex"]
+        if after_index is None:
+            break
+    assert tracks == playlist_json["tracks"]
+
+
+def test_page_by_offset_keeps_duplicate_flags():
+    page = cache_service.getPlaylistPage(createPlaylistJson(7), offset=3, limit=2)
+    assert [t["index"] for t in page["tracks"]] == [3, 4]
+    assert all(t["isDupe"] for t in page["tracks"])
+    assert page["nextAfterIndex"] == 4
+
+
+def test_page_args():
+    assert getPageArgs(MultiDict()) == (0, None, None)
+    assert getPageArgs(MultiDict({"offset": "10", "limit": "50", "afterIndex": "99"})) == (10, 50, 99)
+    assert not cache_service.isPageRequest(*getPageArgs(MultiDict()))
+    for args in [{"limit": "0"}, {"offset": "-1"}, {"afterIndex": "abc"}]:
+        with pytest.raises(ValueError):
+            getPageArgs(MultiDict(args))
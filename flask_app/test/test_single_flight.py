@@ -0,0 +1,40 @@
+import threading
+import time
+
+import pytest
+
+from cache.single_flight import SingleFlight
+
+
+def test_concurrent_calls_share_one_result():
+    flight = SingleFlight()
+    calls = []
+
+    def slowFetch():
+        calls.append(1)
+        time.sleep(0.2)
+        return "data"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("key", slowFetch))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == ["data"] * 5
+    assert flight.shared == 4
+    assert not flight.isRunning("key")
+
+
+def test_exception_is_shared_and_not_cached():
+    flight = SingleFlight()
+
+    def failingFetch():
+        raise Exception("404")
+
+    with pytest.raises(Exception, match="404"):
+        flight.do("key", failingFetch)
+    # the next call runs again
+    assert flight.do("key", lambda: "data") == "data"
@@ -0,0 +1,40 @@
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from flask_app.flask_app import getFieldsArg
+from db import data_models as dm
+
+
+def createSong():
+    song = dm.Song(vid_id="video1", title="Song 1", artists=[dm.Artist("UC1", "Artist 1", None)], length="3:30",
+                   explicit=False, local=False, set_vid_id="set1", album_id=None, album_name=None, thumbnail_id=None,
+                   is_available=True, index=0)
+    song.playlists = [dm.SongInPlaylist(("video1", "set1", 0, "PL1", "Playlist 1"))]
+    return song
+
+
+def test_song_json_only_has_requested_fields():
+    song_json = createSong().to_json(fields={"title", "artists"})
+    assert set(song_json) == {"videoId", "title", "artists"}
+    assert song_json["artists"][0]["name"] == "Artist 1"
+
+
+def test_song_json_projection_matches_full_json():
+    full_json = createSong().to_json()
+    assert set(full_json) == set(dm.SONG_FIELDS)
+    for fields in [{"duration"}, {"playlists", "isDupe"}, set(dm.SONG_FIELDS)]:
+        assert createSong().to_json(fields=fields) == dm.projectSongJson(full_json, fields)
+
+
+def test_album_songs_only_have_requested_fields():
+    album = dm.Album("MPREb_1", "Album 1", None, songs=[createSong()])
+    album_json = album.to_json(fields={"title", "duration"})
+    assert album_json["title"] == "Album 1"
+    assert album_json["songs"] == [{"videoId": "video1", "title": "Song 1", "duration": "3:30"}]
+
+
+def test_fields_arg():
+    assert getFieldsArg(MultiDict()) is None
+    assert getFieldsArg(MultiDict({"fields": "title, artists,duration"})) == {"title", "artists", "duration"}
+    with pytest.raises(ValueError):
+        getFieldsArg(MultiDict({"fields": "title,lyrics"}))
@@ -0,0 +1,85 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from cache import cache_service
+from cache.cache_service import CachedData, DataType
+
+
+class FakeStaleCache(CachedData):
+    """
+    A playlist cache whose entry expired a day ago. Getting it from YTM blocks until `release` is set
+    """
+
+    def __init__(self, in_db=True):
+        super().__init__()
+        self.data_type = DataType.PLAYLIST
+        self.use_memory_cache = False
+        self.coordinate_fetches = False
+        self.in_db = in_db
+        self.release = threading.Event()
+        self.ytm_calls = 0
+
+    def getValidator(self, item_id):
+        expired_at = time.time() - (DataType.PLAYLIST.cache_time + 1) * 24 * 60 * 60
+        return expired_at, 1
+
+    def getNotFoundIds(self, item_ids):
+        return set()
+
+    def updateCache(self, item_id, data_type=None):
+        pass
+
+    def getDataFromDb(self, data_id, extra_data):
+        return SimpleNamespace(source="db") if self.in_db else None
+
+    def getDataFromYTM(self, data_id, extra_data):
+        self.ytm_calls += 1
+        self.release.wait(5)
+        return SimpleNamespace(source="ytm")
+
+
+def waitForRefreshes(cache, data_id):
+    deadline = time.monotonic() + 5
+    while (cache.data_type, data_id) in cache_service.refreshes_in_progress and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_stale_data_is_returned_without_waiting_for_ytm():
+    cache = FakeStaleCache()
+    start = time.monotonic()
+    data = cache.getData("stale_playlist", ignore_cache=False)
+    assert time.monotonic() - start < 1
+    assert data.source == "db"
+    assert data.is_stale
+
+    cache.release.set()
+    waitForRefreshes(cache, "stale_playlist")
+    assert cache.ytm_calls == 1
+
+
+def test_concurrent_stale_hits_start_one_refresh():
+    cache = FakeStaleCache()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.getData("busy_playlist", ignore_cache=False)))
+               for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [r.source for r in results] == ["db"] * 5
+    assert (DataType.PLAYLIST, "busy_playlist") in cache_service.refreshes_in_progress
+
+    cache.release.set()
+    waitForRefreshes(cache, "busy_playlist")
+    assert cache.ytm_calls == 1
+    assert not cache_service.refreshes_in_progress
+
+
+def test_stale_entry_missing_from_the_db_is_requested_from_ytm():
+    cache = FakeStaleCache(in_db=False)
+    cache.release.set()
+    data = cache.getData("deleted_playlist", ignore_cache=False)
+    assert data.source == "ytm"
+    assert not getattr(data, "is_stale", False)
+    assert cache.ytm_calls == 1
@@ -0,0 +1,121 @@
+import threading
+import time
+
+from cache.sync_engine import SyncEngine, RateLimiter, SyncStatus
+
+
+class FakeYTMClient:
+    """
+    Pretends to be YTM: every call takes `latency` seconds, and the first call for each id in `throttled_ids`
+    raises a 429
+    """
+
+    def __init__(self, latency, throttled_ids=(), missing_ids=(), changed_ids=()):
+        self.latency = latency
+        self.throttled_ids = set(throttled_ids)
+        self.missing_ids = set(missing_ids)
+        self.changed_ids = set(changed_ids)
+        self.lock = threading.Lock()
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+
+    def get_playlist(self, playlist_id):
+        with self.lock:
+            self.calls.append(playlist_id)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            throttled = playlist_id in self.throttled_ids
+            self.throttled_ids.discard(playlist_id)
+        try:
+            time.sleep(self.latency)
+            if throttled:
+                raise Exception("Server returned HTTP 429: Too Many Requests.")
+            if playlist_id in self.missing_ids:
+                raise Exception("Server returned HTTP 404: Not Found.")
+            return playlist_id in self.changed_ids
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_workers_sync_in_parallel_and_summarize():
+    ids = [f"PL{i}" for i in range(20)]
+    client = FakeYTMClient(latency=0.05, changed_ids=ids[:5], missing_ids=["PL7"])
+    engine = SyncEngine("playlists", client.get_playlist, RateLimiter(1000, burst=20), num_workers=5)
+
+    summary = engine.run(ids)
+
+    assert client.max_running == 5
+    # 20 calls that take 0.05s each, 5 at a time
+    assert summary.seconds < 0.5
+    assert (summary.fetched, summary.unchanged, summary.failed) == (5, 14, 1)
+    assert [r.item_id for r in summary.results] == ids
+    assert summary.getResults(SyncStatus.FAILED)[0].item_id == "PL7"
+    assert summary.to_json()["results"][0]["seconds"] >= 0.05
+
+
+def test_throttled_calls_are_retried():
+    ids = [f"PL{i}" for i in range(6)]
+    client = FakeYTMClient(latency=0.01, throttled_ids=["PL1", "PL4"])
+    limiter = RateLimiter(1000, burst=6)
+    engine = SyncEngine("playlists", client.get_playlist, limiter, num_workers=3, throttle_pause_seconds=0.05)
+
+    summary = engine.run(ids)
+
+    assert summary.failed == 0
+    assert summary.unchanged == 6
+    assert {r.item_id: r.attempts for r in summary.results if r.attempts > 1} == {"PL1": 2, "PL4": 2}
+    assert len(client.calls) == 8
+
+
+def test_gives_up_after_max_attempts():
+    client = FakeYTMClient(latency=0)
+
+    def alwaysThrottled(playlist_id):
+        client.get_playlist(playlist_id)
+        raise Exception("Server returned HTTP 429: Too Many Requests.")
+
+    engine = SyncEngine("playlists", alwaysThrottled, RateLimiter(1000, burst=1), max_attempts=3,
+                        throttle_pause_seconds=0.01)
+    summary = engine.run(["PL1"])
+    assert summary.failed == 1
+    assert summary.results[0].attempts == 3
+    assert len(client.calls) == 3
+
+
+def test_rate_limiter():
+    clock = FakeClock()
+    limiter = RateLimiter(2, burst=2, clock=clock.time, sleep=clock.sleep)
+
+    # the burst is allowed right away, then one request every half second
+    for _ in range(4):
+        limiter.acquire()
+    assert clock.now == 1
+
+    # after a pause no requests are allowed until it ends
+    limiter.pause(10)
+    limiter.acquire()
+    assert clock.now == 11.5
+
+
+def test_sync_func_can_return_a_status():
+    def syncAlbum(album_id):
+        return SyncStatus.NOT_FOUND if album_id == "dead" else True
+
+    summary = SyncEngine("albums", syncAlbum, RateLimiter(1000, burst=3)).run(["a", "dead", "b"])
+    assert (summary.fetched, summary.not_found, summary.failed) == (2, 1, 0)
+    assert summary.to_json()["notFound"] == 1
@@ -0,0 +1,93 @@
+import pytest
+
+from cache import cache_service
+from cache.memory_cache import MemoryCache
+from benchmark.fake_db import installFakePool
+from db import data_models as dm
+from db import db_service
+
+THUMBNAIL_A = "https://lh3.googleusercontent.com/a="
+THUMBNAIL_B = "https://lh3.googleusercontent.com/b="
+MISSING_THUMBNAIL = "https://lh3.googleusercontent.com/missing="
+
+# thumbnail_download rows: (thumbnail_id, downloaded, size, filepath)
+THUMBNAIL_ROWS = [
+    (THUMBNAIL_A, True, 60, "a_60.png"),
+    (THUMBNAIL_A, True, 120, "a_120.png"),
+    (THUMBNAIL_B, False, 60, None),
+]
+
+
+def selectThumbnails(query, data):
+    # ids are sent as a tuple of 1-tuples (see iterableToDbTuple)
+    id_tuples, *size = data
+    thumbnail_ids = {t[0] for t in id_tuples}
+    rows = [r for r in THUMBNAIL_ROWS if r[0] in thumbnail_ids and (not size or r[2] == size[0])]
+    return sorted(rows, key=lambda r: r[2])
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(cache_service, "thumbnail_index", MemoryCache(100))
+    real_pool = db_service.db_conn_pool
+    yield installFakePool(selectThumbnails)
+    db_service.db_conn_pool = real_pool
+
+
+def getById(thumbnails):
+    return {t.thumbnail_id: t for t in thumbnails}
+
+
+def test_thumbnails_are_resolved_in_one_query_and_then_from_the_index(pool):
+    thumbnails = getById(cache_service.getListOfThumbnails([THUMBNAIL_A, THUMBNAIL_B, THUMBNAIL_A], size=60))
+    assert len(pool.queries) == 1
+    assert thumbnails[THUMBNAIL_A].filepath == "a_60.png"
+    assert thumbnails[THUMBNAIL_B].downloaded is False
+
+    pool.reset()
+    assert getById(cache_service.getListOfThumbnails([THUMBNAIL_B, THUMBNAIL_A], size=60)) == thumbnails
+    assert cache_service.getThumbnail(THUMBNAIL_A, size=60) is thumbnails[THUMBNAIL_A]
+    assert pool.queries == []
+
+
+def test_only_the_thumbnails_that_arent_in_the_index_are_queried(pool):
+    cache_service.getThumbnail(THUMBNAIL_A, size=60)
+    requested_ids = []
+    pool.responder = lambda query, data: requested_ids.append(data[0]) or selectThumbnails(query, data)
+    thumbnails = getById(cache_service.getListOfThumbnails([THUMBNAIL_A, THUMBNAIL_B], size=60))
+    assert requested_ids == [((THUMBNAIL_B,),)]
+    assert set(thumbnails) == {THUMBNAIL_A, THUMBNAIL_B}
+
+
+def test_thumbnail_that_isnt_in_the_db_is_created_once(pool):
+    thumbnail = cache_service.getThumbnail(MISSING_THUMBNAIL + "w60-h60-l90-rj", size=60)
+    assert (thumbnail.thumbnail_id, thumbnail.size, thumbnail.downloaded) == (MISSING_THUMBNAIL, 60, False)
+    assert cache_service.getThumbnail(MISSING_THUMBNAIL, size=60) is thumbnail
+    assert len(pool.queries) == 1
+
+
+def test_largest_size_is_used_when_no_size_is_given(pool):
+    assert cache_service.getThumbnail(THUMBNAIL_A).filepath == "a_120.png"
+    # every size is indexed separately
+    assert cache_service.getThumbnail(THUMBNAIL_A, size=60).filepath == "a_60.png"
+    assert len(pool.queries) == 2
+
+
+def test_ignore_cache_reads_the_thumbnail_from_the_db_again(pool):
+    cache_service.getThumbnail(THUMBNAIL_B, size=60)
+    cache_service.getThumbnail(THUMBNAIL_B, ignore_cache=True, size=60)
+    assert len(pool.queries) == 2
+
+
+def test_prefetch_gets_every_thumbnail_of_the_json_in_one_query(pool):
+    jsons = [{"thumbnails": [{"url": THUMBNAIL_A + "w60-h60-l90-rj", "width": 60}]},
+             {"thumbnails": []},
+             {"album": {"thumbnail": {"url": THUMBNAIL_B + "w60-h60-l90-rj"}}}]
+    cache_service.prefetchThumbnails(jsons, size=60)
+    assert len(pool.queries) == 1
+
+    pool.reset()
+    thumbnails = [dm.Thumbnail.from_json(j, size=60) for j in jsons]
+    assert pool.queries == []
+    assert [t.filepath if t else None for t in thumbnails] == ["a_60.png", None, None]
+    assert thumbnails[2].thumbnail_id == THUMBNAIL_B
@@ -1,9 +1,17 @@
+import os
+
 PLAYLIST_THUMBNAIL_SIZE = 96
 ALBUM_THUMBNAIL_ON_ARTIST_PAGE_SIZE = 96
 SONG_THUMBNAIL_SIZE = 60
 ARTIST_PAGE_THUMBNAIL_SIZE = 200
 ALBUM_PAGE_THUMBNAIL_SIZE = 200
 
+# where thumbnails are downloaded to (see image_downloader.py), and served from
+IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
+
+# the data_id of my library (my list of playlists) in data_cache and library_version
+LIBRARY_ID = "mine"
+
 
 def iterableToDbTuple(iterable):
     """
@@ -98,6 +98,8 @@ def addSongsToPlaylist(playlist_id, song_ids):
                                                 success=True, action_type=data_models.ActionType.ADD_SONG)
     ytm_db_service.persistSongActionFromSongIds(playlist, already_there_ids + failure_ids, through_ytm=False,
                                                 success=False, action_type=data_models.ActionType.ADD_SONG)
+    cache_service.invalidatePlaylistInMemory(playlist_id)
+    cache_service.refreshPlaylistSnapshot(playlist_id)
     return success_ids, already_there_ids, failure_ids
 
 
@@ -134,11 +136,14 @@ def removeSongsFromPlaylist(playlist_id, songs):
     song_ids = [s["videoId"] for s in songs]
     if isSuccessFromYTM(resp):
         ytm_db_service.deleteSongsFromPlaylistInDb(playlist_id, [s["setVideoId"] for s in songs])
+        ytm_db_service.bumpPlaylistVersions([playlist_id], song_ids)
         ytm_db_service.persistSongActionFromIds(playlist_id=playlist_id, song_ids=song_ids, through_ytm=False,
                                                 success=True, action_type=data_models.ActionType.REMOVE_SONG)
     else:
         ytm_db_service.persistSongActionFromIds(playlist_id=playlist_id, song_ids=song_ids, through_ytm=False,
                                                 success=True, action_type=data_models.ActionType.REMOVE_SONG)
+    cache_service.invalidatePlaylistInMemory(playlist_id)
+    cache_service.refreshPlaylistSnapshot(playlist_id)
     return resp
 
 
@@ -8,7 +8,9 @@ export default function Thumbnail(props) {
     let videoId = props.data.videoId
     if (thumbnail) {
         if (thumbnail.filepath) {
-            src = `http://nuc:3000/images/${thumbnail.filepath}`
+            // the backend resizes the image to the size it's displayed at
+            src = props.size ? `http://nuc:3000/images/${props.size}/${thumbnail.filepath}`
+                : `http://nuc:3000/images/${thumbnail.filepath}`
         } else {
             src = thumbnail.url
         }
@@ -13,7 +13,12 @@ create table if not exists thumbnail_download (
 create table if not exists playlist (
     id varchar primary key,
     name varchar,
-    thumbnail_id varchar references thumbnail(id) on delete set null
+    thumbnail_id varchar references thumbnail(id) on delete set null,
+    -- fingerprint from the library listing, and the fingerprint the last time all its songs were synced
+    ytm_fingerprint varchar,
+    synced_fingerprint varchar,
+    -- incremented whenever the json of this playlist's songs changes (see playlist_snapshot)
+    version int not null default 0
 );
 
 create table if not exists artist (
@@ -21,11 +26,15 @@ create table if not exists artist (
     name varchar,
     thumbnail_id varchar references thumbnail(id) on delete set null,
     description varchar,
-    views int,
+    -- as YTM shows them (ie: "1.2M")
+    views varchar,
     channel_id varchar,
-    subscribers int
+    subscribers varchar
 );
 
+-- artists that YTM returns without an id are looked up by name
+create index if not exists artist_lower_name on artist (lower(name));
+
 create type album_type as enum ('album', 'ep', 'single');
 
 create table if not exists album (
@@ -38,7 +47,7 @@ create table if not exists album (
     release_date varchar,
     release_date_timestamp int,
     duration int,
-    release_type album_type
+    release_type album_type,
     year int
 );
 
@@ -52,15 +61,20 @@ create table if not exists song(
     is_available boolean
 );
 
+-- index: the artist's position in the song's list of artists
 create table if not exists artist_songs(
     song_id varchar references song(id) on delete cascade,
     artist_id varchar references artist(id) on delete cascade,
+    index int,
     primary key (song_id, artist_id)
 );
 
+-- the albums and singles on an artist's page, in the order they're shown
 create table if not exists artist_albums(
     album_id varchar references album(id) on delete cascade,
     artist_id varchar references artist(id) on delete cascade,
+    index int,
+    is_single boolean,
     primary key (album_id, artist_id)
 );
 
@@ -73,8 +87,26 @@ create table if not exists songs_in_playlist(
     index int,
     primary key (playlist_id, song_id, set_video_id)
 );
+-- for reading a playlist's songs in order, a page at a time
+create index if not exists songs_in_playlist_index on songs_in_playlist (playlist_id, index);
+
+-- the json of a playlist's songs, as it was at the given version of the playlist (compressed with zlib)
+create table if not exists playlist_snapshot(
+    playlist_id varchar primary key references playlist(id) on delete cascade,
+    version int not null,
+    tracks bytea not null
+);
+
+-- incremented whenever the json of my library changes without it being retrieved from YTM again
+-- (ie: a playlist's songs or name changed). Its id is the library's data_id in data_cache
+create table if not exists library_version(
+    id varchar primary key,
+    version int not null default 0
+);
+insert into library_version (id) values ('mine') on conflict do nothing;
 
-create type data_type as enum ('playlist', 'song', 'album', 'artist', 'thumbnail', 'library', 'history');
+-- not_found: YTM returned 404 for the item. Its data_id is <data type>:<id> (ie: album:MPREb_123)
+create type data_type as enum ('playlist', 'song', 'album', 'artist', 'thumbnail', 'library', 'history', 'not_found');
 
 create table if not exists data_cache(
     data_id varchar,
@@ -106,4 +138,37 @@ create table listening_history(
     song_id varchar references song(id),
     listen_timestamp int,
     listen_order serial primary key
-);
\ No newline at end of file
+);
+
+create type stats_period as enum ('day', 'week', 'month');
+create type stats_item_type as enum ('song', 'artist', 'album', 'total');
+
+-- number of plays and seconds listened for each song/artist/album in each day/week/month of listening_history.
+-- 'total' has one row per period (item_id is ''). Updated as plays are added (see listening_stats.py)
+create table if not exists listening_stats(
+    period stats_period,
+    period_start date,
+    item_type stats_item_type,
+    item_id varchar,
+    plays int not null,
+    seconds int not null,
+    primary key (period, period_start, item_type, item_id)
+);
+
+-- migrations for existing databases
+alter table playlist add column if not exists ytm_fingerprint varchar;
+alter table playlist add column if not exists synced_fingerprint varchar;
+alter table playlist add column if not exists version int not null default 0;
+-- history used to be rewritten (most recent first, without timestamps) on every refresh. Now new plays are appended,
+-- so listen_order goes up with time. The old rows are kept with a null timestamp, and their listen_order is negated so
+-- they come before every appended play, in the order they were played. Rows that were already negated are skipped.
+update listening_history set listen_order = -listen_order where listen_timestamp is null and listen_order > 0;
+alter table artist alter column views type varchar;
+alter table artist alter column subscribers type varchar;
+alter table artist_albums add column if not exists index int;
+alter table artist_albums add column if not exists is_single boolean;
+-- artist pages used to only be cached in memory, so their data_cache rows have nothing in the db behind them
+delete from data_cache where data_type = 'artist'
+    and data_id not in (select artist_id from artist_albums union select id from artist where channel_id is not null);
+alter type data_type add value if not exists 'not_found';
+alter table artist_songs add column if not exists index int;